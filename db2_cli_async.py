@@ -0,0 +1,420 @@
+"""
+    @author: Romeo Lupascu
+    @contact: romeol@ca.ibm.com
+    @organization: IBM
+    @license: http://www.apache.org/licenses/LICENSE-2.0
+    @see: https://github.com/romeolibm/python_db2_cli_lib
+
+     An asyncio front-end (python 3 only) for the db2 and db2pd cli
+     subprocesses of db2_cli_lib.
+
+     The child processes are driven by asyncio subprocess streams
+     so many sessions can run on one event loop without any reader
+     threads. The prompt detection, error detection and line handlers
+     are the ones of DB2CliSubprocess and DB2pdSubprocess.
+
+        async def main():
+            db = await AsyncDB2CliSubprocess.create("sample")
+            try:
+                rs = await db.query("select * from syscat.tables")
+            finally:
+                await db.shutdown()
+"""
+import asyncio, locale, os, time, traceback
+from db2_cli_lib import LGR, TextLineSplitter, ResultCache, DB2CliSubprocess, DB2pdSubprocess, \
+    DisplayRowDecoder, _sharedResult
+
+class AsyncSubprocessMixin:
+    """
+    Replace the threads and the blocking getResponse of a
+    TextRequestResponseSubprocess with asyncio subprocess streams.
+    Must be used before the TextRequestResponseSubprocess derived
+    class in the bases list.
+    """
+    def _start(self):
+        """
+        The child process is started by the start() coroutine
+        """
+
+    async def start(self, timeout=10):
+        """
+        Start the child process and the stdout/stderr reader tasks
+        then wait up to timeout seconds for the first prompt.
+        """
+        LGR.debug("Exec process cmd:{0}".format(repr(self.cmdline)))
+        self.encoding = locale.getpreferredencoding(False)
+        self.endRequestEvent = asyncio.Event()
+        self.proc = await asyncio.create_subprocess_exec(
+            *self.cmdline,
+            stdin=asyncio.subprocess.PIPE,
+            stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.PIPE,
+            env=self.env
+        )
+        self.stdoutproc = asyncio.ensure_future(self._readStream(
+            self.proc.stdout,
+            self._outputSplitter(),
+            True,
+            self._handleEof
+        ))
+        self.stderrproc = asyncio.ensure_future(self._readStream(
+            self.proc.stderr,
+            TextLineSplitter(self.handleErrorLine, encoding=self.encoding)
+        ))
+        if self.promptDetectorMethod:
+            try:
+                await asyncio.wait_for(self.endRequestEvent.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+        return self
+
+    def _outputSplitter(self):
+        """
+        Return the stdout line splitter, it knows the prompt so a prompt
+        followed by more output in the same chunk is found
+        """
+        return TextLineSplitter(
+            self.handleOutputLine,
+            self.handleInflightLine,
+            encoding=self.encoding,
+            prompt=self.PROMPT
+        )
+
+    async def _readStream(self, stream, splitter, recordChunks=False, onEof=None):
+        try:
+            while True:
+                data = await stream.read(self.readChunkSize or 65536)
+                if not data:
+                    if onEof is not None:
+                        onEof()
+                    break
+                if recordChunks and self.metrics is not None:
+                    self._recordChunk(data)
+                    splitter.feed(data)
+                    self._recordChunk(None)
+                else:
+                    splitter.feed(data)
+        except asyncio.CancelledError:
+            pass
+        except Exception as e:
+            LGR.debug("rd-err:{0}".format(traceback.format_exc()))
+
+    def isAlive(self):
+        return self.proc is not None and self.proc.returncode is None
+
+    async def getResponse(self, cmd, timeout=None):
+        """
+        Send a request to the child process then wait for the prompt
+        and return the parsed response (or error).
+        """
+        timeout = self.requestTimeout if timeout is None else timeout
+        self._beginRequest(cmd)
+        try:
+            self.proc.stdin.write((cmd + os.linesep).encode(self.encoding))
+            await self.proc.stdin.drain()
+            if self.requestMetrics is not None:
+                self.requestMetrics.sent = time.time()
+
+            try:
+                await asyncio.wait_for(self.endRequestEvent.wait(), timeout)
+            except asyncio.TimeoutError:
+                raise Exception("Timeout")
+            if not self.endRequest:
+                raise Exception("{0} process ended".format(self.name))
+            return self._requestResult()
+        except Exception as e:
+            if self.requestMetrics is not None:
+                self._endRequestMetrics(e)
+            raise
+        finally:
+            if self.requestMetrics is not None:
+                self._endRequestMetrics()
+
+    def close(self):
+        for task in (self.stdoutproc, self.stderrproc):
+            if task:
+                task.cancel()
+
+    async def shutdown(self, timeout=5):
+        """
+        End the child process by closing its stdin, wait up to timeout
+        seconds for it to exit then kill it if still alive.
+        """
+        try:
+            if self.isAlive():
+                self.proc.stdin.close()
+                try:
+                    await asyncio.wait_for(self.proc.wait(), timeout)
+                except asyncio.TimeoutError:
+                    self.proc.kill()
+                    await self.proc.wait()
+        except Exception as e:
+            LGR.debug("shutdown-err:{0}".format(traceback.format_exc()))
+        finally:
+            self.close()
+
+class AsyncDB2CliSubprocess(AsyncSubprocessMixin, DB2CliSubprocess):
+    """
+    asyncio version of DB2CliSubprocess, use the create() coroutine
+    to get a started (and connected) session.
+    """
+    def __init__(self, database=None, delimiter="@", cache=None, instance=None):
+        DB2CliSubprocess.__init__(self, None, delimiter, cache, instance)
+        self.database = database
+        self.name = "asyncdb2subprocess"
+
+    @classmethod
+    async def create(cls, database=None, delimiter="@", cache=None, instance=None):
+        session = cls(database, delimiter, cache, instance)
+        await session.start()
+        if database:
+            await session.connect(database)
+        return session
+
+    async def query(self, sql, rowWriter=None, rowReader=None, ttl=None, typed=False, timeout=None):
+        """
+        See DB2CliSubprocess.query, the timeout defaults to requestTimeout
+        """
+        if rowWriter is not None or rowReader is not None:
+            ttl = 0
+        decoder = None
+        if typed:
+            decoder = await self.rowDecoder(sql)
+            if rowWriter is not None:
+                rowWriter = decoder.writer(rowWriter)
+        rs = await self._cachedAsync(
+            sql,
+            lambda cmd: self._query(cmd, rowWriter, rowReader, timeout),
+            ttl
+        )
+        return decoder.result(rs) if decoder is not None else rs
+
+    async def rowDecoder(self, sql):
+        """
+        See DB2CliSubprocess.rowDecoder
+        """
+        key = self._cacheKey(sql)
+        decoder = self.describeCache.pop(key, None)
+        if decoder is None:
+            decoder = DisplayRowDecoder(await self.describe(sql))
+        self.describeCache[key] = decoder
+        while len(self.describeCache) > DB2CliSubprocess.DESCRIBE_CACHE_SIZE:
+            self.describeCache.popitem(last=False)
+        return decoder
+
+    async def describe(self, sql):
+        """
+        See DB2CliSubprocess.describe
+        """
+        self.describeHeader = False
+        return await self.execCmd(
+            "describe " + sql,
+            responseLineHandler=self.handleDescribeOutputLine
+        )
+
+    async def _query(self, sql, rowWriter=None, rowReader=None, timeout=None):
+        try:
+            return await self.getResponse(
+                self._prepareQuery(sql, rowWriter, rowReader),
+                timeout
+            )
+        finally:
+            self._resetRequest()
+
+    async def _cachedAsync(self, cmd, execute, ttl=None, private=False):
+        """
+        See DB2CliSubprocess._cached, execute returns an awaitable
+        """
+        if not self._cacheable(ttl):
+            return await execute(cmd)
+        key = self._cacheKey(cmd, private)
+        value = self.cache.get(key)
+        if value is ResultCache.MISS:
+            value = await execute(cmd)
+            self.cache.put(key, value, ttl)
+        return _sharedResult(value)
+
+    async def execStmt(self,
+            sql,
+            responseParser=None,
+            responseLineHandler=None,
+            useDelim=True,
+            returError=False,
+            responseObject=None,
+            timeout=None
+        ):
+        """
+        See DB2CliSubprocess.execStmt
+        """
+        try:
+            result = await self.getResponse(self._prepareStmt(sql,
+                responseParser,
+                responseLineHandler,
+                useDelim,
+                returError,
+                responseObject
+            ), timeout)
+        finally:
+            self._resetRequest()
+            self._invalidateCache(sql)
+        self._trackConnect(sql, result)
+        return result
+
+    async def execCmd(self,
+            sql,
+            responseParser=None,
+            responseLineHandler=None,
+            responseObject=None,
+            timeout=None
+        ):
+        """
+        See DB2CliSubprocess.execCmd
+        """
+        return await self.execStmt(sql,
+            responseParser,
+            responseLineHandler,
+            responseObject=responseObject,
+            timeout=timeout
+        )
+
+    async def getMyApplHandle(self, ttl=None):
+        async def execute(cmd):
+            return self._applHandle(await self._query(cmd))
+        return await self._cachedAsync(
+            "values mon_get_application_handle",
+            execute,
+            ttl,
+            private=True
+        )
+
+    async def getSnapshotForApplication(self, *appl_handle):
+        """
+        See DB2CliSubprocess.getSnapshotForApplication
+        """
+        if len(appl_handle) == 0:
+            return None
+        rl = []
+        for ah in appl_handle:
+            rl.append(await self.execCmd(
+                self._prepareApplicationSnapshot(ah),
+                responseLineHandler=self.handleApplicationSnapshotLine,
+                responseObject={}
+            ))
+        return rl if len(rl) > 1 else rl[0]
+
+    async def getSnapshotForApplications(self, *appl_handle, database=None, compact=False):
+        """
+        See DB2CliSubprocess.getSnapshotForApplications
+        """
+        return await self.execCmd(
+            self._prepareApplicationsSnapshot(database, compact),
+            responseParser=self._applicationSnapshots(appl_handle, compact),
+            responseLineHandler=self.handleApplicationsSnapshotLine
+        )
+
+    async def getDatabaseAliases(self, ttl=None):
+        self.section = None
+        return await self._cachedAsync("list database directory", lambda cmd: self.execCmd(
+            cmd,
+            responseLineHandler=self.handleListDatabaseDirectoryExtractAliasLine
+        ), ttl)
+
+    async def connect(self, dbalias=None):
+        """
+        See DB2CliSubprocess.connect
+        """
+        if not dbalias:
+            aliases = await self.getDatabaseAliases()
+            dbalias = aliases[0]
+        await self.execStmt("connect to " + dbalias)
+
+    async def shutdown(self, timeout=5):
+        """
+        Send a terminate command then end the db2 child process
+        """
+        if self.cache is not None:
+            self.cache.invalidate(scope=self.cacheScope)
+        try:
+            if self.isAlive() and self.endRequest:
+                self.proc.stdin.write(
+                    ("terminate" + self.delimiter + os.linesep).encode(self.encoding)
+                )
+                await self.proc.stdin.drain()
+        except Exception as e:
+            LGR.debug("terminate-err:{0}".format(traceback.format_exc()))
+        await AsyncSubprocessMixin.shutdown(self, timeout)
+
+class AsyncDB2pdSubprocess(AsyncSubprocessMixin, DB2pdSubprocess):
+    """
+    asyncio version of DB2pdSubprocess, use the create() coroutine
+    to get a started session.
+    """
+    def __init__(self, database=None):
+        DB2pdSubprocess.__init__(self, database)
+        self.name = "asyncdb2pdsubprocess"
+
+    @classmethod
+    async def create(cls, database=None):
+        session = cls(database)
+        await session.start()
+        return session
+
+    async def execCmd(self,
+            cmd,
+            responseParser=None,
+            responseLineHandler=None,
+            responseObject=None,
+            timeout=None
+        ):
+        """
+        Execute a db2pd command and return the output lines or the
+        result of the responseParser
+        """
+        try:
+            self.responseParser = responseParser
+            self.responseLineHandler = responseLineHandler
+            self.response = [] if responseObject is None else responseObject
+            return await self.getResponse(cmd, timeout)
+        finally:
+            self.responseParser = None
+            self.responseLineHandler = None
+
+    async def execSections(self, cmd, timeout=None):
+        """
+        See DB2pdSubprocess.execSections
+        """
+        self.textColumns = {}
+        self.section = None
+        self.table = None
+        return await self.execCmd(cmd,
+            responseLineHandler=self.handleSectionOutputLine,
+            responseObject={'banner': [], 'sections': {}},
+            timeout=timeout
+        )
+
+    async def getSections(self, *names, database=None, timeout=None):
+        """
+        See DB2pdSubprocess.getSections
+        """
+        return await self.execCmd(
+            self._prepareSections(names, database),
+            responseParser=self._sectionsResult(names),
+            responseLineHandler=self.handleSectionOutputLine,
+            responseObject={'banner': [], 'sections': {}},
+            timeout=timeout
+        )
+
+    async def getLatches(self):
+        return (await self.getSections('latches'))['latches']
+
+    async def getLocks(self, database=None):
+        return (await self.getSections('locks', database=database))['locks']
+
+    async def getBufferpools(self, database=None):
+        return (await self.getSections('bufferpools', database=database))['bufferpools']
+
+    async def getTransactions(self, database=None):
+        return (await self.getSections('transactions', database=database))['transactions']
+
+    async def getMempools(self):
+        return (await self.getSections('mempools'))['mempools']
@@ -0,0 +1,261 @@
+"""
+    @author: Romeo Lupascu
+    @contact: romeol@ca.ibm.com
+    @organization: IBM
+    @license: http://www.apache.org/licenses/LICENSE-2.0
+    @see: https://github.com/romeolibm/python_db2_cli_lib
+
+     Benchmarks of the db2_cli_lib sessions, run against the fake db2
+     and db2pd command line processors of db2_cli_fake (no db2 instance
+     needed) or against a real instance with --real.
+     For each benchmark the p50/p99 latency, rows per second and MB
+     per second (of db2 output read) are reported.
+
+        python db2_cli_bench.py --rows 200000 --width 32 --json bench.json
+        python db2_cli_bench.py --baseline bench.json --tolerance 0.2
+        python db2_cli_bench.py --real --database sample \\
+            --query "select * from syscat.columns"
+
+     With a baseline the exit code is 1 if a benchmark p50 latency or
+     throughput is worse than the baseline by more than the tolerance.
+"""
+import os, sys, time, json, tempfile, shutil, argparse
+import db2_cli_lib
+from db2_cli_lib import LatencyHistogram, RequestInstrumentation, \
+    DB2CliSubprocess, DB2pdSubprocess
+import db2_cli_fake
+import db2_cli_columnar
+
+class Benchmark:
+    """
+    Time the repeated calls of a function, the request metrics of the
+    session (if any) provide the bytes read
+    """
+    def __init__(self, name, session=None):
+        self.name = name
+        self.session = session
+        self.histogram = LatencyHistogram()
+        self.rows = 0
+        self.bytesRead = 0
+        self.seconds = 0.0
+        if session is not None:
+            session.enableMetrics(RequestInstrumentation([self._record]))
+
+    def _record(self, metrics):
+        self.bytesRead += metrics.bytesRead
+
+    def run(self, function, count):
+        for i in range(count):
+            stime = time.time()
+            rows = function()
+            elapsed = time.time() - stime
+            self.histogram.record(elapsed)
+            self.seconds += elapsed
+            self.rows += rows or 0
+        if self.session is not None:
+            self.session.disableMetrics()
+        return self.result()
+
+    def result(self):
+        seconds = self.seconds or None
+        return {
+            'name':self.name,
+            'count':self.histogram.count,
+            'p50':self.histogram.percentile(50),
+            'p99':self.histogram.percentile(99),
+            'mean':self.seconds / self.histogram.count if self.histogram.count else None,
+            'rowsPerSecond':self.rows / seconds if seconds and self.rows else None,
+            'mbPerSecond':self.bytesRead / 1048576.0 / seconds \
+                if seconds and self.bytesRead else None
+        }
+
+def _rowCount(rs):
+    return len(rs['rows'])
+
+def benchStartup(args):
+    def start():
+        session = DB2CliSubprocess(args.database)
+        session.shutdown()
+    return Benchmark("startup").run(start, args.startups)
+
+def benchQueryLatency(db, args):
+    sql = args.latencyQuery or "select * from bench fetch first 1 rows only"
+    return Benchmark("query.latency", db).run(
+        lambda: _rowCount(db.query(sql)), args.count
+    )
+
+def benchQueryThroughput(db, args):
+    sql = args.query or "select * from bench fetch first {0} rows only".format(args.rows)
+    return Benchmark("query.throughput", db).run(
+        lambda: _rowCount(db.query(sql)), args.repeat
+    )
+
+def benchQueryDelimited(db, args):
+    sql = args.query or "select * from bench fetch first {0} rows only".format(args.rows)
+    return Benchmark("queryDelimited.throughput", db).run(
+        lambda: _rowCount(db.queryDelimited(sql)), args.repeat
+    )
+
+def benchQueryColumns(db, args):
+    sql = args.query or "select * from bench fetch first {0} rows only".format(args.rows)
+    def query():
+        rs = db.queryColumns(sql)
+        return rs['count']
+    return Benchmark("queryColumns.throughput", db).run(query, args.repeat)
+
+def benchExportColumnar(db, args):
+    sql = args.query or "select * from bench fetch first {0} rows only".format(args.rows)
+    fd, path = tempfile.mkstemp(prefix="db2bench", suffix=".col")
+    os.close(fd)
+    try:
+        return Benchmark("exportColumnar.throughput", db).run(
+            lambda: db2_cli_columnar.exportColumnar(db, sql, path), args.repeat
+        )
+    finally:
+        os.remove(path)
+
+def benchExecStmt(db, args):
+    sql = args.stmt or "update bench set col1 = 'x' where id = 1"
+    def execute():
+        db.execStmt(sql)
+    return Benchmark("execStmt.latency", db).run(execute, args.count)
+
+def benchSnapshot(db, args):
+    handle = db.getMyApplHandle()
+    def snapshot():
+        db.getSnapshotForApplication(handle)
+    return Benchmark("snapshot.application", db).run(snapshot, args.count)
+
+def benchSnapshots(db, args):
+    return Benchmark("snapshot.applications", db).run(
+        lambda: len(db.getSnapshotForApplications()), args.repeat
+    )
+
+def benchDb2pd(args):
+    pd = DB2pdSubprocess(args.database)
+    try:
+        def sections():
+            rs = pd.getSections('locks', 'transactions')
+            return sum(len(s['rows']) for s in rs.values())
+        return Benchmark("db2pd.sections", pd).run(sections, args.repeat)
+    finally:
+        pd.shutdown()
+
+def runBenchmarks(args):
+    results = [benchStartup(args)]
+    db = DB2CliSubprocess(args.database)
+    try:
+        for bench in (
+                benchQueryLatency,
+                benchQueryThroughput,
+                benchQueryDelimited,
+                benchQueryColumns,
+                benchExportColumnar,
+                benchExecStmt,
+                benchSnapshot,
+                benchSnapshots
+            ):
+            results.append(bench(db, args))
+    finally:
+        db.shutdown()
+    results.append(benchDb2pd(args))
+    return results
+
+def compareResults(results, baseline, tolerance):
+    """
+    Return the list of regressions compared to the baseline results
+    """
+    previous = dict((r['name'], r) for r in baseline)
+    regressions = []
+    for r in results:
+        b = previous.get(r['name'])
+        if not b:
+            continue
+        if r['p50'] and b['p50'] and r['p50'] > b['p50'] * (1 + tolerance):
+            regressions.append("{0}: p50 {1:.6f}s > {2:.6f}s".format(r['name'], r['p50'], b['p50']))
+        for k in ('rowsPerSecond', 'mbPerSecond'):
+            if r[k] and b[k] and r[k] < b[k] * (1 - tolerance):
+                regressions.append("{0}: {1} {2:.1f} < {3:.1f}".format(r['name'], k, r[k], b[k]))
+    return regressions
+
+def printResults(results):
+    def fmt(v, scale=1.0, digits=3):
+        return "-" if v is None else "{0:.{1}f}".format(v * scale, digits)
+    print("{0:<26} {1:>6} {2:>10} {3:>10} {4:>12} {5:>9}".format(
+        "benchmark", "count", "p50(ms)", "p99(ms)", "rows/s", "MB/s"
+    ))
+    for r in results:
+        print("{0:<26} {1:>6} {2:>10} {3:>10} {4:>12} {5:>9}".format(
+            r['name'], r['count'],
+            fmt(r['p50'], 1000.0), fmt(r['p99'], 1000.0),
+            fmt(r['rowsPerSecond'], digits=0), fmt(r['mbPerSecond'], digits=2)
+        ))
+
+def parseArgs(argv):
+    parser = argparse.ArgumentParser(description="db2_cli_lib benchmarks")
+    parser.add_argument("--real", action="store_true",
+        help="use the db2 and db2pd commands of the PATH instead of the fake ones")
+    parser.add_argument("--database", default="sample")
+    parser.add_argument("--reactor", action="store_true",
+        help="read the sessions output with a shared TextIOReactor thread")
+    parser.add_argument("--rows", type=int, default=100000,
+        help="rows of the throughput queries")
+    parser.add_argument("--width", type=int, default=32,
+        help="width of the fake text columns")
+    parser.add_argument("--columns", type=int, default=3,
+        help="columns of the fake results")
+    parser.add_argument("--latency", type=float, default=0.0,
+        help="latency injected by the fake commands")
+    parser.add_argument("--applications", type=int, default=1000,
+        help="applications in the fake snapshots")
+    parser.add_argument("--count", type=int, default=500,
+        help="calls of the latency benchmarks")
+    parser.add_argument("--repeat", type=int, default=3,
+        help="calls of the throughput benchmarks")
+    parser.add_argument("--startups", type=int, default=5)
+    parser.add_argument("--query", help="throughput query")
+    parser.add_argument("--latencyQuery", help="latency query")
+    parser.add_argument("--stmt", help="execStmt benchmark statement")
+    parser.add_argument("--json", help="save the results in this file")
+    parser.add_argument("--baseline", help="results file to compare to")
+    parser.add_argument("--tolerance", type=float, default=0.2)
+    return parser.parse_args(argv)
+
+def main(argv):
+    args = parseArgs(argv)
+    tmpdir = None
+    if not args.real:
+        tmpdir = db2_cli_fake.installFakeCommands(tempfile.mkdtemp(prefix="db2fake"))
+        os.environ['PATH'] = tmpdir + os.pathsep + os.environ.get('PATH', '')
+        os.environ['DB2FAKE_WIDTH'] = str(args.width)
+        os.environ['DB2FAKE_COLUMNS'] = str(args.columns)
+        os.environ['DB2FAKE_LATENCY'] = str(args.latency)
+        os.environ['DB2FAKE_ROWS'] = str(args.rows)
+        os.environ['DB2FAKE_APPLICATIONS'] = str(args.applications)
+    if args.reactor:
+        db2_cli_lib.useReactor()
+    try:
+        results = runBenchmarks(args)
+    finally:
+        if tmpdir:
+            shutil.rmtree(tmpdir, True)
+    printResults(results)
+    if args.json:
+        f = open(args.json, "w")
+        try:
+            json.dump(results, f, indent=1)
+        finally:
+            f.close()
+    if args.baseline:
+        f = open(args.baseline)
+        try:
+            regressions = compareResults(results, json.load(f), args.tolerance)
+        finally:
+            f.close()
+        for r in regressions:
+            print("REGRESSION " + r)
+        return 1 if regressions else 0
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
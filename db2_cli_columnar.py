@@ -0,0 +1,419 @@
+"""
+    @author: Romeo Lupascu
+    @contact: romeol@ca.ibm.com
+    @organization: IBM
+    @license: http://www.apache.org/licenses/LICENSE-2.0
+    @see: https://github.com/romeolibm/python_db2_cli_lib
+
+     Columnar export of the query results: the rows written by query()
+     are kept in column batches written to a file every batchRows rows,
+     the numeric columns are read back through mmap without copy.
+
+        columns = db.describe(sql)
+        with ColumnarWriter("apps.col", columns, null="-") as writer:
+            db.query(sql, rowWriter=writer)
+        # or exportColumnar(db, sql, "apps.col")
+
+        with ColumnarReader("apps.col") as reader:
+            print(reader.names, len(reader))
+            ids = reader.values("ID", 0)    # numpy array of the batch 0
+            for row in reader.rows():
+                ...
+
+     With fileFormat='arrow' (pyarrow needed) the file is an Arrow IPC
+     file (pyarrow.ipc.open_file(pyarrow.memory_map(path)) reads it),
+     by default (fileFormat='db2col') the file contains:
+        b"DB2COL1\\0"
+        the batches, for each column a validity buffer (1 byte per row)
+        and the values: 8 bytes per row (little endian int64 or float64)
+        for the numeric, date (days since 1970-01-01) and timestamp
+        (microseconds since 1970-01-01) columns, the row offsets (int32,
+        rows + 1) and the utf-8 data for the text and decimal columns.
+        Each buffer starts at a multiple of 8 bytes.
+        the footer: json {'columns':[{'name', 'type', 'kind'}...],
+        'batches':[{'rows', 'buffers':[[offset, size]...]}...]}
+        the footer size (int64) and b"DB2COL1\\0"
+"""
+import os, sys, json, struct, mmap, datetime, decimal
+from db2_cli_lib import LGR, DB2_DISPLAY_CONVERTERS
+try:
+    import numpy
+except ImportError:
+    numpy = None
+try:
+    import pyarrow
+    import pyarrow.ipc
+except ImportError:
+    pyarrow = None
+
+MAGIC = b"DB2COL1\0"
+ARROW_MAGIC = b"ARROW1"
+# storage kind of the db2 column types, the other types are text
+DB2_COLUMN_KINDS = {
+    'SMALLINT': 'int64',
+    'INTEGER': 'int64',
+    'BIGINT': 'int64',
+    'REAL': 'float64',
+    'DOUBLE': 'float64',
+    'FLOAT': 'float64',
+    'DECIMAL': 'decimal',
+    'NUMERIC': 'decimal',
+    'DECFLOAT': 'decimal',
+    'DATE': 'date',
+    'TIMESTAMP': 'timestamp'
+}
+# struct format of the fixed size kinds
+FIXED_KINDS = {'int64': 'q', 'float64': 'd', 'date': 'q', 'timestamp': 'q'}
+NUMPY_TYPES = {'q': '<i8', 'd': '<f8', 'i': '<i4'}
+EPOCH_DATE = datetime.date(1970, 1, 1)
+EPOCH = datetime.datetime(1970, 1, 1)
+if pyarrow is not None:
+    # arrow type of the kinds (the decimals are exported as text)
+    ARROW_TYPES = {
+        'int64': pyarrow.int64,
+        'float64': pyarrow.float64,
+        'decimal': pyarrow.string,
+        'date': pyarrow.date32,
+        'timestamp': lambda: pyarrow.timestamp('us'),
+        'text': pyarrow.string
+    }
+
+def _text(value):
+    if isinstance(value, bytes):
+        return value
+    if not isinstance(value, str):
+        value = u"{0}".format(value)
+    return value.encode("utf-8")
+
+def _date(value):
+    if isinstance(value, datetime.date):
+        return value
+    return DB2_DISPLAY_CONVERTERS['DATE'](value)
+
+def _timestamp(value):
+    if isinstance(value, datetime.datetime):
+        return value
+    return DB2_DISPLAY_CONVERTERS['TIMESTAMP'](value)
+
+def _decimalText(value):
+    return value if isinstance(value, str) else str(value)
+
+# conversion of the values written (python values or db2 displayed text)
+KIND_CONVERTERS = {
+    'int64': int,
+    'float64': float,
+    'decimal': _decimalText,
+    'date': _date,
+    'timestamp': _timestamp,
+    'text': None
+}
+
+def columnKinds(columns):
+    """
+    Return the export columns [{'name', 'type', 'kind', 'nullable'}] of
+    the columns returned by describe() (or of column names, exported as
+    nullable text)
+    """
+    kinds = []
+    for c in columns:
+        if not isinstance(c, dict):
+            c = {'name':c, 'type':'VARCHAR', 'nullable':True}
+        kinds.append({
+            'name':c['name'],
+            'type':c['type'],
+            'kind':DB2_COLUMN_KINDS.get(c['type'], 'text'),
+            'nullable':c.get('nullable', True)
+        })
+    return kinds
+
+class ColumnarWriter:
+    """
+    A row writer (writerow) keeping the rows in column batches written
+    every batchRows rows to path. null is the NULL marker of the values
+    of the nullable columns ("-" for the rows of query(), None for the
+    rows of query(typed=True)). fileFormat is 'db2col' (the default, read
+    by ColumnarReader) or 'arrow' (pyarrow needed).
+    """
+    def __init__(self, path, columns, batchRows=65536, null=None, fileFormat='db2col'):
+        if fileFormat not in ('db2col', 'arrow'):
+            raise Exception("Unknown columnar file format {0}".format(fileFormat))
+        if fileFormat == 'arrow' and pyarrow is None:
+            raise Exception("The arrow format requires pyarrow")
+        self.path = path
+        self.columns = columnKinds(columns)
+        self.batchRows = batchRows
+        self.null = null
+        self.fileFormat = fileFormat
+        self.rows = []
+        self.count = 0
+        self.batches = []
+        if self.fileFormat == 'arrow':
+            self.schema = pyarrow.schema([
+                pyarrow.field(c['name'], ARROW_TYPES[c['kind']]()) for c in self.columns
+            ])
+            self.file = None
+            self.arrowWriter = pyarrow.ipc.new_file(path, self.schema)
+        else:
+            self.file = open(path, "wb")
+            self.file.write(MAGIC)
+            self.size = len(MAGIC)
+
+    def writerow(self, row):
+        self.rows.append(row)
+        if len(self.rows) >= self.batchRows:
+            self.flush()
+
+    def __columnValues(self, column, values):
+        """
+        Return the python values of a column, NULLs as None
+        """
+        converter = KIND_CONVERTERS[column['kind']]
+        if self.null is not None and column['nullable']:
+            null = self.null
+            if converter is None:
+                return [None if v == null else v for v in values]
+            return [None if v is None or v == null else converter(v) for v in values]
+        if converter is None:
+            return values
+        return [None if v is None else converter(v) for v in values]
+
+    def flush(self):
+        """
+        Write the rows kept as a batch
+        """
+        rows = self.rows
+        if not rows:
+            return
+        self.rows = []
+        if len(rows[0]) != len(self.columns):
+            raise Exception("Expected {0} columns, got {1}".format(len(self.columns), len(rows[0])))
+        columns = [
+            self.__columnValues(c, values) for c, values in zip(self.columns, zip(*rows))
+        ]
+        if self.fileFormat == 'arrow':
+            self.arrowWriter.write_batch(pyarrow.record_batch([
+                pyarrow.array(values, type=f.type) for f, values in zip(self.schema, columns)
+            ], schema=self.schema))
+        else:
+            self.__writeBatch(len(rows), columns)
+        self.count += len(rows)
+        LGR.debug("columnar-batch:{0}:{1}".format(self.path, len(rows)))
+
+    def __writeBuffer(self, data):
+        padding = -self.size % 8
+        if padding:
+            self.file.write(b"\0" * padding)
+            self.size += padding
+        self.file.write(data)
+        offset = self.size
+        self.size += len(data)
+        return [offset, len(data)]
+
+    def __writeBatch(self, count, columns):
+        buffers = []
+        for c, values in zip(self.columns, columns):
+            buffers.append(self.__writeBuffer(
+                bytes(bytearray(0 if v is None else 1 for v in values))
+            ))
+            kind = c['kind']
+            if kind in FIXED_KINDS:
+                if kind == 'date':
+                    values = [0 if v is None else (v - EPOCH_DATE).days for v in values]
+                elif kind == 'timestamp':
+                    values = [0 if v is None else _microseconds(v - EPOCH) for v in values]
+                else:
+                    values = [0 if v is None else v for v in values]
+                buffers.append(self.__writeBuffer(
+                    struct.pack("<{0}{1}".format(count, FIXED_KINDS[kind]), *values)
+                ))
+            else:
+                data = [b"" if v is None else _text(v) for v in values]
+                offsets = [0]
+                for d in data:
+                    offsets.append(offsets[-1] + len(d))
+                if offsets[-1] > 0x7fffffff:
+                    raise Exception("Text column {0} batch too large".format(c['name']))
+                buffers.append(self.__writeBuffer(struct.pack("<{0}i".format(count + 1), *offsets)))
+                buffers.append(self.__writeBuffer(b"".join(data)))
+        self.batches.append({'rows':count, 'buffers':buffers})
+
+    def close(self):
+        """
+        Write the last batch and the footer
+        """
+        if self.fileFormat == 'arrow':
+            if self.arrowWriter is not None:
+                self.flush()
+                self.arrowWriter.close()
+                self.arrowWriter = None
+            return
+        if self.file is None:
+            return
+        self.flush()
+        footer = json.dumps({
+            'columns':[dict((k, c[k]) for k in ('name', 'type', 'kind')) for c in self.columns],
+            'batches':self.batches
+        }).encode("utf-8")
+        self.__writeBuffer(footer)
+        self.file.write(struct.pack("<q", len(footer)) + MAGIC)
+        self.file.close()
+        self.file = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+def _microseconds(delta):
+    return (delta.days * 86400 + delta.seconds) * 1000000 + delta.microseconds
+
+class ColumnarReader:
+    """
+    Read a db2col file through mmap: values() returns the values of a
+    column batch without copy (a numpy array, a memoryview without
+    numpy), column() and rows() the python values (NULLs as None)
+    """
+    def __init__(self, path):
+        self.path = path
+        self.file = open(path, "rb")
+        self.map = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        size = len(self.map)
+        if self.map[:len(ARROW_MAGIC)] == ARROW_MAGIC:
+            self.close()
+            raise Exception("An Arrow IPC file (read it with pyarrow.ipc.open_file): {0}".format(path))
+        if size < 2 * len(MAGIC) + 8 or self.map[:len(MAGIC)] != MAGIC or \
+          self.map[size - len(MAGIC):] != MAGIC:
+            self.close()
+            raise Exception("Not a db2col file: {0}".format(path))
+        footerSize = struct.unpack_from("<q", self.map, size - len(MAGIC) - 8)[0]
+        footerEnd = size - len(MAGIC) - 8
+        footer = json.loads(self.map[footerEnd - footerSize:footerEnd].decode("utf-8"))
+        self.columns = footer['columns']
+        self.names = [c['name'] for c in self.columns]
+        self.batches = footer['batches']
+        # index of the first buffer of each column in the batch buffers
+        self.bufferIndex = []
+        pos = 0
+        for c in self.columns:
+            self.bufferIndex.append(pos)
+            pos += 2 if c['kind'] in FIXED_KINDS else 3
+
+    def __len__(self):
+        return sum(b['rows'] for b in self.batches)
+
+    def _column(self, name):
+        return name if isinstance(name, int) else self.names.index(name)
+
+    def _buffer(self, batch, index):
+        return self.batches[batch]['buffers'][index]
+
+    def validity(self, name, batch):
+        """
+        Return the validity bytes of a column batch (0 for NULL)
+        """
+        offset, size = self._buffer(batch, self.bufferIndex[self._column(name)])
+        return self.map[offset:offset + size]
+
+    def values(self, name, batch):
+        """
+        Return the stored values of a column batch without copy: int64
+        or float64 numbers for the fixed size kinds (0 for NULL), the
+        (offsets, data) of the text kinds
+        """
+        i = self._column(name)
+        kind = self.columns[i]['kind']
+        rows = self.batches[batch]['rows']
+        index = self.bufferIndex[i] + 1
+        if kind in FIXED_KINDS:
+            return self._fixed(FIXED_KINDS[kind], rows, *self._buffer(batch, index))
+        offsets = self._fixed('i', rows + 1, *self._buffer(batch, index))
+        offset, size = self._buffer(batch, index + 1)
+        return offsets, self._bytes(offset, size)
+
+    def _fixed(self, code, count, offset, size):
+        if numpy is not None:
+            return numpy.frombuffer(self.map, dtype=NUMPY_TYPES[code],
+                count=count, offset=offset)
+        if sys.byteorder == 'little' and hasattr(memoryview, 'cast'):
+            return memoryview(self.map)[offset:offset + size].cast(code)
+        return struct.unpack_from("<{0}{1}".format(count, code), self.map, offset)
+
+    def _bytes(self, offset, size):
+        if hasattr(memoryview, 'cast'):
+            return memoryview(self.map)[offset:offset + size]
+        return self.map[offset:offset + size]
+
+    def batchColumn(self, name, batch):
+        """
+        Return the python values of a column batch, NULLs as None
+        """
+        i = self._column(name)
+        kind = self.columns[i]['kind']
+        valid = bytearray(self.validity(i, batch))
+        values = self.values(i, batch)
+        if kind in FIXED_KINDS:
+            values = values.tolist() if hasattr(values, 'tolist') else values
+            if kind == 'date':
+                values = [EPOCH_DATE + datetime.timedelta(days=v) for v in values]
+            elif kind == 'timestamp':
+                values = [EPOCH + datetime.timedelta(microseconds=v) for v in values]
+            return [v if ok else None for v, ok in zip(values, valid)]
+        offsets, data = values
+        offsets = offsets.tolist() if hasattr(offsets, 'tolist') else offsets
+        data = bytes(data)
+        texts = [
+            data[offsets[j]:offsets[j + 1]].decode("utf-8") if valid[j] else None \
+                for j in range(len(valid))
+        ]
+        if kind == 'decimal':
+            return [None if v is None else decimal.Decimal(v) for v in texts]
+        return texts
+
+    def column(self, name):
+        """
+        Return the python values of a column, NULLs as None
+        """
+        values = []
+        for batch in range(len(self.batches)):
+            values.extend(self.batchColumn(name, batch))
+        return values
+
+    def rows(self):
+        """
+        Generate the rows (lists of python values)
+        """
+        for batch in range(len(self.batches)):
+            columns = [self.batchColumn(i, batch) for i in range(len(self.columns))]
+            for row in zip(*columns):
+                yield list(row)
+
+    def close(self):
+        if self.map is not None:
+            try:
+                self.map.close()
+            except BufferError:
+                # values() arrays still reference the map
+                pass
+            self.map = None
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+def exportColumnar(session, sql, path, batchRows=65536, fileFormat='db2col'):
+    """
+    Export the result of a query of a DB2CliSubprocess session to a
+    columnar file (see ColumnarWriter), return the number of rows exported
+    """
+    writer = ColumnarWriter(path, session.describe(sql), batchRows, "-", fileFormat)
+    try:
+        session.query(sql, rowWriter=writer)
+    finally:
+        writer.close()
+    return writer.count
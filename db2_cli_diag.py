@@ -0,0 +1,338 @@
+"""
+    @author: Romeo Lupascu
+    @contact: romeol@ca.ibm.com
+    @organization: IBM
+    @license: http://www.apache.org/licenses/LICENSE-2.0
+    @see: https://github.com/romeolibm/python_db2_cli_lib
+
+     Incremental reader of the db2diag.log files: only the bytes written
+     since the last check are read (the file inode and offset are kept
+     in a checkpoint file) and parsed in DiagRecord objects.
+
+        tailer = DB2DiagTailer(get_db2diag_path(), "/var/tmp/diag.ckpt",
+            levels=["Error", "Severe", "Critical"])
+        for rec in tailer.records():
+            print(rec.timestamp, rec.level, rec.pid, rec.function, rec.message)
+
+     A record is committed once the next one is asked for (or by
+     tailer.commit()) so a failure while handling it reads it again.
+     The rotated logs (db2diag.N.log with DIAGSIZE, archived
+     db2diag.log_<timestamp>) are followed: the rest of the checkpoint
+     file is read then the newer files.
+"""
+import os, re, json, time
+
+RECORD_START_REC = re.compile(
+    b"^(\\d{4}-\\d\\d-\\d\\d-\\d\\d\\.\\d\\d\\.\\d\\d\\.\\d+)([+-]\\d+)?\\s+(\\S+)\\s+LEVEL\\s*:\\s*(\\w+)"
+)
+FIELD_REC = re.compile("([A-Z][A-Z0-9_]*(?: #\\d+)?)\\s*:\\s?(.*?)\\s*(?=\\s[A-Z][A-Z0-9_]*\\s*:\\s|$)")
+# the fields whose value is the rest of the line (and the next lines)
+TEXT_FIELDS = ('FUNCTION', 'MESSAGE', 'CALLED', 'RETCODE', 'DATA', 'CALLSTCK', 'START', 'STOP', 'CHANGE', 'IMPACT')
+# the suffix of the logs archived by db2diag -A
+ARCHIVE_SUFFIX = "(_\\d{4}-\\d\\d-\\d\\d-\\d\\d\\.\\d\\d\\.\\d\\d)?"
+DIAG_FILE_REC = re.compile("^db2diag(\\.\\d+)?\\.log" + ARCHIVE_SUFFIX + "$")
+
+def diagFileRec(base):
+    """
+    Return the regex of the names of a log file base name: the name,
+    its rotated (<name>.N<ext>) and archived (<base>_<timestamp>) files
+    """
+    stem, ext = os.path.splitext(base)
+    return re.compile("^" + re.escape(stem) + "(\\.\\d+)?" + re.escape(ext) + ARCHIVE_SUFFIX + "$")
+
+class DiagRecord:
+    """
+    A db2diag.log record: the timestamp, level and the header fields
+    (PID, TID, PROC, INSTANCE, NODE, DB, APPHDL, APPID, EDUID, EDUNAME,
+    FUNCTION, MESSAGE, DATA #n...) in fields, the raw text in text
+    """
+    def __init__(self, timestamp, timezone, recordId, level, text, fname, offset):
+        self.timestamp = timestamp
+        self.timezone = timezone
+        self.recordId = recordId
+        self.level = level
+        self.text = text
+        self.file = fname
+        self.offset = offset
+        self._fields = None
+
+    @property
+    def fields(self):
+        if self._fields is None:
+            self._fields = parseDiagFields(self.text)
+        return self._fields
+
+    @property
+    def pid(self):
+        pid = self.fields.get('PID')
+        return int(pid) if pid and pid.isdigit() else pid
+
+    @property
+    def function(self):
+        return self.fields.get('FUNCTION')
+
+    @property
+    def message(self):
+        return self.fields.get('MESSAGE')
+
+    def __repr__(self):
+        return "DiagRecord({0},{1},{2},{3})".format(
+            self.timestamp, self.level, self.pid, self.function
+        )
+
+def parseDiagFields(text):
+    """
+    Parse the KEY : value fields of a record, the lines not starting
+    with a key continue the value of the previous text field
+    """
+    fields = {}
+    last = None
+    for line in text.split("\n")[1:]:
+        if not line.strip():
+            continue
+        m = FIELD_REC.match(line)
+        key = m.group(1) if m else None
+        if key and (key in TEXT_FIELDS or key.split(" ")[0] in TEXT_FIELDS):
+            fields[key] = line[line.find(":") + 1:].strip()
+            last = key
+        elif key:
+            for m in FIELD_REC.finditer(line):
+                if m.group(1):
+                    fields[m.group(1)] = m.group(2)
+            last = None
+        elif last:
+            fields[last] = fields[last] + "\n" + line.rstrip()
+    return fields
+
+class DB2DiagTailer:
+    """
+    Read the records written in the db2diag log files of a diagpath
+    directory (or a log file) since the last checkpoint.
+    levels and functions filter the records: the level (case
+    insensitive) must be one of levels and the FUNCTION must contain
+    one of functions.
+    Without a checkpoint the files are read from the beginning, or
+    from their current end if startAtEnd is True.
+    The last record of the newest file is held back while the file was
+    modified less than idleTimeout seconds ago (None to wait for the
+    next record) and until stop() is called.
+    """
+    def __init__(self,
+            path,
+            checkpointFile=None,
+            levels=None,
+            functions=None,
+            startAtEnd=False,
+            chunkSize=1048576,
+            idleTimeout=10
+        ):
+        self.path = path
+        self.checkpointFile = checkpointFile
+        self.levels = set(l.lower() for l in levels) if levels else None
+        self.functions = list(functions) if functions else None
+        self.chunkSize = chunkSize
+        self.idleTimeout = idleTimeout
+        self.stopped = False
+        # the checkpoint after the last returned (not yet committed) record
+        self.position = None
+        self.checkpoint = self.loadCheckpoint()
+        if self.checkpoint is None and startAtEnd:
+            files = self.files()
+            if files:
+                self.checkpoint = self._fileCheckpoint(files[-1], os.stat(files[-1]).st_size)
+
+    def loadCheckpoint(self):
+        if not self.checkpointFile or not os.path.exists(self.checkpointFile):
+            return None
+        f = open(self.checkpointFile)
+        try:
+            return json.load(f)
+        finally:
+            f.close()
+
+    def saveCheckpoint(self):
+        if not self.checkpointFile or self.checkpoint is None:
+            return
+        tmp = self.checkpointFile + ".tmp"
+        f = open(tmp, "w")
+        try:
+            json.dump(self.checkpoint, f)
+        finally:
+            f.close()
+        os.rename(tmp, self.checkpointFile)
+
+    def _fileCheckpoint(self, fname, offset):
+        st = os.stat(fname)
+        return {'file':fname, 'inode':st.st_ino, 'offset':offset, 'mtime':st.st_mtime}
+
+    def files(self):
+        """
+        Return the db2diag log files, oldest first
+        """
+        if os.path.isdir(self.path):
+            directory = self.path
+            names = [n for n in os.listdir(directory) if DIAG_FILE_REC.match(n)]
+        else:
+            directory, base = os.path.split(self.path)
+            directory = directory or "."
+            rec = diagFileRec(base)
+            names = [n for n in os.listdir(directory) if rec.match(n)]
+        files = []
+        for n in names:
+            fname = os.path.join(directory, n)
+            try:
+                st = os.stat(fname)
+            except OSError:
+                continue
+            m = re.search("\\.(\\d+)\\.log$", n)
+            files.append((st.st_mtime, int(m.group(1)) if m else 0, fname))
+        return [x[2] for x in sorted(files)]
+
+    def _pending(self):
+        """
+        Return the files and start offsets to read after the checkpoint
+        """
+        files = self.files()
+        ckpt = self.checkpoint
+        if not ckpt:
+            return [(f, 0) for f in files]
+        for i, fname in enumerate(files):
+            st = os.stat(fname)
+            if st.st_ino == ckpt['inode']:
+                # truncated (or rewritten) files are read again
+                offset = ckpt['offset'] if st.st_size >= ckpt['offset'] else 0
+                return [(fname, offset)] + [(f, 0) for f in files[i + 1:]]
+        # the checkpoint file is gone, read the newer files
+        return [(f, 0) for f in files if os.stat(f).st_mtime >= ckpt['mtime']]
+
+    def _accept(self, text):
+        """
+        Apply the functions filter (the levels are filtered before the
+        record text is decoded)
+        """
+        if self.functions is not None:
+            m = re.search("^FUNCTION\\s*:(.*)$", text, re.MULTILINE)
+            function = m.group(1) if m else ""
+            return any(f in function for f in self.functions)
+        return True
+
+    def records(self):
+        """
+        Generate the new records (DiagRecord) matching the filters.
+        A record is committed (the checkpoint moves after it) when the
+        next one is asked for or by commit(), the checkpoint is saved at
+        the end (or when the generator is closed): a record whose
+        processing failed is read again by the next check.
+        The last record of the newest file is only returned once the next
+        one starts (it may still be written), the file is rotated or
+        idle for idleTimeout seconds, or the tailer is stopped.
+        """
+        pending = self._pending()
+        self.position = None
+        try:
+            for i, (fname, offset) in enumerate(pending):
+                last = i == len(pending) - 1
+                for rec, ckpt in self._fileRecords(fname, offset, not last):
+                    if rec is not None:
+                        self.position = ckpt
+                        yield rec
+                        self.position = None
+                    self.checkpoint = ckpt
+        finally:
+            self.saveCheckpoint()
+
+    def commit(self):
+        """
+        Commit the last record returned by records() and save the
+        checkpoint
+        """
+        if self.position is not None:
+            self.checkpoint = self.position
+            self.position = None
+        self.saveCheckpoint()
+
+    def stop(self):
+        """
+        Return the held-back last record of the newest file at the end
+        of the running (or next) records() generator
+        """
+        self.stopped = True
+
+    def _idle(self, fname):
+        if self.idleTimeout is None:
+            return False
+        try:
+            return time.time() - os.stat(fname).st_mtime >= self.idleTimeout
+        except OSError:
+            return True
+
+    def _fileRecords(self, fname, offset, complete):
+        """
+        Generate (record, checkpoint after the record) from offset, the
+        checkpoint is at the start of the next record. If complete is
+        False the last record is only returned when the tailer is
+        stopped or the file idle. None is generated for the records not
+        accepted by the filters (and for the end of the file).
+        """
+        try:
+            f = open(fname, "rb")
+        except IOError:
+            return
+        try:
+            f.seek(offset)
+            st = os.fstat(f.fileno())
+            ckpt = {'file':fname, 'inode':st.st_ino, 'offset':offset, 'mtime':st.st_mtime}
+            record = None
+            recordStart = offset
+            pos = offset
+            tail = b""
+            while True:
+                data = f.read(self.chunkSize)
+                if not data:
+                    break
+                lines = (tail + data).split(b"\n")
+                tail = lines.pop()
+                for line in lines:
+                    # the records start with the timestamp
+                    m = RECORD_START_REC.match(line) if line[:1].isdigit() else None
+                    if m:
+                        if record is not None:
+                            ckpt['offset'] = pos
+                            yield self._record(record, fname, recordStart), dict(ckpt)
+                        record = [m, line]
+                        recordStart = pos
+                    elif record is not None:
+                        record.append(line)
+                    else:
+                        # data before the first record
+                        ckpt['offset'] = pos + len(line) + 1
+                    pos += len(line) + 1
+            if record is not None and (complete or self.stopped or self._idle(fname)):
+                if tail:
+                    record.append(tail)
+                    pos += len(tail)
+                ckpt['offset'] = pos
+                yield self._record(record, fname, recordStart), dict(ckpt)
+            else:
+                # the end of the parsed records (start of a held-back one)
+                yield None, dict(ckpt)
+        finally:
+            f.close()
+
+    def _record(self, record, fname, offset):
+        m = record[0]
+        level = m.group(4).decode("ascii")
+        if self.levels is not None and not level.lower() in self.levels:
+            return None
+        text = b"\n".join(record[1:]).decode("utf-8", "replace").rstrip()
+        if not self._accept(text):
+            return None
+        return DiagRecord(
+            m.group(1).decode("ascii"),
+            m.group(2).decode("ascii") if m.group(2) else None,
+            m.group(3).decode("ascii"),
+            level,
+            text,
+            fname,
+            offset
+        )
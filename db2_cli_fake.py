@@ -0,0 +1,428 @@
+"""
+    @author: Romeo Lupascu
+    @contact: romeol@ca.ibm.com
+    @organization: IBM
+    @license: http://www.apache.org/licenses/LICENSE-2.0
+    @see: https://github.com/romeolibm/python_db2_cli_lib
+
+     A scriptable stand-in for the db2 (db2 -td@) and db2pd (db2pd
+     -interactive) command line processors, used to test and benchmark
+     db2_cli_lib without a db2 instance.
+
+     It prints the real prompts, fixed width result tables, SQLnnnnN
+     error messages, snapshot and db2pd section text:
+
+        python db2_cli_fake.py db2 -td@
+        python db2_cli_fake.py db2pd -interactive
+
+     installFakeCommands(directory) writes db2 and db2pd scripts running
+     this emulator, put the directory first in the PATH to have the
+     db2_cli_lib sessions use them.
+
+     The output is configured by environment variables:
+        DB2FAKE_ROWS            rows returned by a query (10)
+        DB2FAKE_COLUMNS         columns of a query result (3)
+        DB2FAKE_WIDTH           width of the text columns (32)
+        DB2FAKE_LATENCY         seconds to wait before each response (0)
+        DB2FAKE_APPLICATIONS    applications in the snapshots (10)
+     A query with a 'fetch first <n> rows' clause returns n rows and any
+     statement on a table named MISSING returns a SQL0204N error, the
+     text values of a table named UTF8 have multibyte characters.
+     An interrupt (SIGINT) cancels the running statement with a SQL0952N
+     error as the db2 clp does.
+"""
+import os, sys, re, time, locale
+
+ENV_DEFAULTS = {
+    'DB2FAKE_ROWS':'10',
+    'DB2FAKE_COLUMNS':'3',
+    'DB2FAKE_WIDTH':'32',
+    'DB2FAKE_LATENCY':'0',
+    'DB2FAKE_APPLICATIONS':'10'
+}
+
+def setting(name, convert=int):
+    return convert(os.environ.get(name, ENV_DEFAULTS[name]))
+
+class FakeCommandLineProcessor:
+    """
+    Read the requests on stdin and write the responses and the prompt
+    on stdout as the db2 command line processor does
+    """
+    PROMPT = "db2 => "
+    ROWS_REC = re.compile("fetch\s+first\s+(\d+)\s+rows?", re.IGNORECASE)
+    MISSING_REC = re.compile("\\bmissing\\b", re.IGNORECASE)
+    UTF8_REC = re.compile("\\butf8\\b", re.IGNORECASE)
+    # request prefix: handler method name
+    COMMANDS = (
+        ('connect reset', 'connectReset'),
+        ('connect to', 'connect'),
+        ('values mon_get_application_handle', 'applicationHandle'),
+        ('list database directory', 'databaseDirectory'),
+        ('get snapshot for applications', 'applicationsSnapshot'),
+        ('get snapshot for application', 'applicationSnapshot'),
+        ('describe', 'describe'),
+        ('export to', 'export'),
+        ('import from', 'importData'),
+        ('load from', 'importData'),
+        ('select', 'query'),
+        ('values', 'query'),
+        ('with', 'query')
+    )
+
+    def __init__(self, delimiter=None, out=None):
+        self.delimiter = delimiter
+        self.out = out if out else sys.stdout
+        self.rows = setting('DB2FAKE_ROWS')
+        self.columns = max(setting('DB2FAKE_COLUMNS'), 1)
+        self.width = setting('DB2FAKE_WIDTH')
+        self.latency = setting('DB2FAKE_LATENCY', float)
+        self.applications = setting('DB2FAKE_APPLICATIONS')
+        self.database = None
+
+    def write(self, text):
+        self.out.write(text)
+
+    def table(self, names, widths, rows):
+        """
+        Write a result set as the db2 clp does: the column names, the
+        ---- line, the fixed width rows (numbers right aligned) and
+        the count of records
+        """
+        write = self.out.write
+        write("\n" + " ".join(n.ljust(x) for n, x in zip(names, widths)).rstrip() + "\n")
+        write(" ".join("-" * x for x in widths) + "\n")
+        buf = []
+        for r in rows:
+            buf.append(" ".join(
+                str(c).rjust(x) if isinstance(c, int) else self.text(c, x) \
+                for c, x in zip(r, widths)
+            ) + "\n")
+            if len(buf) >= 1000:
+                write("".join(buf))
+                buf = []
+        write("".join(buf))
+        write("\n  {0} record(s) selected.\n\n".format(len(rows)))
+
+    def text(self, value, width):
+        """
+        Pad a text value to width bytes as the db2 clp does
+        """
+        if not isinstance(value, str):
+            # python 2 unicode
+            return value.encode("utf-8").ljust(width)[:width]
+        size = len(value.encode(locale.getpreferredencoding(False), "replace"))
+        return (value + " " * (width - size))[:width]
+
+    def run(self, infile=None):
+        infile = infile if infile else sys.stdin
+        self.write("(c) Copyright IBM Corporation 1993,2007\n"
+            "Command Line Processor for DB2 Client 11.1.0\n\n")
+        self.write(self.PROMPT)
+        self.out.flush()
+        buf = []
+        while True:
+            try:
+                line = infile.readline()
+            except KeyboardInterrupt:
+                continue
+            if not line:
+                break
+            buf.append(line)
+            text = "".join(buf).strip()
+            if self.delimiter and not text.endswith(self.delimiter):
+                continue
+            buf = []
+            if self.delimiter:
+                text = text[:-len(self.delimiter)].strip()
+            if text.lower() in ("quit", "terminate"):
+                break
+            try:
+                if self.latency:
+                    time.sleep(self.latency)
+                if text:
+                    self.execute(text)
+            except KeyboardInterrupt:
+                self.write("\nSQL0952N  Processing was cancelled due to an interrupt.  SQLSTATE=57014\n\n")
+            self.write(self.PROMPT)
+            self.out.flush()
+
+    def execute(self, stmt):
+        s = stmt.lower()
+        if FakeCommandLineProcessor.MISSING_REC.search(s) and not s.startswith("connect"):
+            self.write("SQL0204N  \"FAKE.MISSING\" is an undefined name.  SQLSTATE=42704\n\n")
+            return
+        for prefix, handler in FakeCommandLineProcessor.COMMANDS:
+            if s.startswith(prefix):
+                getattr(self, handler)(stmt)
+                return
+        self.write("DB20000I  The SQL command completed successfully.\n\n")
+
+    def rowCount(self, stmt):
+        m = FakeCommandLineProcessor.ROWS_REC.search(stmt)
+        return int(m.group(1)) if m else self.rows
+
+    def connect(self, stmt):
+        self.database = stmt.split()[-1].upper()
+        self.write("\n   Database Connection Information\n\n"
+            " Database server        = DB2/LINUXX8664 11.1.0\n"
+            " SQL authorization ID   = DB2INST1\n"
+            " Local database alias   = {0}\n\n".format(self.database))
+
+    def connectReset(self, stmt):
+        self.database = None
+        self.write("DB20000I  The SQL command completed successfully.\n\n")
+
+    def applicationHandle(self, stmt):
+        self.table(["1"], [20], [[7]])
+
+    def databaseDirectory(self, stmt):
+        self.write("\n System Database Directory\n\n"
+            " Number of entries in the directory = 2\n\n")
+        for i, alias in enumerate(["SAMPLE", "TESTDB"]):
+            self.write("Database {0} entry:\n\n"
+                " Database alias                       = {1}\n"
+                " Database name                        = {1}\n"
+                " Directory entry type                 = Indirect\n\n".format(i + 1, alias))
+
+    def snapshot(self, handle):
+        self.write("\n            Application Snapshot\n\n"
+            "Application handle                         = {0}\n"
+            "Application status                         = UOW Waiting\n"
+            "Status change time                         = Not Collected\n"
+            "Application code page                      = 1208\n\n"
+            "Workspace Information\n\n"
+            "Most recent operation                      = Static Commit\n"
+            "Rows read                                  = {1}\n\n"
+            "Memory usage for application:\n\n"
+            "  Memory Pool Type                         = Application Heap\n"
+            "     Current size (bytes)                  = 131072\n"
+            "     High water mark (bytes)               = 196608\n\n"
+            "Agent process/thread ID                    = {2}\n"
+            "  Agent Lock timeout (seconds)             = -1\n"
+            "  Memory usage for agent:\n\n"
+            "    Memory Pool Type                       = Other Memory\n"
+            "       Current size (bytes)                = 65536\n\n".format(
+                handle, handle * 100, 1000 + handle
+            ))
+
+    def applicationSnapshot(self, stmt):
+        self.snapshot(int(stmt.split()[-1]))
+
+    def applicationsSnapshot(self, stmt):
+        for handle in range(1, self.applications + 1):
+            self.snapshot(handle)
+
+    def columnNames(self):
+        return ["ID"] + ["COL{0}".format(i) for i in range(1, self.columns)]
+
+    def query(self, stmt):
+        n = self.rowCount(stmt)
+        widths = [11] + [self.width] * (self.columns - 1)
+        if "CHR(31)" in stmt:
+            # one column of CHR(31) separated values (see queryDelimited)
+            self.table(["1"], [sum(widths) + self.columns], [
+                ["{0}\x1f".format(i) + "".join(
+                    "value{0}_{1}\x1f".format(c, i) for c in range(1, self.columns)
+                )] for i in range(n)
+            ])
+            return
+        value = u"v\u00e4lue{0}_{1}" if FakeCommandLineProcessor.UTF8_REC.search(stmt) else "value{0}_{1}"
+        self.table(self.columnNames(), widths, [
+            [i] + [value.format(c, i) for c in range(1, self.columns)] \
+            for i in range(n)
+        ])
+
+    def describe(self, stmt):
+        names = self.columnNames()
+        self.write("\n Column Information\n\n Number of columns: {0}\n\n".format(len(names)))
+        self.write(" SQL type              Type length  Column name                     Name length\n")
+        self.write(" --------------------  -----------  ------------------------------  -----------\n")
+        self.write(" 497   INTEGER                    4  ID                                        2\n")
+        for n in names[1:]:
+            self.write(" 449   VARCHAR           {0:>10}  {1:<30}  {2:>11}\n".format(
+                self.width, n, len(n)
+            ))
+        self.write("\n")
+
+    def export(self, stmt):
+        fname = stmt.split()[2]
+        n = self.rowCount(stmt)
+        self.write("SQL3104N  The Export utility is beginning to export data to file \n"
+            "\"{0}\".\n\n".format(fname))
+        f = open(fname, "w")
+        try:
+            buf = []
+            for i in range(n):
+                buf.append(",".join(
+                    [str(i)] + ['"value{0}_{1}"'.format(c, i) for c in range(1, self.columns)]
+                ) + "\n")
+                if len(buf) >= 1000:
+                    f.write("".join(buf))
+                    buf = []
+            f.write("".join(buf))
+        finally:
+            f.close()
+        self.write("SQL3105N  The Export utility has finished exporting \"{0}\" rows.\n\n\n"
+            "Number of rows exported: {0}\n\n".format(n))
+
+    def importData(self, stmt):
+        fname = stmt.split()[2]
+        n = 0
+        f = open(fname)
+        try:
+            for line in f:
+                n += 1
+        finally:
+            f.close()
+        self.write("SQL3109N  The utility is beginning to load data from file \"{0}\".\n\n"
+            "SQL3110N  The utility has completed processing.  \"{1}\" rows were read from the\n"
+            "input file.\n\n"
+            "\nNumber of rows read         = {1}\n"
+            "Number of rows skipped      = 0\n"
+            "Number of rows inserted     = {1}\n"
+            "Number of rows updated      = 0\n"
+            "Number of rows rejected     = 0\n"
+            "Number of rows committed    = {1}\n\n".format(fname, n))
+
+class FakeDB2pd:
+    """
+    Read the db2pd options on stdin and write the matching sections
+    and the prompt on stdout as db2pd -interactive does
+    """
+    PROMPT = "db2pd> "
+
+    def __init__(self, out=None):
+        self.out = out if out else sys.stdout
+        self.rows = setting('DB2FAKE_ROWS')
+        self.latency = setting('DB2FAKE_LATENCY', float)
+        self.sections = {
+            '-latches':self.latches,
+            '-locks':self.locks,
+            '-bufferpools':self.bufferpools,
+            '-transactions':self.transactions,
+            '-mempools':self.mempools
+        }
+
+    def write(self, text):
+        self.out.write(text)
+
+    def run(self, infile=None):
+        infile = infile if infile else sys.stdin
+        self.write(self.PROMPT)
+        self.out.flush()
+        while True:
+            line = infile.readline()
+            if not line:
+                break
+            options = line.split()
+            if options and options[0] in ("quit", "q"):
+                break
+            if self.latency:
+                time.sleep(self.latency)
+            if options:
+                self.execute(options)
+            self.write("\n" + self.PROMPT)
+            self.out.flush()
+
+    def execute(self, options):
+        unknown = [o for o in options if o.startswith("-") and \
+            not o in self.sections and not o in ("-db", "-alldbs")]
+        if unknown or not options[0].startswith("-"):
+            self.write("Invalid command {0}\n".format(" ".join(options)))
+            return
+        database = options[options.index("-db") + 1] if "-db" in options else None
+        self.write("\nDatabase Member 0 -- {0}Active -- Up 0 days 00:01:00 -- "
+            "Date 2020-06-22-10.00.00.000000\n".format(
+                "Database {0} -- ".format(database.upper()) if database else ""
+            ))
+        for o in options:
+            if o in self.sections:
+                self.sections[o]()
+
+    def latches(self):
+        self.write("\nLatches:\nAddress            Holder     Waiter     Filename             "
+            "LOC        LatchType            HoldCount \n")
+        self.write("".join(
+            "0x00007F0B1A2C{0:04X} {1:<10} 0          ../sqle_workload_disp.C 1391       "
+            "SQLO_LT_sqeWLDispatcher__m_tunerLatch 1 \n".format(i % 65536, 10000 + i) \
+            for i in range(self.rows)
+        ))
+
+    def locks(self):
+        self.write("\nLocks:\nAddress            TranHdl    Lockname                   Type"
+            "           Mode Sts Owner      Dur HoldCount  Att        ReleaseFlg rrIID \n")
+        self.write("".join(
+            "0x00007F0B1A2C{0:04X} 3          02000400000000000000000052 TableLock      "
+            ".IN  G   3          1   0          0x00000000 0x40000000 0     \n".format(i % 65536) \
+            for i in range(self.rows)
+        ))
+
+    def bufferpools(self):
+        self.write("\nBufferpools:\nFirst Active Pool ID      1\nMax Bufferpool ID         1\n"
+            "Num Bufferpools           5\n\n")
+        self.write("Address            Id   Name               PageSz     PA-NumPgs  BA-NumPgs"
+            "  BlkSize    NumTbsp    PgsToRemov CurrentSz  PostAlter  SuspndTSCt Automatic\n")
+        self.write("0x00007F0B1A2C0000 1    IBMDEFAULTBP       4096       1000       0          "
+            "0          3          0          1000       1000       0          True\n")
+
+    def transactions(self):
+        self.write("\nTransactions:\nAddress            AppHandl [nod-index] TranHdl    Locks      "
+            "State   Tflag      Tflag2     Firstlsn           Lastlsn            LogSpace"
+            "             ClientUserID   ClientApplName\n")
+        self.write("".join(
+            "0x00007F0B1A2C{0:04X} {1:<8} [000-{1:05d}] 3          4          READ    0x00000000 "
+            "0x00000000 0x0000000000000000 0x0000000000000000 0                    db2inst1       "
+            "db2bp\n".format(i % 65536, i + 7) \
+            for i in range(self.rows)
+        ))
+        self.write("\nTotal application commits   : 30\nTotal application rollbacks : 2\n")
+
+    def mempools(self):
+        self.write("\nMemory Pools:\nAddress            MemSet   PoolName   Id    SecondId Overhead"
+            "   LogSz       LogHWM      PhySz       PhyHWM      CfgSize     Bnd BlkCnt CfgParm   \n")
+        self.write("".join(
+            "0x00007F0B1A2C{0:04X} DBMS     fcm        74    0        0          {1:<11} 0"
+            "           0           0           0           Ovf 0      n/a       \n".format(
+                i % 65536, i * 100
+            ) for i in range(self.rows)
+        ))
+
+def installFakeCommands(directory):
+    """
+    Write db2 and db2pd executable scripts running this emulator
+    with the current python interpreter in directory
+    """
+    script = os.path.abspath(__file__)
+    if script.endswith((".pyc", ".pyo")):
+        script = script[:-1]
+    for cmd in ("db2", "db2pd"):
+        fname = os.path.join(directory, cmd)
+        f = open(fname, "w")
+        try:
+            f.write('#!/bin/sh\nexec "{0}" "{1}" {2} "$@"\n'.format(sys.executable, script, cmd))
+        finally:
+            f.close()
+        os.chmod(fname, 0o755)
+    return directory
+
+def main(args):
+    if not args or not args[0] in ("db2", "db2pd"):
+        sys.stderr.write("usage: db2_cli_fake.py db2 [-td<delimiter>] | db2pd [-interactive]\n")
+        return 1
+    if args[0] == "db2pd":
+        if len(args) > 1 and args[1] != "-interactive":
+            # single shot db2pd calls (e.g. db2pd -diagpath)
+            sys.stdout.write("/home/db2inst1/sqllib/db2dump/\n" if "-diagpath" in args else "\n")
+            return 0
+        FakeDB2pd().run()
+        return 0
+    delimiter = None
+    for a in args[1:]:
+        if a.startswith("-td"):
+            delimiter = a[3:]
+    FakeCommandLineProcessor(delimiter).run()
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -17,9 +17,41 @@
      from the db2 cli interface. 
  
 """
-import os, sys, subprocess, threading, re, StringIO, time, traceback
+import os, sys, subprocess, threading, re, time, traceback, contextlib, signal
+import codecs, locale, itertools, tempfile, shutil, datetime, numbers, decimal, array
+import collections, mmap
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
+try:
+    import StringIO
+except ImportError:
+    import io as StringIO
+try:
+    import Queue
+except ImportError:
+    import queue as Queue
+try:
+    import numpy
+except ImportError:
+    numpy = None
+try:
+    import selectors
+except ImportError:
+    try:
+        import selectors34 as selectors
+    except ImportError:
+        selectors = None
+try:
+    from collections.abc import Mapping
+except ImportError:
+    from collections import Mapping
 import logging
 LGR = logging.getLogger("main")
+PY3 = sys.version_info[0] > 2
+if PY3:
+    StandardError = Exception
 LOG_LEVELS = {
     'debug': logging.DEBUG,
     'info': logging.INFO,
@@ -49,10 +81,634 @@ def configLogging(file=None, level=None):
         LGR.addHandler(handler)
     LGR.debug("Start logging pid:{0}".format(os.getpid()))
 
+def _dateTimeText(value):
+    """
+    Format date, time and timestamp values the way db2 expects them 
+    """
+    if isinstance(value, datetime.datetime):
+        return value.strftime("%Y-%m-%d-%H.%M.%S.") + "%06d" % value.microsecond
+    if isinstance(value, datetime.date):
+        return value.strftime("%Y-%m-%d")
+    return value.strftime("%H.%M.%S")
+
+def sqlLiteral(value):
+    """
+    Return the SQL literal for a python value (None is NULL)
+    """
+    if value is None:
+        return "NULL"
+    if isinstance(value, bool):
+        return "1" if value else "0"
+    if isinstance(value, numbers.Number):
+        return repr(value) if isinstance(value, float) else str(value)
+    if isinstance(value, (datetime.date, datetime.time)):
+        return "'" + _dateTimeText(value) + "'"
+    if PY3 and isinstance(value, bytes):
+        return "X'" + codecs.encode(value, 'hex').decode('ascii').upper() + "'"
+    return "'" + str(value).replace("'", "''") + "'"
+
+def delField(value):
+    """
+    Return the DEL (db2 delimited ASCII) field for a python value
+    (None is an empty field)
+    """
+    if value is None:
+        return ""
+    if isinstance(value, bool):
+        return "1" if value else "0"
+    if isinstance(value, numbers.Number):
+        return repr(value) if isinstance(value, float) else str(value)
+    if isinstance(value, (datetime.date, datetime.time)):
+        return _dateTimeText(value)
+    return '"' + str(value).replace('"', '""') + '"'
+
+def parseDelLine(line, delimiter=",", quote='"'):
+    """
+    Split a DEL record into its fields, quoted fields are returned 
+    unquoted and empty (not quoted) fields are returned as None (NULL)
+    """
+    if not quote in line:
+        return [x if x else None for x in line.split(delimiter)]
+    fields = []
+    pos = 0
+    size = len(line)
+    while True:
+        if pos < size and line[pos] == quote:
+            parts = []
+            spos = pos + 1
+            while True:
+                qpos = line.find(quote, spos)
+                if qpos < 0:
+                    parts.append(line[spos:])
+                    pos = size
+                    break
+                if line[qpos + 1:qpos + 2] == quote:
+                    parts.append(line[spos:qpos + 1])
+                    spos = qpos + 2
+                    continue
+                parts.append(line[spos:qpos])
+                pos = line.find(delimiter, qpos + 1)
+                if pos < 0:
+                    pos = size
+                break
+            fields.append("".join(parts))
+        else:
+            epos = line.find(delimiter, pos)
+            if epos < 0:
+                epos = size
+            fields.append(line[pos:epos] if epos > pos else None)
+            pos = epos
+        if pos >= size:
+            return fields
+        pos += 1
+        if pos == size:
+            fields.append(None)
+            return fields
+
+# python converters for the values of the DEL (or displayed) columns 
+# by db2 column type name, the other types are kept as strings
+DB2_TYPE_CONVERTERS = {
+    'SMALLINT': int,
+    'INTEGER': int,
+    'BIGINT': int,
+    'DECIMAL': decimal.Decimal,
+    'NUMERIC': decimal.Decimal,
+    'DECFLOAT': decimal.Decimal,
+    'REAL': float,
+    'DOUBLE': float,
+    'FLOAT': float
+}
+
+def _displayDate(value):
+    """
+    Parse a date displayed by db2 (ISO/JIS yyyy-mm-dd, USA mm/dd/yyyy,
+    EUR dd.mm.yyyy)
+    """
+    if "/" in value:
+        m, d, y = value.split("/")
+    elif "." in value:
+        d, m, y = value.split(".")
+    else:
+        y, m, d = value.split("-")
+    return datetime.date(int(y), int(m), int(d))
+
+def _displayTime(value):
+    """
+    Parse a time displayed by db2 (hh.mm.ss, hh:mm:ss, USA hh:mm AM)
+    """
+    hourOffset = None
+    if value[-2:] in ("AM", "PM"):
+        hourOffset = 12 if value[-2:] == "PM" else 0
+        value = value[:-2].strip()
+    parts = value.replace(":", ".").split(".")
+    hour = int(parts[0])
+    if hourOffset is not None:
+        hour = hour % 12 + hourOffset
+    return datetime.time(hour, int(parts[1]), int(parts[2]) if len(parts) > 2 else 0)
+
+def _displayTimestamp(value):
+    """
+    Parse a timestamp displayed by db2 (yyyy-mm-dd-hh.mm.ss.ffffff)
+    """
+    parts = value[11:].split(".")
+    fraction = parts[3] if len(parts) > 3 else ""
+    return datetime.datetime(
+        int(value[0:4]), int(value[5:7]), int(value[8:10]),
+        int(parts[0]), int(parts[1]), int(parts[2]),
+        int((fraction + "000000")[:6])
+    )
+
+# python converters for the values displayed by the db2 clp by
+# column type name, the other types are kept as strings
+DB2_DISPLAY_CONVERTERS = dict(DB2_TYPE_CONVERTERS)
+DB2_DISPLAY_CONVERTERS.update({
+    'DATE': _displayDate,
+    'TIME': _displayTime,
+    'TIMESTAMP': _displayTimestamp
+})
+
+class DisplayRowDecoder:
+    """
+    Convert the text values of the rows returned by query() to python
+    values according to the describe of the query: numbers, dates, 
+    times and timestamps are converted and the NULLs ("-" in the 
+    nullable columns) are None. The rows are converted column by 
+    column, a column with an unexpected value is kept as text.
+    """
+    NULL = "-"
+    
+    def __init__(self, columns):
+        self.columns = columns
+        self.names = [c['name'] for c in columns]
+        # (index, converter, nullable) of the columns to convert
+        self.decoders = []
+        for i, c in enumerate(columns):
+            converter = DB2_DISPLAY_CONVERTERS.get(c['type'])
+            if converter is not None or c['nullable']:
+                self.decoders.append((i, converter, c['nullable']))
+    
+    def _decodeColumn(self, converter, nullable, values, null):
+        try:
+            if null is None:
+                # the NULLs are already None
+                if converter is None:
+                    return None
+                return [None if v is None else converter(v) for v in values]
+            if converter is None:
+                return [None if v == null else v for v in values]
+            if nullable:
+                return [None if v == null else converter(v) for v in values]
+            return [converter(v) for v in values]
+        except (ValueError, ArithmeticError, IndexError) as e:
+            LGR.debug("decode-err:{0}".format(e))
+            return None
+    
+    def decodeRows(self, rows, null=NULL):
+        """
+        Return the converted rows (new lists, rows is not modified),
+        null is the NULL marker of the values (None if the NULLs 
+        are None already)
+        """
+        if not rows:
+            return []
+        if len(rows[0]) != len(self.columns):
+            return rows
+        columns = list(zip(*rows))
+        for i, converter, nullable in self.decoders:
+            values = self._decodeColumn(converter, nullable, columns[i], null)
+            if values is not None:
+                columns[i] = values
+        return [list(row) for row in zip(*columns)]
+    
+    def decodeRow(self, row, null=NULL):
+        return self.decodeRows([row], null)[0]
+    
+    def writer(self, rowWriter, null=NULL):
+        """
+        Return a row writer converting the rows written to rowWriter
+        """
+        return _DecodingRowWriter(self, rowWriter, null)
+    
+    def result(self, rs, null=NULL):
+        """
+        Return a copy of a query result with the converted rows, the
+        described column names and the column descriptions ('columns')
+        """
+        if not isinstance(rs, dict) or not 'rows' in rs:
+            return rs
+        if len(rs.get('sizes', self.columns)) != len(self.columns):
+            LGR.debug("decode-columns-mismatch:{0}".format(self.names))
+            return rs
+        rs = dict(rs)
+        rs['names'] = self.names
+        rs['columns'] = self.columns
+        if isinstance(rs['rows'], list):
+            rs['rows'] = self.decodeRows(rs['rows'], null)
+        return rs
+
+class _DecodingRowWriter:
+    def __init__(self, decoder, rowWriter, null):
+        self.decoder = decoder
+        self.rowWriter = rowWriter
+        self.null = null
+    
+    def writerow(self, row):
+        self.rowWriter.writerow(self.decoder.decodeRow(row, self.null))
+
+class _CompactColumn:
+    """
+    The values of a CompactRows column: the distinct values and an array
+    of value codes (dictionary encoding) or, for a column with mostly
+    distinct values, a plain list
+    """
+    __slots__ = ('values', 'index', 'codes', 'plain')
+    
+    def __init__(self):
+        self.values = []
+        self.index = {}
+        self.codes = array.array('H')
+        self.plain = None
+    
+    def append(self, value):
+        if self.plain is not None:
+            self.plain.append(value)
+            return
+        code = self.index.get(value)
+        if code is None:
+            code = len(self.values)
+            if code > 1024 and code * 2 > len(self.codes):
+                # mostly distinct values, the dictionary does not pay off
+                self.plain = [self.values[c] for c in self.codes]
+                self.plain.append(value)
+                self.values = self.index = self.codes = None
+                return
+            if code == 65536:
+                self.codes = array.array('I', self.codes)
+            self.values.append(value)
+            self.index[value] = code
+        self.codes.append(code)
+    
+    def get(self, i):
+        if self.plain is not None:
+            return self.plain[i]
+        return self.values[self.codes[i]]
+    
+    def tolist(self):
+        if self.plain is not None:
+            return list(self.plain)
+        values = self.values
+        return [values[c] for c in self.codes]
+
+class CompactRows:
+    """
+    A compact list of rows for the long lived (monitoring) results: the
+    values are stored by column and each distinct value of a column is
+    stored once with a 2 (or 4) bytes code per row (dictionary encoding).
+    Can be used as the rowReader (or the rowWriter) of query():
+    
+        rows = db.query("select * from table(mon_get_connection(null, -1))",
+            rowReader=CompactRows())['rows']
+        rows[0][1], len(rows), rows.column(1)
+    
+    The rows are returned as new lists, they can not be modified.
+    """
+    def __init__(self, rows=None):
+        self.columns = None
+        self.count = 0
+        if rows is not None:
+            self.extend(rows)
+    
+    def append(self, row):
+        if self.columns is None:
+            self.columns = [_CompactColumn() for v in row]
+        for column, value in zip(self.columns, row):
+            column.append(value)
+        self.count += 1
+    
+    # rowWriter interface (e.g. with query(typed=True))
+    writerow = append
+    
+    def extend(self, rows):
+        for row in rows:
+            self.append(row)
+    
+    def __len__(self):
+        return self.count
+    
+    def row(self, i):
+        if i < 0:
+            i += self.count
+        if i < 0 or i >= self.count:
+            raise IndexError("row index out of range")
+        return [column.get(i) for column in self.columns]
+    
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self.row(x) for x in range(*i.indices(self.count))]
+        return self.row(i)
+    
+    def __iter__(self):
+        if not self.count:
+            return iter(())
+        return (list(row) for row in zip(*[c.tolist() for c in self.columns]))
+    
+    def column(self, i):
+        """
+        Return the values of a column
+        """
+        return self.columns[i].tolist() if self.columns else []
+    
+    def tolist(self):
+        return list(self)
+
+# array type of the file offsets ('Q' is not available in python 2)
+try:
+    array.array('Q')
+    OFFSET_TYPECODE = 'Q'
+except ValueError:
+    OFFSET_TYPECODE = 'L'
+
+class SpillingRows:
+    """
+    A list of rows kept in memory up to maxBytes (estimated size) then
+    spilled to a temporary file (in directory, the default temporary 
+    directory if None): the rows are pickled one after the other, their
+    offsets are kept in an array and the file is read through mmap.
+    Can be used as the rowReader (or the rowWriter) of query():
+    
+        with SpillingRows(maxBytes=256 * 1024 * 1024) as rows:
+            db.query("select * from big_table", rowReader=rows)
+            print(len(rows), rows[123456], rows[-10:])
+            for row in rows:
+                ...
+    
+    The temporary file is removed by close(). The rows returned from
+    the file are copies, modifying them does not change the store.
+    An iteration returns the rows stored when it started, rows can be
+    appended while iterating (they are not returned by that iteration).
+    """
+    def __init__(self, maxBytes=64 * 1024 * 1024, directory=None, flushBytes=1048576):
+        self.maxBytes = maxBytes
+        self.directory = directory
+        self.flushBytes = flushBytes
+        self.rows = []
+        self.bytes = 0
+        self.file = None
+        self.offsets = None
+        # bytes written to the file (including the pending ones)
+        self.size = 0
+        self.pending = []
+        self.pendingBytes = 0
+        self.map = None
+        self.mapSize = 0
+    
+    @property
+    def spilled(self):
+        return self.file is not None
+    
+    def append(self, row):
+        if self.file is None:
+            self.rows.append(row)
+            self.bytes += _resultSize(row)
+            if self.bytes > self.maxBytes:
+                self._spill()
+            return
+        data = pickle.dumps(row, 2)
+        self.offsets.append(self.size)
+        self.size += len(data)
+        self.pending.append(data)
+        self.pendingBytes += len(data)
+        if self.pendingBytes >= self.flushBytes:
+            self._flush()
+    
+    # rowWriter interface (e.g. with query(typed=True))
+    writerow = append
+    
+    def extend(self, rows):
+        for row in rows:
+            self.append(row)
+    
+    def _spill(self):
+        """
+        Move the rows kept in memory to the temporary file
+        """
+        LGR.debug("spill-rows:{0}:{1}".format(len(self.rows), self.bytes))
+        self.file = tempfile.TemporaryFile(prefix="db2rows", dir=self.directory)
+        self.offsets = array.array(OFFSET_TYPECODE)
+        rows = self.rows
+        self.rows = None
+        self.bytes = 0
+        for row in rows:
+            self.append(row)
+    
+    def _flush(self):
+        if self.pending:
+            self.file.write(b"".join(self.pending))
+            self.file.flush()
+            self.pending = []
+            self.pendingBytes = 0
+    
+    def _mapped(self):
+        """
+        Return the mmap of the file, mapped again if the file grew
+        """
+        self._flush()
+        if self.mapSize != self.size:
+            if self.map is not None:
+                self.map.close()
+            self.map = mmap.mmap(self.file.fileno(), self.size, access=mmap.ACCESS_READ)
+            self.mapSize = self.size
+        return self.map
+    
+    def __len__(self):
+        return len(self.rows) if self.file is None else len(self.offsets)
+    
+    def row(self, i):
+        if self.file is None:
+            return self.rows[i]
+        count = len(self.offsets)
+        if i < 0:
+            i += count
+        if i < 0 or i >= count:
+            raise IndexError("row index out of range")
+        end = self.offsets[i + 1] if i + 1 < count else self.size
+        return pickle.loads(self._mapped()[self.offsets[i]:end])
+    
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            if self.file is None:
+                return self.rows[i]
+            return [self.row(x) for x in range(*i.indices(len(self.offsets)))]
+        return self.row(i)
+    
+    def __iter__(self):
+        if self.file is None:
+            return iter(self.rows)
+        return self._iterFile()
+    
+    def _iterFile(self):
+        data = self._mapped()
+        offsets = self.offsets
+        count = len(offsets)
+        size = self.mapSize
+        loads = pickle.loads
+        for i in range(count):
+            if self.map is not data:
+                # the file grew and was mapped again (the old map is closed)
+                if self.file is None:
+                    raise ValueError("SpillingRows closed while iterating")
+                data = self._mapped()
+            end = offsets[i + 1] if i + 1 < count else size
+            yield loads(data[offsets[i]:end])
+    
+    def close(self):
+        if self.map is not None:
+            self.map.close()
+            self.map = None
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+        self.rows = []
+        self.offsets = None
+        self.pending = []
+        self.size = self.mapSize = self.bytes = 0
+    
+    def __enter__(self):
+        return self
+    
+    def __exit__(self, *args):
+        self.close()
+
+class CompactMapping:
+    """
+    A read only mapping sharing its keys (a key schema) with the other
+    mappings of the same keys, only the values are stored per mapping.
+    Built by a MappingCompactor.
+    """
+    __slots__ = ('schema', 'data')
+    
+    def __init__(self, schema, values):
+        # schema: (keys tuple, key -> position)
+        self.schema = schema
+        self.data = values
+    
+    def __getitem__(self, key):
+        return self.data[self.schema[1][key]]
+    
+    def get(self, key, default=None):
+        pos = self.schema[1].get(key)
+        return default if pos is None else self.data[pos]
+    
+    def __contains__(self, key):
+        return key in self.schema[1]
+    
+    def __iter__(self):
+        return iter(self.schema[0])
+    
+    def __len__(self):
+        return len(self.data)
+    
+    def keys(self):
+        return list(self.schema[0])
+    
+    def values(self):
+        return list(self.data)
+    
+    def items(self):
+        return list(zip(self.schema[0], self.data))
+    
+    def __eq__(self, other):
+        return dict(self.items()) == (dict(other.items()) if isinstance(other, Mapping) else other)
+    
+    def __ne__(self, other):
+        return not self == other
+    
+    def __repr__(self):
+        return repr(dict(self.items()))
+
+Mapping.register(CompactMapping)
+
+class MappingCompactor:
+    """
+    Convert maps (e.g. the application snapshots) to CompactMapping
+    objects: the maps with the same keys share one key schema and the 
+    equal values are stored once. Up to maxSchemas schemas and maxValues
+    values are remembered, the tables are cleared when full so a 
+    compactor can be used for ever by a collector.
+    """
+    def __init__(self, maxSchemas=1024, maxValues=65536):
+        self.maxSchemas = maxSchemas
+        self.maxValues = maxValues
+        self.schemas = {}
+        self.values = {}
+    
+    def compact(self, mapping):
+        keys = tuple(mapping)
+        schema = self.schemas.get(keys)
+        if schema is None:
+            if len(self.schemas) >= self.maxSchemas:
+                self.schemas = {}
+            schema = (keys, dict((k, i) for i, k in enumerate(keys)))
+            self.schemas[keys] = schema
+        values = self.values
+        if len(values) >= self.maxValues:
+            values = self.values = {}
+        shared = []
+        for k in keys:
+            v = mapping[k]
+            shared.append(values.setdefault(v, v))
+        return CompactMapping(schema, shared)
+
+DB2PD_NUMBER_REC = re.compile("^-?\d+$")
+DB2PD_HEX_REC = re.compile("^0x[0-9A-Fa-f]+$")
+
+def _hexInt(value):
+    return int(value, 16)
+
+def db2pdValue(value):
+    """
+    Convert a db2pd column value, decimal and 0x hex numbers (addresses,
+    flags, lsn) are returned as int, the rest as text
+    """
+    c = value[0]
+    if not (c.isdigit() or c == '-'):
+        return value
+    if DB2PD_NUMBER_REC.match(value):
+        return int(value)
+    if DB2PD_HEX_REC.match(value):
+        return int(value, 16)
+    return value
+
+_DISCOVERY = []
+
+def processDiscovery():
+    """
+    Return the shared DB2ProcessDiscovery (db2_cli_proc) if /proc can be
+    read on this system, None otherwise (the ps command is used then)
+    """
+    if not _DISCOVERY:
+        try:
+            import db2_cli_proc
+            discovery = db2_cli_proc.DB2ProcessDiscovery()
+            _DISCOVERY.append(discovery if discovery.available() else None)
+        except ImportError:
+            _DISCOVERY.append(None)
+    return _DISCOVERY[0]
+
+def _firstProcess(name):
+    processes = processDiscovery().processes(name)
+    return processes[0] if processes else None
+
 def getuserid(user_name):
     """
-    Use 'id -u <user-name>' to get the user number (id) from a user name
+    Get the user number (id) from a user name 
+    (using 'id -u <user-name>' if the pwd module is not available)
     """
+    try:
+        import pwd
+        return str(pwd.getpwnam(user_name).pw_uid)
+    except ImportError:
+        pass
     return subprocess.Popen(
         ["id", "-u", user_name],
         stdout=subprocess.PIPE
@@ -60,7 +716,11 @@ def getuserid(user_name):
 
 def get_db2sysc_user():
     """
+    Return the owner of the (first) db2 engine process, None if not running
     """
+    if processDiscovery():
+        p = _firstProcess('db2sysc')
+        return p.user if p else None
     return subprocess.Popen(
         ["ps", "-o", "user", "-C", "db2sysc"],
         stdout=subprocess.PIPE
@@ -68,17 +728,24 @@ def get_db2sysc_user():
 
 def get_db2fmp_user():
     """
+    Return the owner of the (first) db2 fenced process, None if not running
     """
+    if processDiscovery():
+        p = _firstProcess('db2fmp')
+        return p.user if p else None
     return subprocess.Popen(
         ["ps", "-o", "user", "-C", "db2fmp"],
         stdout=subprocess.PIPE
     ).communicate()[0].strip().splitlines()[1].strip()
     
 
-def get_db2diag_path():
+def get_db2diag_path(instance=None):
     """
-    Retrieve the current env db2 diagpath by using db2pd -diagpath
+    Retrieve the db2 diagpath of an instance (the current env one by 
+    default) by using db2pd -diagpath, resolved once per instance
     """
+    if processDiscovery():
+        return processDiscovery().diagPath(instance)
     return subprocess.Popen(
         ["db2pd", "-diagpath"],
         stdout=subprocess.PIPE
@@ -87,13 +754,104 @@ def get_db2diag_path():
 def get_db2sysc_pid():
     """
     Find the current PID for the DB2 engine process.
-    ps -o pid -C db2sysc
+    The processes found in /proc are cached (see db2_cli_proc), 
+    ps -o pid -C db2sysc is used if /proc is not available.
     """
+    if processDiscovery():
+        p = _firstProcess('db2sysc')
+        return str(p.pid) if p else None
     return subprocess.Popen(
         ["ps", "-o", "pid", "-C", "db2sysc"],
         stdout=subprocess.PIPE
     ).communicate()[0].strip().splitlines()[1].strip()
 
+class TextLineSplitter:
+    """
+    Split the chunks of text read from a stream into lines.
+    Every complete line is passed to the linehandler and the unterminated
+    tail to the inflightLineHandler that can consume it (e.g. a prompt)
+    by returning True.
+    Binary chunks (python 3 pipes) are decoded using the encoding
+    (the preferred locale encoding by default).
+    If the prompt text is known, complete lines starting with it 
+    (the child process read the next request before this line 
+    was processed) are split in the prompt and the rest of the line.
+    """
+    def __init__(self,
+            linehandler=None,
+            inflightLineHandler=None,
+            ignorablechars="\r",
+            eol="\n",
+            encoding=None,
+            prompt=None
+        ):
+        self.linehandler = linehandler
+        self.inflightLineHandler = inflightLineHandler
+        self.ignorablechars = ignorablechars
+        self.eol = eol
+        self.encoding = encoding
+        self.prompt = prompt
+        self.decoder = None
+        self.tail = ""
+        
+    def handleLine(self, line):
+        if self.linehandler:
+            try:
+                self.linehandler(line)
+            except Exception as e:
+                LGR.debug("<>{0}".format(line))
+                LGR.debug("lh-err:{0}".format(traceback.format_exc()))
+                
+    def handleInflightLine(self, s):
+        """
+        Return True if the inflight line handler consumed the line s
+        (e.g. a prompt was detected) and the line buffer must be reset.
+        """
+        try:
+            if self.inflightLineHandler and self.inflightLineHandler(s):
+                LGR.debug(">>>%s", s)
+                return True
+        except Exception as e:
+            LGR.debug("<<>{0}".format(s))
+            LGR.debug("plh-err:{0}".format(traceback.format_exc()))
+        return False
+    
+    def decode(self, data):
+        if isinstance(data, str):
+            return data
+        if self.decoder is None:
+            self.decoder = codecs.getincrementaldecoder(
+                self.encoding or locale.getpreferredencoding(False)
+            )("replace")
+        return self.decoder.decode(data)
+    
+    def feed(self, data):
+        """
+        Process a chunk of data, dispatch the complete lines and check
+        the unterminated tail. Return the data without the ignorable chars.
+        """
+        data = self.decode(data)
+        for c in self.ignorablechars:
+            if c in data:
+                data = data.replace(c, "")
+        if not data:
+            return data
+        
+        lines = data.split(self.eol)
+        if len(lines) > 1:
+            lines[0] = self.tail + lines[0]
+            self.tail = lines.pop()
+            prompt = self.prompt
+            for line in lines:
+                if prompt and line.startswith(prompt) and self.handleInflightLine(prompt):
+                    line = line[len(prompt):]
+                self.handleLine(line)
+        else:
+            self.tail = self.tail + data
+        if self.tail and self.handleInflightLine(self.tail):
+            self.tail = ""
+        return data
+    
 class TextIOProcessor(threading.Thread):
     """
     Read data from an input stream infile one char at the time.
@@ -103,6 +861,12 @@ class TextIOProcessor(threading.Thread):
     line buffer it will be called.
     The time of last read is recorded and available for
     future analysis.
+    If a chunkSize is provided the input is read in chunks of up to
+    chunkSize bytes (whatever is available on the pipe), the complete
+    lines are dispatched in bulk and the inflight line handler is only
+    called on the unterminated tail of the data read so far.
+    If a reactor (TextIOReactor) is provided no thread is started, 
+    start() registers the input with the reactor reading it in chunks.
     """
     
     def __init__(self,
@@ -110,11 +874,14 @@ class TextIOProcessor(threading.Thread):
             outfile=None,
             linehandler=None,
             inflightLineHandler=None,
-            name=None
+            name=None,
+            chunkSize=None,
+            prompt=None,
+            reactor=None
         ):
         threading.Thread.__init__(self)
-        self.setName(name if name else "iosubprocessor")
-        self.setDaemon(True)
+        self.name = name if name else "iosubprocessor"
+        self.daemon = True
         self.ignorablechars = "\r"
         self.eol = "\n"
         self.linehandler = linehandler
@@ -123,8 +890,18 @@ class TextIOProcessor(threading.Thread):
         self.lastrdtime = None
         self.infile = infile
         self.outfile = outfile
+        self.chunkSize = chunkSize
+        self.prompt = prompt
         self.rlock = threading.RLock()
         self.closed = False
+        # chunkHook(data) is called before and chunkHook(None) after 
+        # the processing of each chunk (see enableMetrics)
+        self.chunkHook = None
+        # eofHandler() is called once when the end of the input is reached
+        self.eofHandler = None
+        self.eof = False
+        self.reactor = reactor
+        self.splitter = None
         
     def lockSelf(self):
         """
@@ -175,42 +952,386 @@ class TextIOProcessor(threading.Thread):
             self.closed = True
         finally:
             self.unlockSelf()
+        if self.reactor is not None:
+            self.reactor.unregister(self)
+    
+    def start(self):
+        """
+        Start the reading thread or register the input with the reactor
+        """
+        if self.reactor is None:
+            threading.Thread.start(self)
+            return
+        self.splitter = self.__newSplitter()
+        self.reactor.register(self)
+    
+    def endOfInput(self):
+        if not self.eof:
+            self.eof = True
+            if self.eofHandler is not None:
+                self.eofHandler()
             
+    def __newSplitter(self):
+        return TextLineSplitter(
+            self.linehandler,
+            self.inflightLineHandler,
+            self.ignorablechars,
+            self.eol,
+            prompt=self.prompt
+        )
+    
+    def __runChunked(self):
+        """
+        Read all the data available on the input stream (up to chunkSize) 
+        at once, split it in lines and dispatch them to the line handler.
+        Only the unterminated tail is checked by the inflight line handler.
+        """
+        fd = self.infile.fileno()
+        self.splitter = self.__newSplitter()
+        while not self.closed:
+            data = os.read(fd, self.chunkSize)
+            if not data:
+                # nothing is read after the end of input, end the thread
+                self.endOfInput()
+                return
+            self.processChunk(data)
+    
+    def processChunk(self, data):
+        """
+        Dispatch the lines of a chunk of data read from the input
+        """
+        self.lastrdtime = time.time()
+        hook = self.chunkHook
+        if hook is not None:
+            hook(data)
+        data = self.splitter.feed(data)
+        if hook is not None:
+            hook(None)
+        if data:
+            self.__writeOutput(data)
+    
     def run(self):
         try:
+            if self.chunkSize:
+                self.__runChunked()
+                return
+            splitter = self.__newSplitter()
             while not self.closed:
                 c = self.infile.read(1)
                 if not c:
-                    time.sleep(0.2)
-                    continue
+                    self.endOfInput()
+                    return
                 self.lastrdtime = time.time()
                 if c in self.ignorablechars:
                     continue
                 
                 if c == self.eol:
-                    if self.linehandler:
-                        try:
-                            self.linehandler(self.line.getvalue())
-                        except Exception, e:
-                            LGR.debug("<>{0}".format(s))
-                            LGR.debug("lh-err:{0}".format(traceback.format_exc()))
-                    # TODO: use an array or buffer instead
+                    splitter.handleLine(self.line.getvalue())
                     self.line = StringIO.StringIO()
                 else:
                     self.line.write(c)
-                    s = self.line.getvalue()
-                    try:
-                        if self.inflightLineHandler and self.inflightLineHandler(s):
-                            LGR.debug(">>>{0}".format(s))
-                            self.line = StringIO.StringIO()
-                    except Exception, e:
-                        LGR.debug("<<>{0}".format(s))
-                        LGR.debug("plh-err:{0}".format(traceback.format_exc()))
+                    if splitter.handleInflightLine(self.line.getvalue()):
+                        self.line = StringIO.StringIO()
                         
                 self.__writeOutput(c)
         finally:
             LGR.debug("***Ending thread:{0}".format(self.name))
 
+class TextIOReactor(threading.Thread):
+    """
+    A single thread reading the inputs of many TextIOProcessor (the 
+    stdout and stderr pipes of the child processes of the sessions)
+    with a selector (epoll on linux): the data available on an input is
+    read in chunks of up to chunkSize bytes and dispatched by its
+    processor as by a chunked TextIOProcessor thread.
+    The number of threads does not grow with the number of sessions,
+    the line handlers run in the reactor thread and must not block
+    (a queryIter() consumer slower than the query stalls the other 
+    sessions while its row queue is full).
+    Requires python 3 (or the selectors34 package in python 2).
+    
+        reactor = useReactor()   # used by the sessions started next
+        pool = DB2CliSubprocessPool("sample", 100)
+    """
+    def __init__(self, chunkSize=65536, name="ioreactor"):
+        if selectors is None:
+            raise Exception("The reactor requires the selectors module")
+        threading.Thread.__init__(self)
+        self.name = name
+        self.daemon = True
+        self.chunkSize = chunkSize
+        self.selector = selectors.DefaultSelector()
+        # the (processor, register) changes applied by the reactor thread
+        self.changes = []
+        self.lock = threading.Lock()
+        self.wakeupPending = False
+        self.wakeupRead, self.wakeupWrite = os.pipe()
+        self.selector.register(self.wakeupRead, selectors.EVENT_READ, None)
+        self.closed = False
+    
+    def register(self, processor):
+        """
+        Read the input of the processor (called by processor.start())
+        """
+        processor.fd = processor.infile.fileno()
+        self.__change(processor, True)
+    
+    def unregister(self, processor):
+        self.__change(processor, False)
+    
+    def __change(self, processor, register):
+        if self.closed:
+            return
+        with self.lock:
+            self.changes.append((processor, register))
+            wakeup = not self.wakeupPending
+            self.wakeupPending = True
+        if wakeup:
+            os.write(self.wakeupWrite, b"x")
+    
+    def __applyChanges(self):
+        os.read(self.wakeupRead, 4096)
+        with self.lock:
+            changes = self.changes
+            self.changes = []
+            self.wakeupPending = False
+        for processor, register in changes:
+            fd = getattr(processor, 'fd', None)
+            if fd is None:
+                continue
+            key = self.selector.get_map().get(fd)
+            if key is not None and (register or key.data is processor):
+                # a closed pipe fd can be reused by a new process
+                self.selector.unregister(fd)
+            if register and not (processor.closed or processor.eof):
+                self.selector.register(fd, selectors.EVENT_READ, processor)
+    
+    def __read(self, fd, processor):
+        if processor.closed:
+            self.selector.unregister(fd)
+            return
+        try:
+            data = os.read(fd, self.chunkSize)
+        except OSError:
+            data = None
+        try:
+            if data:
+                processor.processChunk(data)
+                return
+            self.selector.unregister(fd)
+            processor.endOfInput()
+        except Exception as e:
+            LGR.debug("reactor-err:{0}".format(traceback.format_exc()))
+    
+    def run(self):
+        try:
+            while not self.closed:
+                for key, events in self.selector.select():
+                    if key.data is None:
+                        self.__applyChanges()
+                    else:
+                        self.__read(key.fd, key.data)
+        finally:
+            self.selector.close()
+            os.close(self.wakeupRead)
+            os.close(self.wakeupWrite)
+            LGR.debug("***Ending thread:{0}".format(self.name))
+    
+    def close(self):
+        """
+        Stop the reactor thread, the registered inputs are no longer read
+        """
+        self.closed = True
+        with self.lock:
+            self.wakeupPending = True
+        os.write(self.wakeupWrite, b"x")
+
+_REACTOR = []
+
+def useReactor(enabled=True, chunkSize=65536):
+    """
+    Make the sessions started next (TextRequestResponseSubprocess and
+    derived classes not given a reactor) read the output of their child
+    process with a shared TextIOReactor (returned), or with their own
+    threads if enabled is False
+    """
+    if not enabled:
+        TextRequestResponseSubprocess.defaultReactor = None
+        return None
+    if not _REACTOR or _REACTOR[0].closed:
+        del _REACTOR[:]
+        reactor = TextIOReactor(chunkSize)
+        reactor.start()
+        _REACTOR.append(reactor)
+    TextRequestResponseSubprocess.defaultReactor = _REACTOR[0]
+    return _REACTOR[0]
+
+class LatencyHistogram:
+    """
+    HDR style histogram of latencies: the values (seconds) are counted
+    in microseconds buckets, subBuckets linear buckets per power of 2
+    so the relative error of the percentiles is below 2/subBuckets.
+    Values over maxSeconds are counted in the last bucket.
+    """
+    def __init__(self, subBuckets=128, maxSeconds=3600):
+        self.subBits = max(subBuckets.bit_length() - 1, 1)
+        self.half = 1 << (self.subBits - 1)
+        self.maxIndex = self._index(int(maxSeconds * 1000000))
+        self.counts = array.array('L', [0]) * (self.maxIndex + 1)
+        self.count = 0
+        self.total = 0.0
+        self.min = None
+        self.max = None
+    
+    def _index(self, us):
+        h = us.bit_length() - self.subBits
+        if h <= 0:
+            return us
+        return h * self.half + (us >> h)
+    
+    def _value(self, index):
+        """
+        Return the highest value (microseconds) counted in a bucket
+        """
+        if index < 2 * self.half:
+            return index
+        h = index // self.half - 1
+        return ((index - h * self.half + 1) << h) - 1
+    
+    def record(self, seconds):
+        if seconds < 0:
+            seconds = 0.0
+        self.counts[min(self._index(int(seconds * 1000000)), self.maxIndex)] += 1
+        self.count += 1
+        self.total += seconds
+        if self.min is None or seconds < self.min:
+            self.min = seconds
+        if self.max is None or seconds > self.max:
+            self.max = seconds
+    
+    def percentile(self, p):
+        """
+        Return the value (seconds) under which p percent of the values are
+        """
+        if not self.count:
+            return None
+        rank = max(1, int(round(self.count * p / 100.0)))
+        seen = 0
+        for i, c in enumerate(self.counts):
+            seen += c
+            if seen >= rank:
+                return min(self._value(i) / 1000000.0, self.max)
+        return self.max
+    
+    def stats(self):
+        return {
+            'count':self.count,
+            'mean':self.total / self.count if self.count else None,
+            'min':self.min,
+            'max':self.max,
+            'p50':self.percentile(50),
+            'p90':self.percentile(90),
+            'p99':self.percentile(99),
+            'p999':self.percentile(99.9)
+        }
+
+class RequestMetrics:
+    """
+    The timings (time.time() values) and counters of one request
+    """
+    def __init__(self, cmd, kind):
+        self.cmd = cmd
+        self.kind = kind
+        self.start = time.time()
+        self.sent = None
+        self.firstByte = None
+        self.prompt = None
+        self.end = None
+        self.bytesRead = 0
+        self.lines = 0
+        self.parseSeconds = 0.0
+        self.chunkStart = None
+        self.rows = None
+        self.error = None
+    
+    def asDict(self):
+        """
+        Return the metrics as a map of durations (seconds) and counters
+        """
+        sent = self.sent or self.start
+        return {
+            'cmd':self.cmd,
+            'kind':self.kind,
+            'start':self.start,
+            'sendSeconds':sent - self.start,
+            'firstByteSeconds':self.firstByte - sent if self.firstByte else None,
+            'promptSeconds':self.prompt - sent if self.prompt else None,
+            'totalSeconds':self.end - self.start if self.end else None,
+            'parseSeconds':self.parseSeconds,
+            'bytesRead':self.bytesRead,
+            'lines':self.lines,
+            'rows':self.rows,
+            'error':self.error
+        }
+
+class RequestInstrumentation:
+    """
+    Collect the RequestMetrics of the requests of one or more sessions
+    (see TextRequestResponseSubprocess.enableMetrics) in latency 
+    histograms ('total', 'firstByte', 'parse') by command kind (the 
+    first word of the command) and pass them to the hooks, any 
+    callable hook(metrics) e.g. an exporter.
+    """
+    KIND_REC = re.compile("^\s*(\w+)")
+    HISTOGRAMS = ('total', 'firstByte', 'parse')
+    
+    def __init__(self, hooks=None):
+        self.hooks = list(hooks) if hooks else []
+        self.histograms = {}
+        self.requests = 0
+        self.errors = 0
+        self.lock = threading.Lock()
+    
+    def addHook(self, hook):
+        self.hooks.append(hook)
+    
+    def removeHook(self, hook):
+        self.hooks.remove(hook)
+    
+    def kindOf(self, cmd):
+        m = RequestInstrumentation.KIND_REC.match(cmd)
+        return m.group(1).lower() if m else ""
+    
+    def record(self, metrics):
+        sent = metrics.sent or metrics.start
+        with self.lock:
+            hs = self.histograms.get(metrics.kind)
+            if hs is None:
+                hs = dict((n, LatencyHistogram()) for n in RequestInstrumentation.HISTOGRAMS)
+                self.histograms[metrics.kind] = hs
+            hs['total'].record(metrics.end - metrics.start)
+            if metrics.firstByte:
+                hs['firstByte'].record(metrics.firstByte - sent)
+            hs['parse'].record(metrics.parseSeconds)
+            self.requests += 1
+            if metrics.error is not None:
+                self.errors += 1
+        for hook in self.hooks:
+            try:
+                hook(metrics)
+            except Exception as e:
+                LGR.debug("metrics-hook-err:{0}".format(traceback.format_exc()))
+    
+    def stats(self):
+        """
+        Return the histograms statistics by command kind
+        """
+        with self.lock:
+            return dict(
+                (kind, dict((n, h.stats()) for n, h in hs.items())) \
+                for kind, hs in self.histograms.items()
+            )
+
 class TextRequestResponseSubprocessException(StandardError):
     """
     A base exception for all process response detected errors.
@@ -228,53 +1349,97 @@ class TextRequestResponseSubprocess:
     Allows for provisions on handling interfaces designed for
     human beings (including a prompt and a text custom parser). 
     """
+    # the prompt text, if known, allows the prompt to be found at the 
+    # beginning of a line when requests are pipelined
+    PROMPT = None
+    # the TextIOReactor of the sessions not given one (see useReactor)
+    defaultReactor = None
+    
     def __init__(self,
             cmdline ,
             promptDetectorMethod,
             responseParser=None,
             responseLineHandler=None,
-            name=None
+            name=None,
+            readChunkSize=65536,
+            env=None,
+            reactor=None
         ):
+        """
+        The stdout and stderr of the child process are read in chunks
+        of up to readChunkSize bytes, set readChunkSize to None to fall
+        back to reading one char at the time.
+        env is the environment of the child process (the current one
+        if None).
+        With a reactor (TextIOReactor, defaultReactor if None) the 
+        stdout and stderr are read by the reactor thread instead of two
+        threads per session.
+        """
         self.name = name if name else "subprocess"
         self.promptDetectorMethod = promptDetectorMethod
         self.responseLineHandler = responseLineHandler
         self.responseParser = responseParser
         self.cmdline = cmdline
         self.endRequest = False
+        self.endRequestEvent = threading.Event()
         self.stdoutErr = False
         self.response = []
+        self.error = []
+        self.readChunkSize = readChunkSize
+        self.env = env
+        self.reactor = reactor if reactor is not None else TextRequestResponseSubprocess.defaultReactor
+        # the timeout of the requests not given an explicit timeout
+        self.requestTimeout = 300
+        self.proc = None
+        self.stdoutproc = None
+        self.stderrproc = None
+        # the RequestInstrumentation, metrics are not collected if None
+        self.metrics = None
+        self.requestMetrics = None
+        self._start()
         
-        LGR.debug("Exec process cmd:{0}".format(repr(cmdline)))
+    def _start(self):
+        """
+        Start the child process and the stdout/stderr processing threads
+        then wait for the first prompt. 
+        Redefined by front-ends that drive the child process differently.
+        """
+        LGR.debug("Exec process cmd:{0}".format(repr(self.cmdline)))
         
         self.proc = subprocess.Popen(
-            cmdline,
+            self.cmdline,
             stdin=subprocess.PIPE,
             stdout=subprocess.PIPE,
-            stderr=subprocess.PIPE
+            stderr=subprocess.PIPE,
+            universal_newlines=PY3,
+            env=self.env
         )
         if not self.isAlive():
-            raise Exception("Unable to start {0}".format(cmdline[0]))
+            raise Exception("Unable to start {0}".format(self.cmdline[0]))
         
         self.stdoutproc = TextIOProcessor(
             self.proc.stdout,
             linehandler=self.handleOutputLine,
             inflightLineHandler=self.handleInflightLine,
-            name=self.name + ".stdout"
+            name=self.name + ".stdout",
+            chunkSize=self.readChunkSize,
+            prompt=self.PROMPT,
+            reactor=self.reactor
         )
+        self.stdoutproc.eofHandler = self._handleEof
         self.stdoutproc.start()
         
         self.stderrproc = TextIOProcessor(
             self.proc.stderr,
             linehandler=self.handleErrorLine,
-            name=self.name + ".stderr"
+            name=self.name + ".stderr",
+            chunkSize=self.readChunkSize,
+            reactor=self.reactor
         )
         self.stderrproc.start()
         
         if self.promptDetectorMethod:
-            timeout = 10
-            start = time.time()
-            while not self.endRequest and ((time.time() - start) < timeout):
-                time.sleep(0.2)
+            self.endRequestEvent.wait(10)
 
     def testForErrorState(self, line):
         """
@@ -289,19 +1454,95 @@ class TextRequestResponseSubprocess:
     def isAlive(self):
         return self.proc.poll() is None
     
+    def _handleEof(self):
+        """
+        The child process ended (or closed its stdout): release the
+        request waiting for a prompt that will never come
+        """
+        LGR.debug("{0} stdout closed".format(self.name))
+        self.endRequestEvent.set()
+    
     def handleInflightLine(self, line):
         if self.promptDetectorMethod and self.promptDetectorMethod(line):
+            if self.requestMetrics is not None:
+                self._markPrompt()
             self.endRequest = True
+            self.endRequestEvent.set()
         return self.endRequest
     
-    def handleOutputLine(self, line):
-        LGR.debug(">>{0}".format(line))
-        if self.stdoutErr:
-            self.handleErrorLine(line)
-            return        
-        if self.testForErrorState(line):
-            self.stdoutErr = True
-            self.handleErrorLine(line)
+    def enableMetrics(self, instrumentation=None):
+        """
+        Collect the metrics of each request (RequestMetrics) in a
+        RequestInstrumentation (can be shared by several sessions)
+        and return it. When not enabled there is no metrics overhead.
+        """
+        self.metrics = instrumentation if instrumentation else RequestInstrumentation()
+        if self.stdoutproc is not None and hasattr(self.stdoutproc, 'chunkHook'):
+            self.stdoutproc.chunkHook = self._recordChunk
+        return self.metrics
+    
+    def disableMetrics(self):
+        if self.stdoutproc is not None and hasattr(self.stdoutproc, 'chunkHook'):
+            self.stdoutproc.chunkHook = None
+        self.metrics = None
+    
+    def _recordChunk(self, data):
+        """
+        Called by the stdout thread before (with the data) and after 
+        (with None) processing each chunk read
+        """
+        m = self.requestMetrics
+        if m is None:
+            return
+        now = time.time()
+        if data is None:
+            if m.chunkStart is not None:
+                m.parseSeconds += now - m.chunkStart
+                m.chunkStart = None
+            return
+        if m.firstByte is None:
+            m.firstByte = now
+        m.bytesRead += len(data)
+        m.lines += data.count(b"\n" if isinstance(data, bytes) else "\n")
+        m.chunkStart = now
+    
+    def _markPrompt(self):
+        m = self.requestMetrics
+        if m is not None:
+            now = time.time()
+            m.prompt = now
+            if m.chunkStart is not None:
+                m.parseSeconds += now - m.chunkStart
+                m.chunkStart = None
+    
+    def _endRequestMetrics(self, error=None):
+        """
+        Complete the current request metrics and record them
+        """
+        m = self.requestMetrics
+        if m is None:
+            return
+        self.requestMetrics = None
+        m.end = time.time()
+        if error is not None:
+            m.error = error
+        elif self.error:
+            m.error = self.error[0]
+        response = self.response
+        if isinstance(response, dict) and isinstance(response.get('rows'), list):
+            m.rows = len(response['rows'])
+        metrics = self.metrics
+        if metrics is not None:
+            metrics.record(m)
+    
+    def handleOutputLine(self, line):
+        LGR.debug(">>%s", line)
+        if self.stdoutErr:
+            self.handleErrorLine(line)
+            return        
+        if self.testForErrorState(line):
+            self.stdoutErr = True
+            self.handleErrorLine(line)
             return
          
         if self.responseLineHandler:
@@ -311,7 +1552,7 @@ class TextRequestResponseSubprocess:
             if rt == list:
                 self.response.append(line)
             elif (rt == dict) \
-              and self.response.has_key('info') \
+              and 'info' in self.response \
               and (type(self.response['info']) == list):
                 self.response['info'].append(line)
         
@@ -336,41 +1577,101 @@ class TextRequestResponseSubprocess:
         """
         raise TextRequestResponseSubprocessException(*self.error)
     
-    def getResponse(self, cmd, timeout=300, loopSleep=0.2):
+    def getResponse(self, cmd, timeout=None, loopSleep=0.2):
         """
         Execute a request to the child thread listen/wait for a response on the
         stdout and stderr then when the prompt is found call the 
-        output and error parser then return the result
+        output and error parser then return the result.
+        The stdout reader thread signals the prompt through the 
+        endRequestEvent so the response is returned as soon as it is
+        complete, loopSleep is no longer used and is kept only for
+        compatibility with existing callers.
+        The timeout defaults to requestTimeout, if the child process ends
+        before the prompt an exception is raised without waiting.
+        """
+        self._beginRequest(cmd)
+        try:
+            self._sendRequest(cmd)
+            
+            if not self.endRequestEvent.wait(self.requestTimeout if timeout is None else timeout):
+                raise Exception("Timeout")
+            if not self.endRequest:
+                raise Exception("{0} process ended".format(self.name))
+            return self._requestResult()
+        except Exception as e:
+            if self.requestMetrics is not None:
+                self._endRequestMetrics(e)
+            raise
+        finally:
+            if self.requestMetrics is not None:
+                self._endRequestMetrics()
+    
+    def _beginRequest(self, cmd):
+        """
+        Reset the request state before sending cmd to the child process
         """
         if not self.isAlive():
             raise Exception("{0} process is disconnected!".format(self.name))
         self.request = cmd
         self.endRequest = False
+        self.endRequestEvent.clear()
         if self.response is None:
             self.response = []
         self.stdoutErr = False
         self.error = []
+        if self.metrics is not None:
+            self.requestMetrics = RequestMetrics(cmd, self.metrics.kindOf(cmd))
         
         LGR.debug("<<<{0}".format(str(cmd)))
-        
+    
+    def _sendRequest(self, cmd):
         self.proc.stdin.write(cmd)
         self.proc.stdin.write(os.linesep)
         self.proc.stdin.flush()
-        
+        if self.requestMetrics is not None:
+            self.requestMetrics.sent = time.time()
+    
+    def _requestResult(self):
+        """
+        Parse the response (or the error) once the prompt was found
+        """
+        m = self.requestMetrics
+        if m is None:
+            if self.error:
+                return self._errParser()
+            return self._outputParser()
         stime = time.time()
-        while not self.endRequest:
-            time.sleep(loopSleep)
-            if (time.time() - stime) > timeout:
-                raise Exception("Timeout")
-        if self.error:
-            return self._errParser()
-        return self._outputParser()
+        try:
+            if self.error:
+                return self._errParser()
+            return self._outputParser()
+        finally:
+            m.parseSeconds += time.time() - stime
     
     def close(self):
         if self.stdoutproc:
             self.stdoutproc.close()
         if self.stderrproc:
             self.stderrproc.close()
+    
+    def shutdown(self, timeout=5):
+        """
+        End the child process by closing its stdin, wait up to timeout 
+        seconds for it to exit then kill it if still alive and
+        stop the stdout and stderr processing threads.
+        """
+        try:
+            if self.isAlive():
+                self.proc.stdin.close()
+                etime = time.time() + timeout
+                while self.isAlive() and time.time() < etime:
+                    time.sleep(0.05)
+                if self.isAlive():
+                    self.proc.kill()
+        except Exception as e:
+            LGR.debug("shutdown-err:{0}".format(traceback.format_exc()))
+        finally:
+            self.close()
 
 class SQLError(TextRequestResponseSubprocessException):
     def __init__(self, *args, **names):
@@ -385,30 +1686,504 @@ class SQLError(TextRequestResponseSubprocessException):
     def __str__(self):
         return repr(self)
     
+class ColumnBatchParser:
+    """
+    Parse batches of fixed width lines (as printed by the db2 cli for
+    a result set) into columns. 
+    With numpy each batch is converted in a single array and each column 
+    is cut out of it as a whole, numeric columns are converted to int64
+    (float64 if they have decimals or NULLs) and the others are kept as
+    text. A column is text if any of its batches is not numeric.
+    Right aligned integer columns are converted directly from the char
+    codes (no per value string parsing).
+    If the db2 column types are provided (see describe) only the columns
+    of the NUMERIC_TYPES are converted, otherwise the columns with a 
+    left aligned value (character columns) are kept as text.
+    """
+    NULL = "-"
+    NUMERIC_TYPES = ('SMALLINT', 'INTEGER', 'BIGINT', 'DECIMAL', 'NUMERIC', 
+        'DECFLOAT', 'REAL', 'DOUBLE', 'FLOAT')
+    
+    def __init__(self, sizes, fixedWidthText=False, types=None):
+        self.sizes = sizes
+        self.fixedWidthText = fixedWidthText
+        self.rowSize = sum(sizes) + len(sizes) - 1
+        self.slices = []
+        spos = 0
+        for l in sizes:
+            self.slices.append((spos, spos + l))
+            spos = spos + l + 1
+        self.batches = [[] for l in sizes]
+        if types is not None and len(types) == len(sizes):
+            self.numeric = [t in ColumnBatchParser.NUMERIC_TYPES for t in types]
+            self.typed = True
+        else:
+            self.numeric = [True for l in sizes]
+            self.typed = False
+        self.count = 0
+        
+    def addBatch(self, lines):
+        self.count += len(lines)
+        if numpy is None:
+            return self.__addListBatch(lines)
+        kind = 'S' if isinstance(lines[0], bytes) else 'U'
+        n = len(lines)
+        chars = numpy.array(lines, dtype=kind + str(self.rowSize))
+        chars = chars.view(kind + '1').reshape(n, self.rowSize)
+        codeType = numpy.uint8 if kind == 'S' else numpy.uint32
+        for i, (spos, epos) in enumerate(self.slices):
+            block = numpy.ascontiguousarray(chars[:, spos:epos])
+            if self.numeric[i] and not self.typed:
+                codes = block.view(codeType)
+                # the character columns are left aligned
+                if ((codes[:, 0] != 32) & (codes[:, -1] == 32)).any():
+                    self.numeric[i] = False
+            num = self.__toInt(block.view(codeType)) if self.numeric[i] else None
+            if num is not None:
+                self.batches[i].append(num)
+                continue
+            col = numpy.char.strip(block.view(kind + str(epos - spos)).reshape(n))
+            num = self.__toNumeric(col) if self.numeric[i] else None
+            if num is None:
+                self.numeric[i] = False
+                self.batches[i].append(col)
+            else:
+                self.batches[i].append(num)
+    
+    def __toInt(self, codes):
+        """
+        Convert the char codes (rows x width) of a column of right aligned
+        integers (up to 18 digits) or NULLs, return None for any other column.
+        """
+        digit = (codes >= 48) & (codes <= 57)
+        space = codes == 32
+        minus = codes == 45
+        if not (digit | space | minus).all() or space[:, -1].any():
+            return None
+        # right aligned: no space or '-' after a digit or a '-'
+        if ((space[:, 1:] | minus[:, 1:]) & ~space[:, :-1]).any():
+            return None
+        width = codes.shape[1]
+        if width > 18 and digit[:, :width - 18].any():
+            return None
+        powers = numpy.array(
+            [10 ** (width - 1 - j) if width - j <= 18 else 0 for j in range(width)],
+            dtype=numpy.int64
+        )
+        values = numpy.where(digit, codes - 48, 0).dot(powers)
+        values[minus.any(axis=1)] *= -1
+        nulls = minus[:, -1]
+        if nulls.any():
+            values = values.astype(numpy.float64)
+            values[nulls] = numpy.nan
+        return values
+    
+    def __toNumeric(self, col):
+        nulls = col == ColumnBatchParser.NULL
+        if not nulls.any():
+            try:
+                return col.astype(numpy.int64)
+            except (ValueError, OverflowError):
+                pass
+        try:
+            return numpy.where(nulls, 'nan', col).astype(numpy.float64)
+        except (ValueError, OverflowError):
+            return None
+    
+    def __addListBatch(self, lines):
+        for i, (spos, epos) in enumerate(self.slices):
+            if self.numeric[i] and not self.typed and epos > spos:
+                # the character columns are left aligned
+                for line in lines:
+                    if line[spos] != " " and line[epos - 1] == " ":
+                        self.numeric[i] = False
+                        break
+            col = [line[spos:epos].strip() for line in lines]
+            if self.numeric[i]:
+                try:
+                    col = [None if x == ColumnBatchParser.NULL else \
+                        (int(x) if x.lstrip('-').isdigit() else float(x)) \
+                        for x in col]
+                except ValueError:
+                    self.numeric[i] = False
+            self.batches[i].append(col)
+    
+    def __text(self, col):
+        if col.dtype.kind in 'SU':
+            if self.fixedWidthText:
+                return numpy.char.encode(col, 'utf-8') if col.dtype.kind == 'U' else col
+            return col.astype(object)
+        # a numeric batch of a column found to be text in a later batch,
+        # the NULLs (nan) are the NULL marker again
+        text = col.astype('U')
+        if col.dtype.kind == 'f':
+            nulls = numpy.isnan(col)
+            # the integers of a batch with NULLs were converted to float
+            values = numpy.where(numpy.isfinite(col), col, 0)
+            integral = ~nulls & (values == numpy.floor(values)) & (values == col)
+            text = numpy.where(integral, values.astype(numpy.int64).astype('U'), text)
+            text = numpy.where(nulls, ColumnBatchParser.NULL, text)
+        return self.__text(text)
+    
+    def columns(self):
+        """
+        Return the list of columns parsed so far
+        """
+        cols = []
+        for i, batches in enumerate(self.batches):
+            if numpy is None:
+                col = []
+                for batch in batches:
+                    if not self.numeric[i]:
+                        batch = [x if isinstance(x, str) else \
+                            (ColumnBatchParser.NULL if x is None else str(x)) for x in batch]
+                    col.extend(batch)
+                cols.append(col)
+            elif not batches:
+                cols.append(numpy.array([], dtype=object))
+            elif self.numeric[i]:
+                cols.append(numpy.concatenate(batches))
+            else:
+                cols.append(numpy.concatenate([self.__text(x) for x in batches]))
+        return cols
+    
+class DelFileReader(threading.Thread):
+    """
+    Read and parse in a thread a DEL file (usually a named pipe written
+    by a db2 EXPORT). Each record is converted with the column 
+    converters and passed to writerow, onEnd is called at the end.
+    """
+    def __init__(self, fname, converters, writerow, onEnd=None, name=None):
+        threading.Thread.__init__(self)
+        self.name = name if name else "delreader"
+        self.daemon = True
+        self.fname = fname
+        self.converters = converters
+        self.writerow = writerow
+        self.onEnd = onEnd
+        self.released = False
+        self.count = 0
+        
+    def run(self):
+        try:
+            if not self.released:
+                self.__readRows()
+        except Exception as e:
+            LGR.debug("del-reader-err:{0}".format(traceback.format_exc()))
+        finally:
+            if self.onEnd:
+                self.onEnd()
+    
+    def __readRows(self):
+        converters = self.converters
+        writerow = self.writerow
+        f = open(self.fname)
+        try:
+            pending = None
+            for line in f:
+                if pending is not None:
+                    line = pending + line
+                    pending = None
+                if line.count('"') % 2:
+                    # a new line inside a quoted field
+                    pending = line
+                    continue
+                fields = parseDelLine(line.rstrip("\r\n"))
+                writerow([
+                    v if (c is None or v is None) else c(v) \
+                    for c, v in zip(converters, fields)
+                ])
+                self.count += 1
+        finally:
+            f.close()
+    
+    def release(self, timeout=1.0):
+        """
+        Unblock the thread if db2 never opened the pipe for writing
+        """
+        self.released = True
+        etime = time.time() + timeout
+        while self.is_alive():
+            try:
+                os.close(os.open(self.fname, os.O_WRONLY | os.O_NONBLOCK))
+                return
+            except OSError as e:
+                # the thread did not open the pipe yet
+                if time.time() > etime:
+                    return
+                time.sleep(0.01)
+    
+class DB2CliQueryIterator:
+    """
+    Iterate over the rows of a query while they are parsed by the
+    stdout processing thread of a DB2CliSubprocess (see queryIter).
+    The rows are passed through a queue of at most queueSize rows,
+    when the consumer is slower than db2 the stdout thread blocks
+    (and so does db2) until rows are consumed.
+    The column names and sizes are available after the first row.
+    Close the iterator (or use it as a context manager) if you stop 
+    before the last row so the rest of the output is discarded and 
+    the session can be used again.
+    """
+    END = object()
+    
+    def __init__(self, session, queueSize=1000, timeout=300):
+        self.session = session
+        self.queue = Queue.Queue(queueSize)
+        self.timeout = timeout
+        self.discard = False
+        self.done = False
+        self.response = None
+        # finisher(raiseError) replaces the default end of request handling
+        self.finisher = None
+        
+    def writerow(self, rec):
+        if not self.discard:
+            self.queue.put(rec)
+    
+    def end(self):
+        if not self.discard:
+            self.queue.put(DB2CliQueryIterator.END)
+    
+    @property
+    def names(self):
+        return self.response.get('names') if self.response else None
+    
+    @property
+    def sizes(self):
+        return self.response.get('sizes') if self.response else None
+    
+    def __iter__(self):
+        return self
+    
+    def next(self):
+        """
+        Return the next row, wait up to timeout seconds for it.
+        At the end of the result raise the SQLError returned by db2 if any.
+        """
+        if self.done:
+            raise StopIteration
+        try:
+            row = self.queue.get(True, self.timeout)
+        except Queue.Empty:
+            raise Exception("Timeout")
+        if row is DB2CliQueryIterator.END:
+            self.done = True
+            if self.finisher:
+                self.finisher(True)
+            else:
+                self.session._endQueryIter()
+                self.session._requestResult()
+            raise StopIteration
+        return row
+    __next__ = next
+    
+    def close(self):
+        """
+        Discard the remaining rows and wait for the end of the request
+        """
+        if self.done:
+            return
+        self.done = True
+        self.discard = True
+        while True:
+            try:
+                self.queue.get_nowait()
+            except Queue.Empty:
+                break
+        if self.finisher:
+            self.finisher(False)
+            return
+        self.session.endRequestEvent.wait(self.timeout)
+        self.session._endQueryIter()
+        
+    def __enter__(self):
+        return self
+    
+    def __exit__(self, *args):
+        self.close()
+    
+def _resultSize(value):
+    """
+    Estimate the memory used by a result (maps, lists and scalars)
+    """
+    size = sys.getsizeof(value)
+    if isinstance(value, dict):
+        for k, v in value.items():
+            size += _resultSize(k) + _resultSize(v)
+    elif isinstance(value, (list, tuple)):
+        for v in value:
+            size += _resultSize(v)
+    return size
+
+class ResultCache:
+    """
+    A thread safe LRU cache of query and command results, shared by 
+    one or more DB2CliSubprocess sessions (see DB2CliSubprocess.cache).
+    The keys are (instance, database, scope, normalized command), scope 
+    is None for the results valid for any session of the database.
+    The entries expire after ttl seconds and the least recently used 
+    entries are evicted while the estimated size of the cached results
+    is over maxBytes. The sessions return copies of the cached results
+    (see _sharedResult).
+    """
+    MISS = object()
+    
+    def __init__(self, maxBytes=64 * 1024 * 1024, ttl=60):
+        self.maxBytes = maxBytes
+        self.ttl = ttl
+        # key -> (expire time, size, value), least recently used first
+        self.entries = collections.OrderedDict()
+        self.bytes = 0
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        self.invalidations = 0
+    
+    def get(self, key):
+        """
+        Return the cached value or ResultCache.MISS
+        """
+        with self.lock:
+            entry = self.entries.pop(key, None)
+            if entry is None:
+                self.misses += 1
+                return ResultCache.MISS
+            if entry[0] < time.time():
+                self.bytes -= entry[1]
+                self.expirations += 1
+                self.misses += 1
+                return ResultCache.MISS
+            self.entries[key] = entry
+            self.hits += 1
+            return entry[2]
+    
+    def put(self, key, value, ttl=None):
+        size = _resultSize(value)
+        if size > self.maxBytes:
+            return
+        ttl = self.ttl if ttl is None else ttl
+        with self.lock:
+            old = self.entries.pop(key, None)
+            if old is not None:
+                self.bytes -= old[1]
+            self.entries[key] = (time.time() + ttl, size, value)
+            self.bytes += size
+            while self.bytes > self.maxBytes:
+                k, entry = self.entries.popitem(last=False)
+                self.bytes -= entry[1]
+                self.evictions += 1
+    
+    def invalidate(self, database=None, scope=None, instance=None):
+        """
+        Remove the entries of a database, of a session scope and/or of
+        an instance (all the entries if none is provided)
+        """
+        with self.lock:
+            for key in list(self.entries):
+                if (instance is None or key[0] == instance) and \
+                  (database is None or key[1] == database) and \
+                  (scope is None or key[2] == scope):
+                    self.bytes -= self.entries.pop(key)[1]
+                    self.invalidations += 1
+    
+    def clear(self):
+        self.invalidate()
+    
+    def stats(self):
+        with self.lock:
+            return {
+                'entries':len(self.entries),
+                'bytes':self.bytes,
+                'hits':self.hits,
+                'misses':self.misses,
+                'evictions':self.evictions,
+                'expirations':self.expirations,
+                'invalidations':self.invalidations
+            }
+
+def _sharedResult(value):
+    """
+    Return a shallow copy of a cached result (with a copy of its rows
+    list) so the callers can not modify the cached one
+    """
+    if isinstance(value, dict):
+        value = dict(value)
+        if isinstance(value.get('rows'), list):
+            value['rows'] = list(value['rows'])
+    elif isinstance(value, list):
+        value = list(value)
+    return value
+
+_SESSION_IDS = itertools.count(1)
+
 class DB2CliSubprocess(TextRequestResponseSubprocess):
     """
     Call a db2 command then execute subsequent commands parse and 
     return results to the caller.
     """
+    PROMPT = "db2 => "
     QUERY_HDR_REC = re.compile("^-+(\s+-*)*$")
     ERROR_LINE_REC = re.compile("^SQL\d+N.*$", re.DOTALL)
     ERROR_CODE_REC = re.compile("SQL\d+N")
     ERROR_STATE_REC = re.compile("SQLSTATE\=\d+")
             
-    def __init__(self, database=None, delimiter="@"):
+    def __init__(self, database=None, delimiter="@", cache=None, instance=None, reactor=None):
+        """
+        The db2 cli runs in the DB2INSTANCE environment of instance if
+        provided (the current instance otherwise), its output is read
+        by the reactor if provided (see TextRequestResponseSubprocess)
+        """
         self.delimiter = delimiter
+        self.database = database
+        self.instance = instance
+        env = None
+        if instance:
+            env = dict(os.environ)
+            env['DB2INSTANCE'] = instance
+        # an optional ResultCache (can be shared by several sessions)
+        self.cache = cache
+        self.cacheScope = next(_SESSION_IDS)
+        # normalized query -> DisplayRowDecoder, least recently used first
+        self.describeCache = collections.OrderedDict()
+        self.outputEncoding = locale.getpreferredencoding(False)
+        # the MappingCompactor of the compact snapshots (kept between
+        # calls so the snapshots of a collector share keys and values)
+        self.snapshotCompactor = None
+        # key the agent sections of the snapshots by position
+        self.agentOrdinals = False
         self.trimColData = True
+        self.rowQueue = None
+        self.pipeStmts = None
         TextRequestResponseSubprocess.__init__(self,
             ["db2", "-td" + delimiter],
             self.__promptDetector,
-            name="db2subprocess"
+            name="db2subprocess",
+            env=env,
+            reactor=reactor
         )
         
         if database:
             self.execStmt("connect to " + database + self.delimiter)
         
     def __promptDetector(self, line):
-        return line == "db2 => "
+        return line == DB2CliSubprocess.PROMPT
+    
+    def handleInflightLine(self, line):
+        if self.pipeStmts is not None:
+            if self.promptDetectorMethod(line):
+                if self.requestMetrics is not None:
+                    self._markPrompt()
+                self._nextPipelineStmt()
+                return True
+            return False
+        if TextRequestResponseSubprocess.handleInflightLine(self, line) and self.rowQueue:
+            rowQueue = self.rowQueue
+            self.rowQueue = None
+            rowQueue.end()
+        return self.endRequest
     
     def testForErrorState(self, line):
         """
@@ -448,29 +2223,99 @@ class DB2CliSubprocess(TextRequestResponseSubprocess):
         for result sets that may not fit in memory
         """
         if self.rq_begin:
-            if DB2CliSubprocess.QUERY_HDR_REC.match(line):
-                self.row_size = len(line)
-                self.row_sizes = [len(x) for x in line.split()]
-                self.response['sizes'] = self.row_sizes
-                if self.last_line:
-                    self.response["names"] = self.last_line.split()
-                self.rq_begin = False
-            self.last_line = line
+            self._parseQueryHeaderLine(line)
         else:
-            if len(line) == self.row_size:
-                spos = 0
-                rec = []
-                for l in self.row_sizes:
-                    col = line[spos:spos + l]
-                    if self.trimColData:
-                        col = col.strip()
-                    rec.append(col)
-                    spos = spos + l + 1
-                if self.rowWriter:
+            rec = self._splitRow(line)
+            if rec is not None:
+                if self.rowWriter is not None:
                     self.rowWriter.writerow(rec)
                 else:
                     self.response['rows'].append(rec)
+    
+    def _splitRow(self, line):
+        """
+        Return the columns of a fixed width row line or None if line is
+        not a row. The columns are padded to their size in bytes, a
+        line with multibyte characters is split on its encoded bytes.
+        """
+        size = len(line)
+        if size != self.row_size:
+            data = self._rowBytes(line)
+            if data is None:
+                return None
+            enc = self.outputEncoding
+            if self.trimColData:
+                return [data[s:e].decode(enc, "replace").strip() for s, e in self.row_slices]
+            return [data[s:e].decode(enc, "replace") for s, e in self.row_slices]
+        if self.trimColData:
+            return [line[s:e].strip() for s, e in self.row_slices]
+        return [line[s:e] for s, e in self.row_slices]
 
+    def _rowBytes(self, line):
+        """
+        Return the encoded bytes of a row line shorter than the row size
+        because of its multibyte characters, None if line is not a row
+        """
+        if not PY3 or not line or len(line) > self.row_size:
+            return None
+        data = line.encode(self.outputEncoding, "replace")
+        return data if len(data) == self.row_size else None
+    
+    def _parseQueryHeaderLine(self, line):
+        """
+        Find the ----- line under the column names and extract the
+        column sizes and names.
+        """
+        if DB2CliSubprocess.QUERY_HDR_REC.match(line):
+            self.row_size = len(line)
+            self.row_sizes = [len(x) for x in line.split()]
+            self.row_slices = []
+            spos = 0
+            for l in self.row_sizes:
+                self.row_slices.append((spos, spos + l))
+                spos = spos + l + 1
+            self.response['sizes'] = self.row_sizes
+            if self.last_line:
+                self.response["names"] = self.last_line.split()
+            self.rq_begin = False
+        self.last_line = line
+    
+    def handleColumnarQueryOutputLine(self, line):
+        """
+        Handle lines returned by a query, the row lines are collected 
+        and parsed in batches of columnBatchSize lines into columns.
+        """
+        if self.rq_begin:
+            self._parseQueryHeaderLine(line)
+            if not self.rq_begin:
+                self.columnParser = ColumnBatchParser(
+                    self.row_sizes, self.fixedWidthText, self.columnTypes
+                )
+        else:
+            if len(line) != self.row_size:
+                data = self._rowBytes(line)
+                if data is None:
+                    return
+                # pad the columns to their size in characters
+                enc = self.outputEncoding
+                line = " ".join(
+                    data[s:e].decode(enc, "replace").ljust(e - s) for s, e in self.row_slices
+                )
+            self.columnBatch.append(line)
+            if len(self.columnBatch) >= self.columnBatchSize:
+                self.columnParser.addBatch(self.columnBatch)
+                self.columnBatch = []
+    
+    def _columnarResult(self, response):
+        if self.columnParser:
+            if self.columnBatch:
+                self.columnParser.addBatch(self.columnBatch)
+            response['columns'] = self.columnParser.columns()
+            response['count'] = self.columnParser.count
+        self.columnBatch = []
+        self.columnParser = None
+        return response
+    
     def parseKV(self, line):
         idx = line.find("=")
         if idx > 0:
@@ -485,27 +2330,50 @@ class DB2CliSubprocess(TextRequestResponseSubprocess):
             if line.find('Application Snapshot') > 0:
                 self.rsState = 'kv'
         elif self.rsState == 'kv':
-            if not line:
-                return
-            
-            k, v = self.parseKV(line)
-            if k:
-                if k == 'Agent process/thread ID':
+            self._handleApplicationSnapshotKV(line, self.response)
+    
+    def handleApplicationsSnapshotLine(self, line):
+        """
+        Handle the output of the db2 get snapshot for applications on <db>
+        each application snapshot is parsed in its own map
+        """
+        if line.find('Application Snapshot') > 0:
+            self.rsState = 'kv'
+            self.section = None
+            self.agentCount = 0
+            self.snapshot = {}
+            self.response.append(self.snapshot)
+        elif self.rsState == 'kv':
+            self._handleApplicationSnapshotKV(line, self.snapshot)
+    
+    def _handleApplicationSnapshotKV(self, line, snapshot):
+        if not line:
+            return
+        
+        k, v = self.parseKV(line)
+        if k:
+            if k == 'Agent process/thread ID':
+                if not self.agentOrdinals:
                     self.section = ["agent[{0}]".format(v)]
                     return
-                if k == 'Memory Pool Type':
-                    self.section.append(v.replace(" ", "_"))
-                    return
-                if self.section:
-                    k = ".".join(self.section) + '.' + k
-                if v and not v == 'Not Collected':
-                    self.response[k] = v
-            elif line.startswith('Workspace Information'):
-                self.section = ['wki']
-            elif line.startswith('Memory usage for application'):
-                self.section = ['mem']
-            elif line.startswith('  Memory usage for agent:'):
-                self.section.append("mem")
+                # the same keys for the agents of all the snapshots
+                self.section = ["agent[{0}]".format(self.agentCount)]
+                self.agentCount += 1
+                snapshot[self.section[0] + '.' + k] = v
+                return
+            if k == 'Memory Pool Type':
+                self.section.append(v.replace(" ", "_"))
+                return
+            if self.section:
+                k = ".".join(self.section) + '.' + k
+            if v and not v == 'Not Collected':
+                snapshot[k] = v
+        elif line.startswith('Workspace Information'):
+            self.section = ['wki']
+        elif line.startswith('Memory usage for application'):
+            self.section = ['mem']
+        elif line.startswith('  Memory usage for agent:'):
+            self.section.append("mem")
             
     def handleListDatabaseDirectoryExtractAliasLine(self, line):
         """
@@ -521,142 +2389,1919 @@ class DB2CliSubprocess(TextRequestResponseSubprocess):
         if k == 'Database alias':
             self.response.append(v)
         
-    def query(self, sql, rowWriter=None, rowReader=None):
+    def query(self, sql, rowWriter=None, rowReader=None, ttl=None, typed=False):
         """
         Execute query statements that returns a result set.
         If a rowWriter is provided (any object with a method writerow(<iterable>)
         then the rows of the result will be written to it.
         If a rowReader is provided then it will be provided in the
         result map instead of the 'rows' list. 
+        The result (without rowWriter/rowReader) is only cached when the
+        session has a cache and ttl is positive: it is then kept for ttl
+        seconds, by default (ttl None or 0) the query is always executed.
+        If typed is True the values of the rows (and of the rows written
+        to the rowWriter) are converted to python values by the
+        DisplayRowDecoder of the query (see rowDecoder) and the column
+        names and descriptions ('columns') come from its describe.
         """
+        if rowWriter is not None or rowReader is not None:
+            ttl = 0
+        decoder = None
+        if typed:
+            decoder = self.rowDecoder(sql)
+            if rowWriter is not None:
+                rowWriter = decoder.writer(rowWriter)
+        rs = self._cached(sql, lambda cmd: self.__query(cmd, rowWriter, rowReader), ttl)
+        return decoder.result(rs) if decoder is not None else rs
+    
+    def __query(self, sql, rowWriter=None, rowReader=None):
         try:
-            self.responseLineHandler = self.handleQueryOutputLine
-            self.rq_begin = True
-            self.row_size = None
-            self.last_line = None
-            self.rowWriter = rowWriter
-            self.returError = False
-            self.response = {'rows':rowReader if rowReader else [], 'info':[]}
-            return self.getResponse(sql + self.delimiter)
+            return self.getResponse(self._prepareQuery(sql, rowWriter, rowReader))
         finally:
-            self.responseParser = None
-            self.responseLineHandler = None
-            
-    def execStmt(self,
-            sql,
-            responseParser=None,
-            responseLineHandler=None,
-            useDelim=True,
-            returError=False,
-            responseObject=None
-        ):
+            self._resetRequest()
+    
+    # size of the describe LRU of rowDecoder
+    DESCRIBE_CACHE_SIZE = 256
+    
+    def rowDecoder(self, sql):
         """
-        Execute and db2 statement or command that does not return any result sets.
+        Return the DisplayRowDecoder of a query, the query is only
+        described the first time its (normalized) text is seen, the 
+        decoders of the last DESCRIBE_CACHE_SIZE queries are kept.
         """
-        try:
-            self.returError = returError
-            self.responseParser = responseParser
-            self.responseLineHandler = responseLineHandler
-            if not responseObject is None:
-                self.response = responseObject
-            else:
-                self.response = []
-            return self.getResponse(sql + (self.delimiter if useDelim else ""))
-        finally:
-            self.responseParser = None
-            self.responseLineHandler = None
-     
-    def execCmd(self,
-            sql,
-            responseParser=None,
-            responseLineHandler=None,
-            responseObject=None
-        ):
+        key = self._cacheKey(sql)
+        decoder = self.describeCache.pop(key, None)
+        if decoder is None:
+            decoder = DisplayRowDecoder(self.describe(sql))
+        self.describeCache[key] = decoder
+        while len(self.describeCache) > DB2CliSubprocess.DESCRIBE_CACHE_SIZE:
+            self.describeCache.popitem(last=False)
+        return decoder
+    
+    # the statements changing data or catalog (DDL, DML, utilities)
+    WRITE_STMT_REC = re.compile(
+        "^\s*(insert|update|delete|merge|create|alter|drop|rename|load|import|truncate)\\b", 
+        re.IGNORECASE
+    )
+    # the DDL statements that can change the columns of a query
+    DDL_STMT_REC = re.compile("^\s*(create|alter|drop|rename)\\b", re.IGNORECASE)
+    CONNECT_REC = re.compile("^\s*connect\s+(?:to\s+(\S+)|reset\\b)", re.IGNORECASE)
+    NORMALIZE_REC = re.compile("'(?:[^']|'')*'|\s+")
+    
+    def _cacheKey(self, cmd, private=False):
         """
-        Execute and db2 command that does not return any result sets.
+        Return the cache key of a command, the white spaces (not in 
+        string literals) are normalized, private results are only 
+        valid for this session
         """
-        return self.execStmt(sql,
-            responseParser,
-            responseLineHandler,
-            responseObject=responseObject
-        )
-     
-    def getMyApplHandle(self):
+        cmd = DB2CliSubprocess.NORMALIZE_REC.sub(
+            lambda m: " " if m.group(0)[0] != "'" else m.group(0), 
+            cmd
+        ).strip().rstrip(self.delimiter).strip()
+        return (self.instance, self.database, self.cacheScope if private else None, cmd)
+    
+    def _cacheable(self, ttl):
         """
-        Return the current application handle
+        Caching is opt-in: a session cache and a positive ttl are needed
         """
-        rs = self.query("values mon_get_application_handle")
-        rows = rs['rows']
-        return rows[0][0].strip() if rows else None
-        
-    def getSnapshotForApplication(self, *appl_handle):
+        return self.cache is not None and ttl is not None and ttl > 0
+    
+    def _cached(self, cmd, execute, ttl=None, private=False):
         """
-        Execute a db2 get snapshot for application agentid <appl-handle>
-        Parse the text output and present it in a map object containing 
-        db2 standard naming parameters as keys.
-        TODO: key set and name mappings
+        Return the cached result of cmd or execute(cmd) and cache it
+        for ttl seconds (see _cacheable)
         """
-        if len(appl_handle) == 0:
-            return None
-        rl = []
-        for ah in appl_handle:
-            self.rsState = 'start'
-            self.section = None
-            rl.append(self.execCmd(
-                "get snapshot for application agentid " + str(ah),
-                responseLineHandler=self.handleApplicationSnapshotLine,
-                responseObject={}
-            ))
-        return rl if len(rl) > 1 else rl[0]
-        
-    def getDatabaseAliases(self):
+        if not self._cacheable(ttl):
+            return execute(cmd)
+        key = self._cacheKey(cmd, private)
+        value = self.cache.get(key)
+        if value is ResultCache.MISS:
+            value = execute(cmd)
+            self.cache.put(key, value, ttl)
+        return _sharedResult(value)
+    
+    def _invalidateCache(self, *statements):
         """
-        Return all the known database aliases for this instance
+        Drop the cached results of the database if any statement changes
+        data or catalog (DDL, DML, utilities), the other statements 
+        (commit, set, connect, ...) keep them. The described queries are
+        only dropped by the DDL that can change their columns.
         """
-        self.section = None
-        self.response = []
-        return self.execCmd(
-            "list database directory",
-            responseLineHandler=self.handleListDatabaseDirectoryExtractAliasLine
-        )
-        
-    def connect(self, dbalias=None):
+        if any(DB2CliSubprocess.DDL_STMT_REC.match(s) for s in statements):
+            self.describeCache.clear()
+        if any(DB2CliSubprocess.WRITE_STMT_REC.match(s) for s in statements):
+            if self.cache is not None:
+                self.cache.invalidate(self.database, instance=self.instance)
+    
+    def _trackConnect(self, sql, result):
         """
-        Connect to a database alias or to the first database in the
-        database directory if no alias is provided
+        Follow the database of the session through the successful 
+        connect to/connect reset statements, the private cached results
+        of the previous connection are dropped
         """
-        if not dbalias:
-            aliases = self.getDatabaseAliases()
-            dbalias = aliases[0]
-        self.execStmt("connect to " + dbalias)
-    
-class DB2pdSubprocess(TextRequestResponseSubprocess):
-    """
-    Call a db2pd command then execute subsequent commands parse and 
-    return results to the caller.
-    """
-    ERROR_LINE_REC = re.compile("^Invalid\s+command.*$")
-    
-    def __init__(self):
-        TextRequestResponseSubprocess.__init__(self,
-            ["db2pd"],
-            self.__promptDetector,
-            self.__parseResponse
-        )
+        m = DB2CliSubprocess.CONNECT_REC.match(sql)
+        if m is None or isinstance(result, SQLError):
+            return
+        if self.cache is not None:
+            self.cache.invalidate(scope=self.cacheScope)
+        self.database = m.group(1).rstrip(self.delimiter) if m.group(1) else None
     
-    def testForErrorState(self, line):
+    def queryIter(self, sql, queueSize=1000, timeout=300):
         """
-        Detect if this line is the start of an error message as 
-        a SQLnnnnN ...pattern        
+        Execute a query and return an iterator (DB2CliQueryIterator) 
+        over its rows available as soon as they are parsed.
+        At most queueSize rows are buffered so the memory used is 
+        constant no matter how many rows are returned.
+        The timeout is the maximum time to wait for the next row.
         """
-        return DB2pdSubprocess.ERROR_LINE_REC.matches(line)
-
-    def __promptDetector(self, line):
-        return line == "db2pd> "
+        rowQueue = DB2CliQueryIterator(self, queueSize, timeout)
+        cmd = self._prepareQuery(sql, rowWriter=rowQueue)
+        rowQueue.response = self.response
+        self._beginRequest(cmd)
+        self.rowQueue = rowQueue
+        self._sendRequest(cmd)
+        return rowQueue
     
-    def getLatches(self):
+    def execMany(self, statements, stopOnError=False, window=None, timeout=300):
+        """
+        Pipelined execution of many statements or commands: up to window
+        statements (all of them by default) are written at once to the 
+        db2 stdin and the output is split back into one result per 
+        statement by counting the prompts.
+        Return a list with, for each statement, a map 
+        {'rows':[...], 'info':[...]} (plus 'names' and 'sizes' for queries)
+        or the SQLError returned by db2.
+        If stopOnError is True no more statements are sent after the
+        first error, the statements not sent get a None result. 
+        The statements already sent still run, use a smaller window to 
+        limit them.
+        The timeout is the maximum time to wait for the next result.
+        """
+        statements = list(statements)
+        if not statements:
+            return []
+        self._invalidateCache(*statements)
+        window = window if window else len(statements)
+        self._beginRequest(statements[0])
+        self.pipeCond = threading.Condition()
+        self.pipeResults = []
+        self.pipeStopped = False
+        self.pipeStopOnError = stopOnError
+        self.pipeStmts = statements
+        self.pipeSent = 0
+        self._preparePipelineStmt()
+        try:
+            while True:
+                # never write while holding the lock, the stdout thread 
+                # needs it to go on reading the db2 output
+                with self.pipeCond:
+                    if self.pipeStmts is None:
+                        break
+                    sent = self.pipeSent
+                    if not self.pipeStopped:
+                        self.pipeSent = min(len(statements), len(self.pipeResults) + window)
+                    if sent == self.pipeSent:
+                        done = len(self.pipeResults)
+                        self.pipeCond.wait(timeout)
+                        if done == len(self.pipeResults) and self.pipeStmts is not None:
+                            raise Exception("Timeout")
+                        continue
+                    batch = statements[sent:self.pipeSent]
+                self.proc.stdin.write("".join(
+                    [stmt + self.delimiter + os.linesep for stmt in batch]
+                ))
+                self.proc.stdin.flush()
+            results = self.pipeResults
+            for stmt, result in zip(statements, results):
+                self._trackConnect(stmt, result)
+            return results + [None] * (len(statements) - len(results))
+        finally:
+            self.pipeStmts = None
+            self._resetRequest()
+            
+    def _preparePipelineStmt(self):
+        self._prepareQuery(self.pipeStmts[len(self.pipeResults)])
+        self.responseLineHandler = self.handlePipelineOutputLine
+        self.returError = True
+        self.stdoutErr = False
+        self.error = []
+        
+    def _nextPipelineStmt(self):
+        """
+        Called by the stdout thread on each prompt while pipelining
+        """
+        with self.pipeCond:
+            result = self._requestResult()
+            self.pipeResults.append(result)
+            if isinstance(result, SQLError) and self.pipeStopOnError:
+                self.pipeStopped = True
+            done = len(self.pipeResults)
+            if done >= len(self.pipeStmts) or \
+              (self.pipeStopped and done >= self.pipeSent):
+                self.pipeStmts = None
+                self.endRequest = True
+                self.endRequestEvent.set()
+            else:
+                self._preparePipelineStmt()
+            self.pipeCond.notify_all()
+    
+    def handlePipelineOutputLine(self, line):
+        """
+        Query rows are parsed as by query() all other lines are kept in 'info'
+        """
+        if self.rq_begin:
+            self._parseQueryHeaderLine(line)
+            if self.rq_begin:
+                self.response['info'].append(line)
+            elif self.response['info']:
+                # the column names line
+                self.response['info'].pop()
+        else:
+            rec = self._splitRow(line)
+            if rec is not None:
+                self.response['rows'].append(rec)
+            else:
+                self.response['info'].append(line)
+    
+    UTILITY_COUNT_REC = re.compile("^\s*Number of rows (\w+)\s*=\s*(\d+)")
+    
+    def insertMany(self,
+            table,
+            columns,
+            rows,
+            method=None,
+            bulkThreshold=10000,
+            chunkSize=1000,
+            useFifo=True,
+            options=None
+        ):
+        """
+        Insert many rows (any iterable of sequences of python values) 
+        into table (columns is the list of the column names).
+        The method is chosen by volume if not provided:
+        - 'values' (up to bulkThreshold rows): multi-row INSERT ... VALUES
+          statements of chunkSize rows sent one after the other, the
+          first failing statement raises its SQLError (with the count of
+          the rows already inserted in its 'inserted' attribute) and the
+          next ones are not sent
+        - 'import' (more rows): the rows are streamed into a named pipe
+          (or a temporary file if useFifo is False) in DEL format and 
+          loaded with IMPORT FROM ... OF DEL INSERT INTO ...
+        - 'load' same as 'import' but using LOAD, the file is read by the
+          db2 server so this only works on the db2 server host.
+        The options are inserted before INSERT INTO in the IMPORT/LOAD
+        command (e.g. "COMMITCOUNT 10000").
+        Return a map with the method, the row counts parsed from the db2 
+        messages ('inserted', 'read', 'rejected', ...), 'seconds' and 
+        'rowsPerSecond'.
+        """
+        stime = time.time()
+        rows = iter(rows)
+        if not method:
+            head = list(itertools.islice(rows, bulkThreshold + 1))
+            method = 'values' if len(head) <= bulkThreshold else 'import'
+            rows = itertools.chain(head, rows)
+        target = "{0} ({1})".format(table, ",".join(columns))
+        
+        if method == 'values':
+            result = self._insertValues(target, rows, chunkSize)
+        else:
+            result = self._insertUtility(method, target, rows, useFifo, options)
+        result['method'] = method
+        result['seconds'] = time.time() - stime
+        result['rowsPerSecond'] = result.get('inserted', 0) / result['seconds'] \
+            if result['seconds'] > 0 else None
+        return result
+    
+    def _insertValues(self, target, rows, chunkSize):
+        stmts = []
+        counts = []
+        while True:
+            chunk = list(itertools.islice(rows, chunkSize))
+            if not chunk:
+                break
+            stmts.append("INSERT INTO {0} VALUES {1}".format(target, ",".join(
+                ["(" + ",".join([sqlLiteral(v) for v in row]) + ")" for row in chunk]
+            )))
+            counts.append(len(chunk))
+        # one statement at a time so no chunk is sent after a failed one
+        results = self.execMany(stmts, stopOnError=True, window=1)
+        inserted = 0
+        for count, result in zip(counts, results):
+            if isinstance(result, SQLError):
+                result.inserted = inserted
+                raise result
+            if result is not None:
+                inserted += count
+        return {'inserted':inserted, 'statements':len(stmts)}
+    
+    def _insertUtility(self, method, target, rows, useFifo, options):
+        tmpdir = tempfile.mkdtemp(prefix="db2cli")
+        fname = os.path.join(tmpdir, "rows.del")
+        writer = None
+        try:
+            if useFifo:
+                os.mkfifo(fname)
+                writer = threading.Thread(
+                    target=self._writeDelFile, args=(fname, rows),
+                    name=self.name + ".delwriter"
+                )
+                writer.daemon = True
+                writer.start()
+            else:
+                self._writeDelFile(fname, rows)
+            cmd = "{0} FROM {1} OF DEL {2}INSERT INTO {3}".format(
+                method.upper(), fname, options + " " if options else "", target
+            )
+            rs = self.execStmt(cmd, returError=True)
+        finally:
+            if writer:
+                if writer.is_alive():
+                    # db2 never opened the pipe, release the writer
+                    try:
+                        os.close(os.open(fname, os.O_RDONLY | os.O_NONBLOCK))
+                    except OSError as e:
+                        pass
+                writer.join(10)
+            shutil.rmtree(tmpdir, True)
+        
+        # the utilities report their progress as SQLnnnnN messages 
+        # so a successful run is detected by its row counts summary
+        lines = list(rs.args) if isinstance(rs, SQLError) else rs
+        result = {'messages':lines}
+        for line in lines:
+            m = DB2CliSubprocess.UTILITY_COUNT_REC.match(line)
+            if m:
+                result[m.group(1)] = int(m.group(2))
+        if not 'read' in result and isinstance(rs, SQLError):
+            raise rs
+        if 'loaded' in result and not 'inserted' in result:
+            result['inserted'] = result['loaded']
+        return result
+    
+    def _writeDelFile(self, fname, rows):
+        try:
+            f = open(fname, "w")
+            try:
+                buf = []
+                for row in rows:
+                    buf.append(",".join([delField(v) for v in row]))
+                    if len(buf) >= 1000:
+                        buf.append("")
+                        f.write("\n".join(buf))
+                        buf = []
+                if buf:
+                    buf.append("")
+                    f.write("\n".join(buf))
+            finally:
+                f.close()
+        except (IOError, OSError) as e:
+            LGR.debug("del-writer-err:{0}".format(traceback.format_exc()))
+    
+    DESCRIBE_LINE_REC = re.compile(
+        "^\s*(\d+)\s+(\S+(?:\s\S+)*?)\s+(\d+(?:,\s*\d+)?)\s+(.*\S)\s+(\d+)\s*$"
+    )
+    EXPORT_COUNT_REC = re.compile("^\s*Number of rows exported:\s*(\d+)")
+    
+    def describe(self, sql):
+        """
+        Return the result set columns of a query as a list of maps
+        {'name', 'type', 'sqlType', 'length', 'nullable'}
+        """
+        self.describeHeader = False
+        return self.execCmd(
+            "describe " + sql,
+            responseLineHandler=self.handleDescribeOutputLine
+        )
+        
+    def handleDescribeOutputLine(self, line):
+        """
+        Handle the output of a db2 describe <query>
+        """
+        if not self.describeHeader:
+            self.describeHeader = line.strip().startswith("-")
+            return
+        m = DB2CliSubprocess.DESCRIBE_LINE_REC.match(line)
+        if m:
+            sqlType = int(m.group(1))
+            self.response.append({
+                'name':m.group(4),
+                'type':m.group(2),
+                'sqlType':sqlType,
+                'length':m.group(3),
+                'nullable':sqlType % 2 == 1
+            })
+    
+    def _prepareExport(self, sql, writerow, onEnd=None):
+        """
+        Describe the query, create the named pipe and start its reader,
+        return the export command, the result map and the reader.
+        """
+        columns = self.describe(sql)
+        rs = {'names':[c['name'] for c in columns], 'columns':columns, 'info':[]}
+        tmpdir = tempfile.mkdtemp(prefix="db2cli")
+        fname = os.path.join(tmpdir, "rows.del")
+        os.mkfifo(fname)
+        reader = DelFileReader(
+            fname,
+            [DB2_TYPE_CONVERTERS.get(c['type']) for c in columns],
+            writerow,
+            onEnd,
+            name=self.name + ".delreader"
+        )
+        reader.start()
+        return "EXPORT TO {0} OF DEL {1}".format(fname, sql), rs, reader
+    
+    def _releaseExport(self, reader, timeout=None):
+        """
+        Release and wait (up to timeout seconds) for the pipe reader
+        then remove the named pipe directory
+        """
+        try:
+            if reader.is_alive():
+                reader.release()
+            reader.join(timeout)
+            if reader.is_alive():
+                LGR.debug("del-reader-timeout:{0}".format(reader.fname))
+        finally:
+            shutil.rmtree(os.path.dirname(reader.fname), True)
+    
+    def _exportResult(self, result, rs):
+        """
+        Check the result of the export
+        """
+        # the export reports its progress as SQLnnnnN messages
+        lines = list(result.args) if isinstance(result, SQLError) else result
+        rs['info'] = lines
+        for line in lines:
+            m = DB2CliSubprocess.EXPORT_COUNT_REC.match(line)
+            if m:
+                rs['count'] = int(m.group(1))
+        if not 'count' in rs and isinstance(result, SQLError):
+            raise result
+        return rs
+    
+    def queryExport(self, sql, rowWriter=None, rowReader=None, timeout=300):
+        """
+        Execute a query as an EXPORT TO <named pipe> OF DEL and parse
+        the delimited rows instead of the formatted (padded, truncated) 
+        query output. The columns are described first and the numeric 
+        values are converted to python numbers, NULLs are None.
+        The rowWriter and rowReader are used as by query(), the result
+        map also contains the column descriptions as 'columns' and the
+        exported rows count.
+        """
+        rows = rowReader if rowReader is not None else []
+        cmd, rs, reader = self._prepareExport(
+            sql,
+            rowWriter.writerow if rowWriter is not None else rows.append
+        )
+        rs['rows'] = rows
+        try:
+            result = self.execStmt(cmd, returError=True, timeout=timeout)
+        finally:
+            self._releaseExport(reader, timeout)
+        return self._exportResult(result, rs)
+        
+    def queryExportIter(self, sql, queueSize=1000, timeout=300):
+        """
+        Same as queryExport but return an iterator (DB2CliQueryIterator)
+        over the rows as soon as they are exported. 
+        """
+        rowQueue = DB2CliQueryIterator(self, queueSize, timeout)
+        cmd, rs, reader = self._prepareExport(sql, rowQueue.writerow, rowQueue.end)
+        rowQueue.response = rs
+        
+        def finish(raiseError):
+            try:
+                if not self.endRequestEvent.wait(timeout):
+                    raise Exception("Timeout")
+                if not self.endRequest:
+                    raise Exception("{0} process ended".format(self.name))
+                result = self._requestResult()
+            finally:
+                self._resetRequest()
+                self._releaseExport(reader, timeout)
+            try:
+                self._exportResult(result, rs)
+            except SQLError as e:
+                if raiseError:
+                    raise
+        
+        rowQueue.finisher = finish
+        cmd = self._prepareStmt(cmd, returError=True)
+        self._beginRequest(cmd)
+        self._sendRequest(cmd)
+        return rowQueue
+    
+    def _endQueryIter(self):
+        self.rowQueue = None
+        self.rowWriter = None
+        self._resetRequest()
+    
+    def _prepareQuery(self, sql, rowWriter=None, rowReader=None):
+        """
+        Set the query parsing state and return the command to send
+        """
+        self.responseLineHandler = self.handleQueryOutputLine
+        self.rq_begin = True
+        self.row_size = None
+        self.last_line = None
+        self.rowWriter = rowWriter
+        self.returError = False
+        self.response = {'rows':rowReader if rowReader is not None else [], 'info':[]}
+        return sql + self.delimiter
+    
+    def queryColumns(self, sql, batchSize=10000, fixedWidthText=False, typed=True):
+        """
+        Execute a query and return its result by columns instead of rows:
+        {'names':[...], 'sizes':[...], 'columns':[...], 'count':<rows>, 'info':[...]}
+        The numeric columns are returned as numpy int64 or float64 arrays
+        (NULL values as nan) and the other columns as object arrays of
+        strings or, if fixedWidthText is True, as fixed width byte arrays.
+        Without numpy the columns are lists (numbers converted, NULL as None).
+        The rows are parsed in batches of batchSize lines. 
+        The numeric columns are the ones of a numeric type in the cached
+        describe of the query (see rowDecoder), if typed is False they 
+        are guessed from the values (see ColumnBatchParser).
+        """
+        types = [c['type'] for c in self.rowDecoder(sql).columns] if typed else None
+        try:
+            return self.getResponse(self._prepareQueryColumns(
+                sql, batchSize, fixedWidthText, types
+            ))
+        finally:
+            self._resetRequest()
+    
+    def _prepareQueryColumns(self, sql, batchSize=10000, fixedWidthText=False, types=None):
+        cmd = self._prepareQuery(sql)
+        self.responseLineHandler = self.handleColumnarQueryOutputLine
+        self.responseParser = self._columnarResult
+        self.response = {'columns':[], 'count':0, 'info':[]}
+        self.columnBatchSize = batchSize
+        self.fixedWidthText = fixedWidthText
+        self.columnTypes = types
+        self.columnBatch = []
+        self.columnParser = None
+        return cmd
+    
+    # separator of the columns and NULL marker of queryDelimited
+    FIELD_SEPARATOR = "\x1f"
+    NULL_MARKER = "\x1e"
+    ISOLATION_REC = re.compile(
+        "\s+(with\s+(?:ur|cs|rs|rr)|for\s+(?:read|fetch)\s+only)\s*$", 
+        re.IGNORECASE
+    )
+    
+    def queryDelimited(self, sql, rowWriter=None, rowReader=None, ttl=None, typed=False):
+        """
+        Same as query() but the query is executed as one column with
+        the values separated by CHR(31) and NULLs as CHR(30):
+        
+            SELECT COALESCE(VARCHAR(Q.C0), CHR(30)) || CHR(31) || ... 
+            FROM (<sql>) AS Q (C0, ...) ORDER BY ORDER OF Q
+        
+        so each row is parsed with a single split instead of the column
+        widths (no truncated columns, no rows lost to multibyte data).
+        The column names and descriptions ('columns') come from the 
+        cached describe of the query (see rowDecoder).
+        The concatenated row must fit in a VARCHAR(32672), queries
+        starting with a common table expression (WITH) are executed by 
+        query().
+        """
+        decoder = self.rowDecoder(sql)
+        cmd = self._delimitedQuery(sql, decoder.columns)
+        if cmd is None:
+            return self.query(sql, rowWriter, rowReader, ttl, typed)
+        if rowWriter is not None or rowReader is not None:
+            ttl = 0
+        if typed and rowWriter is not None:
+            rowWriter = decoder.writer(rowWriter, None)
+        def execute(cmd):
+            try:
+                cmd = self._prepareQuery(cmd, rowWriter, rowReader)
+                self.responseLineHandler = self.handleDelimitedQueryOutputLine
+                rs = self.getResponse(cmd)
+                rs['names'] = decoder.names
+                rs['columns'] = decoder.columns
+                return rs
+            finally:
+                self._resetRequest()
+        rs = self._cached(cmd, execute, ttl)
+        return decoder.result(rs, None) if typed else rs
+    
+    def _delimitedQuery(self, sql, columns):
+        """
+        Return the one column query of queryDelimited, None if sql
+        can not be used as a nested table expression
+        """
+        sql = sql.strip().rstrip(self.delimiter).strip()
+        if not columns or re.match("^with\\b", sql, re.IGNORECASE):
+            return None
+        suffix = ""
+        m = DB2CliSubprocess.ISOLATION_REC.search(sql)
+        if m:
+            sql = sql[:m.start()]
+            suffix = " " + m.group(1)
+        names = ["C{0}".format(i) for i in range(len(columns))]
+        fields = []
+        for name, c in zip(names, columns):
+            if c['type'] in ('BLOB', 'BINARY', 'VARBINARY'):
+                value = "HEX(Q.{0})".format(name)
+            elif c['type'] in ('DATE', 'TIME'):
+                value = "CHAR(Q.{0}, ISO)".format(name)
+            elif c['type'] == 'XML':
+                value = "XMLSERIALIZE(Q.{0} AS VARCHAR(32672))".format(name)
+            else:
+                value = "VARCHAR(Q.{0})".format(name)
+            fields.append("COALESCE({0}, CHR(30)) || CHR(31)".format(value))
+        return "SELECT {0} FROM ({1}) AS Q ({2}) ORDER BY ORDER OF Q{3}".format(
+            " || ".join(fields), sql, ", ".join(names), suffix
+        )
+    
+    def handleDelimitedQueryOutputLine(self, line):
+        """
+        Handle the lines returned by a queryDelimited query, the rows
+        end with the separator, the other lines are kept in 'info'
+        """
+        if self.rq_begin:
+            if DB2CliSubprocess.QUERY_HDR_REC.match(line):
+                self.rq_begin = False
+            return
+        end = line.rfind(DB2CliSubprocess.FIELD_SEPARATOR)
+        if end < 0:
+            if line:
+                self.response['info'].append(line)
+            return
+        rec = line[:end].split(DB2CliSubprocess.FIELD_SEPARATOR)
+        if DB2CliSubprocess.NULL_MARKER in line:
+            NULL = DB2CliSubprocess.NULL_MARKER
+            rec = [None if v == NULL else v for v in rec]
+        if self.rowWriter is not None:
+            self.rowWriter.writerow(rec)
+        else:
+            self.response['rows'].append(rec)
+    
+    def _resetRequest(self):
+        if self.requestMetrics is not None:
+            self._endRequestMetrics()
+        self.responseParser = None
+        self.responseLineHandler = None
+            
+    def execStmt(self,
+            sql,
+            responseParser=None,
+            responseLineHandler=None,
+            useDelim=True,
+            returError=False,
+            responseObject=None,
+            timeout=None
+        ):
+        """
+        Execute and db2 statement or command that does not return any result sets.
+        The cached results of the database are dropped if the statement
+        may change the data or the catalog, a connect statement switches
+        the database of the session.
+        The timeout defaults to requestTimeout.
+        """
+        try:
+            result = self.getResponse(self._prepareStmt(sql,
+                responseParser,
+                responseLineHandler,
+                useDelim,
+                returError,
+                responseObject
+            ), timeout)
+        finally:
+            self._resetRequest()
+            self._invalidateCache(sql)
+        self._trackConnect(sql, result)
+        return result
+    
+    def _prepareStmt(self,
+            sql,
+            responseParser=None,
+            responseLineHandler=None,
+            useDelim=True,
+            returError=False,
+            responseObject=None
+        ):
+        """
+        Set the statement parsing state and return the command to send
+        """
+        self.returError = returError
+        self.responseParser = responseParser
+        self.responseLineHandler = responseLineHandler
+        if not responseObject is None:
+            self.response = responseObject
+        else:
+            self.response = []
+        return sql + (self.delimiter if useDelim else "")
+     
+    def execCmd(self,
+            sql,
+            responseParser=None,
+            responseLineHandler=None,
+            responseObject=None
+        ):
+        """
+        Execute and db2 command that does not return any result sets.
+        """
+        return self.execStmt(sql,
+            responseParser,
+            responseLineHandler,
+            responseObject=responseObject
+        )
+     
+    def getMyApplHandle(self, ttl=None):
+        """
+        Return the current application handle (cached for ttl seconds
+        if positive)
+        """
+        return self._cached(
+            "values mon_get_application_handle",
+            lambda cmd: self._applHandle(self.__query(cmd)),
+            ttl,
+            private=True
+        )
+    
+    def _applHandle(self, rs):
+        rows = rs['rows']
+        return rows[0][0].strip() if rows else None
+        
+    def getSnapshotForApplication(self, *appl_handle):
+        """
+        Execute a db2 get snapshot for application agentid <appl-handle>
+        Parse the text output and present it in a map object containing 
+        db2 standard naming parameters as keys.
+        TODO: key set and name mappings
+        """
+        if len(appl_handle) == 0:
+            return None
+        rl = []
+        for ah in appl_handle:
+            rl.append(self.execCmd(
+                self._prepareApplicationSnapshot(ah),
+                responseLineHandler=self.handleApplicationSnapshotLine,
+                responseObject={}
+            ))
+        return rl if len(rl) > 1 else rl[0]
+    
+    def getSnapshotForApplications(self, *appl_handle, **kw):
+        """
+        Execute a single db2 get snapshot for applications on <database>
+        (the connected database by default) and return a map of the 
+        application snapshots keyed by application handle. When handles
+        are provided only their snapshots are returned.
+        Much faster than getSnapshotForApplication for many handles.
+        With compact=True the snapshots are CompactMapping objects
+        sharing their keys and repeated values (see snapshotCompactor),
+        the agent sections are keyed by position (agent[0], ...) instead
+        of thread id (agent[0].Agent process/thread ID).
+        """
+        return self.execCmd(
+            self._prepareApplicationsSnapshot(kw.get('database'), kw.get('compact')),
+            responseParser=self._applicationSnapshots(appl_handle, kw.get('compact')),
+            responseLineHandler=self.handleApplicationsSnapshotLine
+        )
+    
+    def _prepareApplicationsSnapshot(self, database=None, compact=False):
+        """
+        Reset the snapshots parsing state and return the snapshot command
+        """
+        self.rsState = 'start'
+        self.section = None
+        self.snapshot = None
+        self.agentOrdinals = compact
+        database = database or self.database
+        if not database:
+            raise Exception("no database: pass database= or connect first")
+        return "get snapshot for applications on " + database
+    
+    def _applicationSnapshots(self, appl_handle, compact=False):
+        """
+        Return a response parser mapping the application snapshots 
+        by application handle (only the appl_handle ones if any)
+        """
+        wanted = set(str(ah) for ah in appl_handle)
+        if compact and self.snapshotCompactor is None:
+            self.snapshotCompactor = MappingCompactor()
+        compactor = self.snapshotCompactor if compact else None
+        def parse(snapshots):
+            rs = {}
+            for snapshot in snapshots:
+                ah = snapshot.get('Application handle')
+                if ah and (not wanted or ah in wanted):
+                    rs[ah] = compactor.compact(snapshot) if compactor else snapshot
+            return rs
+        return parse
+    
+    def _prepareApplicationSnapshot(self, appl_handle):
+        """
+        Reset the snapshot parsing state and return the snapshot command
+        """
+        self.rsState = 'start'
+        self.section = None
+        self.agentOrdinals = False
+        return "get snapshot for application agentid " + str(appl_handle)
+        
+    def getDatabaseAliases(self, ttl=None):
+        """
+        Return all the known database aliases for this instance (cached
+        for ttl seconds if positive)
+        """
+        self.section = None
+        self.response = []
+        return self._cached("list database directory", lambda cmd: self.execCmd(
+            cmd,
+            responseLineHandler=self.handleListDatabaseDirectoryExtractAliasLine
+        ), ttl)
+        
+    def connect(self, dbalias=None):
+        """
+        Connect to a database alias or to the first database in the
+        database directory if no alias is provided
+        """
+        if not dbalias:
+            aliases = self.getDatabaseAliases()
+            dbalias = aliases[0]
+        self.execStmt("connect to " + dbalias)
+    
+    def interrupt(self):
+        """
+        Interrupt the running statement as Ctrl-C does, db2 answers with
+        a SQL0952N error then the prompt
+        """
+        if self.isAlive():
+            self.proc.send_signal(signal.SIGINT)
+    
+    def shutdown(self, timeout=5):
+        """
+        Send a terminate command (ending the db2 back-end process too)
+        then end the db2 child process.
+        """
+        if self.cache is not None:
+            self.cache.invalidate(scope=self.cacheScope)
+        try:
+            if self.isAlive() and self.endRequest:
+                self.proc.stdin.write("terminate" + self.delimiter)
+                self.proc.stdin.write(os.linesep)
+                self.proc.stdin.flush()
+        except Exception as e:
+            LGR.debug("terminate-err:{0}".format(traceback.format_exc()))
+        TextRequestResponseSubprocess.shutdown(self, timeout)
+    
+class DB2CliSubprocessPool:
+    """
+    A thread safe pool of DB2CliSubprocess sessions connected to the 
+    same database alias (use one pool per database alias).
+    At least minSize sessions are spawned and connected upfront
+    and the pool grows on demand up to maxSize sessions.
+    A session must be used by one thread at the time, get one with
+    checkout() and give it back with checkin() or use the session()
+    context manager:
+    
+        with pool.session() as db:
+            rs = db.query("select ...")
+    
+    Dead sessions (isAlive() is false) and sessions returned in the 
+    middle of a request (e.g. after a timeout) are discarded and replaced
+    on demand. Sessions idle for more than maxIdle seconds are 
+    ended while the pool has more than minSize sessions.
+    A ResultCache provided as cache is shared by all the sessions.
+    """
+    def __init__(self,
+            database=None,
+            minSize=1,
+            maxSize=10,
+            maxIdle=300,
+            delimiter="@",
+            sessionFactory=None,
+            cache=None
+        ):
+        self.database = database
+        self.cache = cache
+        self.minSize = minSize
+        self.maxSize = max(minSize, maxSize)
+        self.maxIdle = maxIdle
+        self.delimiter = delimiter
+        self.sessionFactory = sessionFactory
+        self.cond = threading.Condition()
+        # idle sessions as (session, last checkin time), most recent last
+        self.idle = []
+        self.size = 0
+        self.closed = False
+        try:
+            for i in range(minSize):
+                self.idle.append((self._newSession(), time.time()))
+                self.size += 1
+        except Exception:
+            # do not leak the sessions already started
+            self._discard([session for session, t in self.idle])
+            self.idle = []
+            self.size = 0
+            raise
+    
+    def _newSession(self):
+        """
+        Spawn and connect a new session, override or provide 
+        a sessionFactory(database) to customize the sessions.
+        """
+        if self.sessionFactory:
+            session = self.sessionFactory(self.database)
+        else:
+            session = DB2CliSubprocess(self.database, self.delimiter)
+        if self.cache is not None:
+            session.cache = self.cache
+        return session
+    
+    def _discard(self, sessions):
+        for session in sessions:
+            try:
+                session.shutdown()
+            except Exception as e:
+                LGR.debug("pool-discard-err:{0}".format(traceback.format_exc()))
+    
+    def _evictIdle(self):
+        """
+        Remove (while holding the lock) and return the sessions 
+        idle for longer than maxIdle seconds keeping at least minSize 
+        sessions in the pool.
+        """
+        evicted = []
+        if self.maxIdle is None:
+            return evicted
+        limit = time.time() - self.maxIdle
+        while self.idle and self.size > self.minSize and self.idle[0][1] < limit:
+            evicted.append(self.idle.pop(0)[0])
+            self.size -= 1
+        return evicted
+    
+    def evictIdle(self):
+        """
+        End the sessions idle for more than maxIdle seconds. 
+        This is also done on every checkin.
+        """
+        with self.cond:
+            evicted = self._evictIdle()
+        self._discard(evicted)
+        return len(evicted)
+    
+    def checkout(self, timeout=None):
+        """
+        Get a live session from the pool, spawn a new one if none 
+        is idle and the pool is not at maxSize or wait up to
+        timeout seconds (forever if None) for a session to be returned.
+        """
+        etime = None if timeout is None else time.time() + timeout
+        dead = []
+        try:
+            with self.cond:
+                while True:
+                    if self.closed:
+                        raise Exception("The {0} session pool is closed".format(self.database))
+                    while self.idle:
+                        session = self.idle.pop()[0]
+                        if session.isAlive():
+                            return session
+                        self.size -= 1
+                        dead.append(session)
+                    if self.size < self.maxSize:
+                        self.size += 1
+                        break
+                    if etime is None:
+                        self.cond.wait()
+                    else:
+                        remaining = etime - time.time()
+                        if remaining <= 0:
+                            raise Exception("Timeout")
+                        self.cond.wait(remaining)
+        finally:
+            self._discard(dead)
+        
+        try:
+            return self._newSession()
+        except:
+            with self.cond:
+                self.size -= 1
+                self.cond.notify()
+            raise
+    
+    def checkin(self, session):
+        """
+        Return a session to the pool
+        """
+        healthy = session.isAlive() and session.endRequest
+        discard = []
+        with self.cond:
+            if healthy and not self.closed:
+                self.idle.append((session, time.time()))
+            else:
+                self.size -= 1
+                discard.append(session)
+            discard.extend(self._evictIdle())
+            self.cond.notify()
+        self._discard(discard)
+    
+    @contextlib.contextmanager
+    def session(self, timeout=None):
+        """
+        Context manager for a checkout(timeout) followed by a checkin
+        """
+        session = self.checkout(timeout)
+        try:
+            yield session
+        finally:
+            self.checkin(session)
+    
+    def close(self):
+        """
+        End all the idle sessions, the sessions checked out 
+        are ended when returned to the pool.
+        """
+        with self.cond:
+            self.closed = True
+            idle = [x[0] for x in self.idle]
+            self.size -= len(idle)
+            self.idle = []
+            self.cond.notify_all()
+        self._discard(idle)
+
+class DB2FanOutExecutor:
+    """
+    Run the same query (or function) on many databases in parallel.
+    A target is an (instance, database alias) pair, the instance None
+    is the current DB2INSTANCE. Without targets all the aliases of
+    the database directory of each instance are used.
+    The targets are run by up to workers threads on sessions checked out
+    of one DB2CliSubprocessPool per instance (the sessions are kept for
+    the next runs until close()). A target still running after timeout
+    seconds is reported as timed out and its session is killed, so one
+    hung database does not block the other ones:
+
+        fanout = DB2FanOutExecutor(instances=["db2inst1", "db2inst2"], timeout=60)
+        rs = fanout.query("select count(*) from syscat.tables")
+        for row in rs['rows']:
+            print(row)  # [instance, database, <query columns>...]
+        for target in rs['targets']:
+            print(target['instance'], target['database'], target['status'])
+    """
+    def __init__(self,
+            targets=None,
+            instances=None,
+            workers=8,
+            timeout=300,
+            delimiter="@",
+            cache=None
+        ):
+        self.targets = [self._target(t) for t in targets] if targets else None
+        self.instances = list(instances) if instances else [None]
+        self.workers = workers
+        self.timeout = timeout
+        self.delimiter = delimiter
+        self.cache = cache
+        # instance -> DB2CliSubprocessPool
+        self.pools = {}
+        self.lock = threading.Lock()
+
+    def _target(self, target):
+        """
+        Return the (instance, database) pair of an alias or a pair
+        """
+        if isinstance(target, (tuple, list)):
+            return tuple(target)
+        return (None, target)
+
+    def _pool(self, instance):
+        with self.lock:
+            pool = self.pools.get(instance)
+            if pool is None:
+                pool = DB2CliSubprocessPool(None,
+                    minSize=0,
+                    maxSize=self.workers,
+                    delimiter=self.delimiter,
+                    sessionFactory=lambda database: DB2CliSubprocess(
+                        database, self.delimiter, instance=instance
+                    ),
+                    cache=self.cache
+                )
+                self.pools[instance] = pool
+            return pool
+
+    def discoverTargets(self, timeout=None):
+        """
+        Return the (instance, database alias) targets of the database
+        directories of the instances (also used as default targets)
+        """
+        results = self.run(
+            lambda session, target: session.getDatabaseAliases(),
+            [(instance, None) for instance in self.instances],
+            timeout
+        )
+        targets = []
+        for r in results:
+            if r['status'] != 'ok':
+                LGR.debug("fanout-directory-err:{0}:{1}".format(r['instance'], r['error']))
+                continue
+            targets.extend((r['instance'], alias) for alias in r['result'])
+        self.targets = targets
+        return targets
+
+    def run(self, function, targets=None, timeout=None):
+        """
+        Call function(session, target) for each target with a session
+        connected to the target database. Return one record per target
+        (in the targets order) with the instance, database, status
+        ('ok', 'error' or 'timeout'), result, error and elapsed seconds.
+        """
+        if targets is None:
+            targets = self.targets if self.targets is not None else self.discoverTargets(timeout)
+        timeout = self.timeout if timeout is None else timeout
+        records = [{
+                'instance':instance,
+                'database':database,
+                'status':'pending',
+                'result':None,
+                'error':None,
+                'elapsed':None,
+                'started':None,
+                'session':None
+            } for instance, database in (self._target(t) for t in targets)
+        ]
+        if not records:
+            return records
+
+        queue = Queue.Queue()
+        for r in records:
+            queue.put(r)
+        cond = threading.Condition()
+        for i in range(min(self.workers, len(records))):
+            worker = threading.Thread(
+                target=self._worker,
+                args=(function, queue, cond),
+                name="fanout.worker{0}".format(i)
+            )
+            worker.daemon = True
+            worker.start()
+
+        with cond:
+            while True:
+                now = time.time()
+                wait = None
+                done = True
+                for r in records:
+                    if r['status'] == 'pending':
+                        done = False
+                    elif r['status'] == 'running':
+                        done = False
+                        if timeout is None:
+                            continue
+                        remaining = r['started'] + timeout - now
+                        if remaining <= 0:
+                            self._expire(r, now)
+                        elif wait is None or remaining < wait:
+                            wait = remaining
+                if done:
+                    break
+                cond.wait(wait)
+        for r in records:
+            del r['session']
+            del r['started']
+        return records
+
+    def _worker(self, function, queue, cond):
+        while True:
+            try:
+                r = queue.get_nowait()
+            except Queue.Empty:
+                return
+            pool = None
+            session = None
+            try:
+                pool = self._pool(r['instance'])
+                session = pool.checkout()
+                # the timeout starts once the target has a session
+                with cond:
+                    r['status'] = 'running'
+                    r['started'] = time.time()
+                    r['session'] = session
+                    cond.notify_all()
+                if r['database'] and session.database != r['database']:
+                    session.connect(r['database'])
+                result = function(session, r)
+                status, error = 'ok', None
+            except Exception as e:
+                LGR.debug("fanout-err:{0}".format(traceback.format_exc()))
+                result, status, error = None, 'error', e
+            with cond:
+                # a timed out target keeps its timeout status
+                if r['status'] in ('pending', 'running'):
+                    r['status'] = status
+                    r['result'] = result
+                    r['error'] = error
+                    r['elapsed'] = time.time() - r['started'] if r['started'] else None
+                # the session is not expired any more once released
+                r['session'] = None
+                cond.notify_all()
+            if session is not None:
+                pool.checkin(session)
+
+    def _expire(self, r, now):
+        """
+        Mark a running target as timed out and kill the session of its
+        request (called holding the condition), the worker waiting for
+        the session response is released. A target already completed
+        by its worker is left unchanged.
+        """
+        session = r['session']
+        if r['status'] != 'running' or session is None:
+            return
+        r['status'] = 'timeout'
+        r['error'] = Exception("Timeout")
+        r['elapsed'] = now - r['started']
+        try:
+            session.proc.kill()
+        except Exception as e:
+            LGR.debug("fanout-kill-err:{0}".format(traceback.format_exc()))
+        session.endRequest = False
+        session.error = ["Timeout"]
+        session.endRequestEvent.set()
+
+    def query(self, sql, targets=None, timeout=None):
+        """
+        Run a query on the targets and merge the rows in one result set
+        with the INSTANCE and DATABASE columns first. The result
+        'targets' has the status of each target: the result set is
+        partial if a target failed or timed out.
+        """
+        records = self.run(lambda session, target: session.query(sql), targets, timeout)
+        rs = {'names':None, 'sizes':None, 'rows':[], 'targets':records}
+        for r in records:
+            result = r['result']
+            if r['status'] != 'ok' or not isinstance(result, dict):
+                continue
+            if rs['names'] is None and 'names' in result:
+                rs['names'] = ['INSTANCE', 'DATABASE'] + result['names']
+                rs['sizes'] = [None, None] + result.get('sizes', [])
+            prefix = [r['instance'], r['database']]
+            rs['rows'].extend(prefix + row for row in result['rows'])
+            r['rows'] = len(result['rows'])
+            r['result'] = None
+        return rs
+
+    def execCmd(self, cmd, targets=None, timeout=None):
+        """
+        Execute a command on the targets, return the target records
+        with the command output lines as result
+        """
+        return self.run(lambda session, target: session.execCmd(cmd), targets, timeout)
+
+    def close(self):
+        with self.lock:
+            pools = list(self.pools.values())
+            self.pools = {}
+        for pool in pools:
+            pool.close()
+
+class DB2SessionSupervisor:
+    """
+    Keep an active session connected to a database alias and standby
+    sessions already started and connected (by a background thread)
+    ready to replace it. When a request times out or the db2 process
+    dies the active session is swapped with a standby one and the bad
+    session is retired in the background: with interrupt=True the
+    running statement is interrupted (SIGINT) and the session is reused
+    as a standby one if the prompt comes back within drainTimeout
+    seconds, otherwise it is killed.
+    The error of the failed request is still raised, the next requests
+    run on the new active session. Like a session, a supervisor must
+    be used by one thread at the time:
+
+        db = DB2SessionSupervisor("sample", timeout=30, interrupt=True)
+        rs = db.query("select ...")
+        snapshots = db.call('getSnapshotForApplications')
+        db.close()
+    """
+    def __init__(self,
+            database=None,
+            standby=1,
+            timeout=300,
+            interrupt=False,
+            drainTimeout=10,
+            delimiter="@",
+            cache=None,
+            instance=None,
+            sessionFactory=None
+        ):
+        self.database = database
+        self.standbySize = standby
+        self.timeout = timeout
+        self.interrupt = interrupt
+        self.drainTimeout = drainTimeout
+        self.delimiter = delimiter
+        self.cache = cache
+        self.instance = instance
+        self.sessionFactory = sessionFactory
+        self.failovers = 0
+        self.cond = threading.Condition()
+        self.standby = []
+        self.closed = False
+        self.active = self._newSession()
+        self.warmer = threading.Thread(target=self._warm, name="supervisor.warmer")
+        self.warmer.daemon = True
+        self.warmer.start()
+
+    def _newSession(self):
+        """
+        Spawn and connect a new session, override or provide a
+        sessionFactory(database) to customize the sessions.
+        """
+        if self.sessionFactory:
+            session = self.sessionFactory(self.database)
+        else:
+            session = DB2CliSubprocess(self.database, self.delimiter, self.cache, self.instance)
+        session.requestTimeout = self.timeout
+        return session
+
+    def _warm(self):
+        """
+        Keep standbySize standby sessions ready
+        """
+        while True:
+            with self.cond:
+                while not self.closed and len(self.standby) >= self.standbySize:
+                    self.cond.wait()
+                if self.closed:
+                    return
+            try:
+                session = self._newSession()
+            except Exception as e:
+                LGR.debug("supervisor-spawn-err:{0}".format(traceback.format_exc()))
+                time.sleep(1)
+                continue
+            with self.cond:
+                # a drained session may have filled the standby list
+                spare = self.closed or len(self.standby) >= self.standbySize
+                if not spare:
+                    self.standby.append(session)
+                    self.cond.notify_all()
+            if spare:
+                session.shutdown()
+
+    def session(self):
+        """
+        Return the active session (replaced first if its process ended)
+        """
+        session = self.active
+        if not session.isAlive():
+            session = self.failover()
+        return session
+
+    def failover(self):
+        """
+        Replace the active session with a standby one (a new one is
+        started if none is ready) and retire the old one
+        """
+        old = self.active
+        with self.cond:
+            if self.closed:
+                raise Exception("The {0} supervisor is closed".format(self.database))
+            session = None
+            while self.standby and session is None:
+                session = self.standby.pop(0)
+                if not session.isAlive():
+                    self._retire(session, False)
+                    session = None
+            self.cond.notify_all()
+        if session is None:
+            session = self._newSession()
+        self.active = session
+        self.failovers += 1
+        LGR.debug("supervisor-failover:{0}".format(self.database))
+        retire = threading.Thread(
+            target=self._retire,
+            args=(old, self.interrupt),
+            name="supervisor.retire"
+        )
+        retire.daemon = True
+        retire.start()
+        return session
+
+    def _retire(self, session, interrupt):
+        """
+        Drain (after an interrupt) or kill a session taken out of service
+        """
+        try:
+            if interrupt and session.isAlive():
+                session.interrupt()
+                if session.endRequestEvent.wait(self.drainTimeout) and \
+                  session.endRequest and session.isAlive():
+                    with self.cond:
+                        if not self.closed and len(self.standby) < self.standbySize:
+                            LGR.debug("supervisor-drained:{0}".format(self.database))
+                            self.standby.append(session)
+                            self.cond.notify_all()
+                            return
+            if session.isAlive():
+                session.proc.kill()
+        except Exception as e:
+            LGR.debug("supervisor-retire-err:{0}".format(traceback.format_exc()))
+        session.close()
+
+    def call(self, method, *args, **kw):
+        """
+        Call a DB2CliSubprocess method on the active session, the session
+        is replaced if the request did not end with a prompt (timeout
+        or process ended)
+        """
+        session = self.session()
+        try:
+            return getattr(session, method)(*args, **kw)
+        except Exception as e:
+            if not session.endRequest or not session.isAlive():
+                self.failover()
+            raise
+
+    def query(self, sql, *args, **kw):
+        return self.call('query', sql, *args, **kw)
+
+    def execStmt(self, sql, *args, **kw):
+        return self.call('execStmt', sql, *args, **kw)
+
+    def execCmd(self, sql, *args, **kw):
+        return self.call('execCmd', sql, *args, **kw)
+
+    def close(self):
+        """
+        End the active and the standby sessions
+        """
+        with self.cond:
+            self.closed = True
+            sessions = self.standby + [self.active]
+            self.standby = []
+            self.cond.notify_all()
+        for session in sessions:
+            try:
+                session.shutdown()
+            except Exception as e:
+                LGR.debug("supervisor-close-err:{0}".format(traceback.format_exc()))
+
+class DB2pdSubprocess(TextRequestResponseSubprocess):
+    """
+    Call a db2pd command then execute subsequent commands parse and 
+    return results to the caller.
+    
+    The output of a db2pd invocation is parsed in a single pass in a map
+    of sections by section title ('Locks', 'Memory Pools', ...), each 
+    section is a map {'names', 'rows', 'values'} where the table rows
+    are lists of values in the names order and values holds the 
+    'key   value' lines of the section.
+    """
+    PROMPT = "db2pd> "
+    ERROR_LINE_REC = re.compile("^Invalid\s+command.*$")
+    BANNER_REC = re.compile("^(Database|Member|Partition)\\b.*\s--\s")
+    COLUMNS_SPLIT_REC = re.compile("\s{2,}")
+    COLUMN_REC = re.compile("\S+")
+    KV_SPLIT_REC = re.compile("\s*:\s+|\s{2,}")
+    
+    # accessor name: (db2pd option, section title, database scoped, 
+    # text columns not converted by db2pdValue)
+    SECTIONS = {
+        'latches':('-latches', 'Latches', False, ()),
+        'locks':('-locks', 'Locks', True, ('Lockname',)),
+        'bufferpools':('-bufferpools', 'Bufferpools', True, ('Name',)),
+        'transactions':('-transactions', 'Transactions', True, ()),
+        'mempools':('-mempools', 'Memory Pools', False, ('PoolName',))
+    }
+    
+    def __init__(self, database=None, reactor=None):
+        self.database = database
+        TextRequestResponseSubprocess.__init__(self,
+            ["db2pd", "-interactive"],
+            self.__promptDetector,
+            reactor=reactor
+        )
+    
+    def testForErrorState(self, line):
+        """
+        Detect if this line is the start of an error message as 
+        a SQLnnnnN ...pattern        
+        """
+        return DB2pdSubprocess.ERROR_LINE_REC.match(line)
+
+    def __promptDetector(self, line):
+        return line == DB2pdSubprocess.PROMPT
+    
+    def handleSectionOutputLine(self, line):
+        """
+        Handle the output of a db2pd command made of titled sections
+        ('Title:') of tables (header line then rows up to a blank line)
+        and 'key   value' lines
+        """
+        text = line.strip()
+        if not text:
+            self.table = None
+            return
+        if self.table is not None:
+            self._addSectionRow(line.rstrip())
+            return
+        if DB2pdSubprocess.BANNER_REC.match(text):
+            self.response.setdefault('banner', []).append(text)
+            self.section = None
+            return
+        parts = DB2pdSubprocess.COLUMNS_SPLIT_REC.split(text)
+        if len(parts) == 1 and text.endswith(":"):
+            self.section = self._newSection(text[:-1])
+            return
+        if self.section is None:
+            self.section = self._newSection("")
+        if len(parts) <= 2 and DB2pdSubprocess.KV_SPLIT_REC.search(text):
+            k, v = DB2pdSubprocess.KV_SPLIT_REC.split(text, 1)
+            self.section['values'][k] = db2pdValue(v) if v else None
+        elif len(parts) > 2 and not any(
+                DB2PD_NUMBER_REC.match(x) or DB2PD_HEX_REC.match(x) for x in parts
+            ):
+            header = line.rstrip()
+            self.section['names'] = header.split()
+            self.table = [m.start() for m in DB2pdSubprocess.COLUMN_REC.finditer(header)]
+            self.converters = None
+        else:
+            self.section['values'][text] = None
+    
+    def _newSection(self, title):
+        """
+        Return the section map (the same one for a title repeated
+        by several members)
+        """
+        self.table = None
+        sections = self.response['sections']
+        if not title in sections:
+            sections[title] = {'title':title, 'names':[], 'rows':[], 'values':{}}
+        return sections[title]
+    
+    def _addSectionRow(self, line):
+        """
+        Split a table row on blanks, if a value contains blanks (or is 
+        empty) split it by the header columns positions instead
+        """
+        values = line.split()
+        starts = self.table
+        if len(values) != len(starts):
+            ends = starts[1:] + [None]
+            values = [line[b:e].strip() for b, e in zip(starts, ends)]
+        if self.converters is None:
+            self.converters = self._columnConverters(values)
+        try:
+            row = [
+                (v if c is None else c(v)) if v else None \
+                for c, v in zip(self.converters, values)
+            ]
+        except ValueError as e:
+            # a value not typed as the first row one 
+            row = [
+                (v if c is None else db2pdValue(v)) if v else None \
+                for c, v in zip(self.converters, values)
+            ]
+        self.section['rows'].append(row)
+    
+    def _columnConverters(self, values):
+        """
+        Type the table columns by the values of the first row so
+        the next rows are converted without testing every value
+        """
+        textColumns = self.textColumns.get(self.section['title'], ())
+        converters = []
+        for n, v in zip(self.section['names'], values):
+            if n in textColumns or not v:
+                converters.append(None)
+            elif DB2PD_NUMBER_REC.match(v):
+                converters.append(int)
+            elif DB2PD_HEX_REC.match(v):
+                converters.append(_hexInt)
+            else:
+                converters.append(None)
+        return converters
+    
+    def _prepareSections(self, names, database=None):
+        """
+        Reset the section parsing state and return the db2pd command 
+        for the accessor names (keys of SECTIONS)
+        """
+        options = [DB2pdSubprocess.SECTIONS[n] for n in names]
+        database = database or self.database
+        cmd = " ".join(o[0] for o in options)
+        if database and any(o[2] for o in options):
+            cmd = "-db {0} {1}".format(database, cmd)
+        self.textColumns = dict((o[1], o[3]) for o in options)
+        self.section = None
+        self.table = None
+        return cmd
+    
+    def _sectionsResult(self, names):
+        """
+        Return a response parser mapping the accessor names to 
+        their sections
+        """
+        def parse(response):
+            sections = response['sections']
+            rs = {}
+            for n in names:
+                title = DB2pdSubprocess.SECTIONS[n][1]
+                rs[n] = sections.get(title) or \
+                    {'title':title, 'names':[], 'rows':[], 'values':{}}
+            return rs
+        return parse
+    
+    def execCmd(self,
+            cmd,
+            responseParser=None,
+            responseLineHandler=None,
+            responseObject=None,
+            timeout=300
+        ):
+        """
+        Execute a db2pd command and return the output lines or the
+        result of the responseParser
+        """
+        try:
+            self.responseParser = responseParser
+            self.responseLineHandler = responseLineHandler
+            self.response = [] if responseObject is None else responseObject
+            return self.getResponse(cmd, timeout)
+        finally:
+            self.responseParser = None
+            self.responseLineHandler = None
+    
+    def execSections(self, cmd, timeout=300):
+        """
+        Execute a db2pd command and return all the sections of its 
+        output as a map {'banner', 'sections'}
+        """
+        self.textColumns = {}
+        self.section = None
+        self.table = None
+        return self.execCmd(cmd,
+            responseLineHandler=self.handleSectionOutputLine,
+            responseObject={'banner':[], 'sections':{}},
+            timeout=timeout
+        )
+    
+    def getSections(self, *names, **kw):
+        """
+        Collect several sections (keys of SECTIONS) with a single db2pd
+        invocation and return a map of sections by accessor name.
+        The database keyword overrides the session database.
+        """
+        return self.execCmd(
+            self._prepareSections(names, kw.get('database')),
+            responseParser=self._sectionsResult(names),
+            responseLineHandler=self.handleSectionOutputLine,
+            responseObject={'banner':[], 'sections':{}},
+            timeout=kw.get('timeout', 300)
+        )
+    
+    def getLatches(self):
+        """
+        Return the latches section (db2pd -latches)
+        """
+        return self.getSections('latches')['latches']
+    
+    def getLocks(self, database=None):
+        """
+        Return the locks section (db2pd -db <database> -locks)
+        """
+        return self.getSections('locks', database=database)['locks']
+    
+    def getBufferpools(self, database=None):
+        """
+        Return the bufferpools section (db2pd -db <database> -bufferpools)
+        """
+        return self.getSections('bufferpools', database=database)['bufferpools']
+    
+    def getTransactions(self, database=None):
+        """
+        Return the transactions section (db2pd -db <database> -transactions)
+        """
+        return self.getSections('transactions', database=database)['transactions']
+    
+    def getMempools(self):
+        """
+        Return the memory pools section (db2pd -mempools)
+        """
+        return self.getSections('mempools')['mempools']
+    
+class MetricRingBuffer:
+    """
+    A fixed size ring buffer of samples (time, elapsed, key, values).
+    The values are kept in a preallocated size x width array of floats 
+    (numpy when available) so the memory used does not grow with the
+    number of samples, the oldest samples are overwritten.
+    """
+    def __init__(self, size, width):
+        self.size = size
+        self.width = width
+        if numpy is not None:
+            self.values = numpy.zeros((size, width))
+        else:
+            self.values = array.array('d', [0.0]) * (size * width)
+        self.times = array.array('d', [0.0]) * size
+        self.elapsed = array.array('d', [0.0]) * size
+        self.keys = [None] * size
+        self.pos = 0
+        self.count = 0
+        self.lock = threading.Lock()
+    
+    def __len__(self):
+        return self.count
+    
+    def append(self, t, elapsed, key, values):
+        with self.lock:
+            pos = self.pos
+            self.times[pos] = t
+            self.elapsed[pos] = elapsed
+            self.keys[pos] = key
+            if numpy is not None:
+                self.values[pos] = values
+            else:
+                w = self.width
+                self.values[pos * w:(pos + 1) * w] = array.array('d', values)
+            self.pos = (pos + 1) % self.size
+            if self.count < self.size:
+                self.count += 1
+    
+    def records(self, key=None):
+        """
+        Return the samples as (time, elapsed, key, values) oldest first,
+        only the ones of key if provided
+        """
+        with self.lock:
+            rl = []
+            w = self.width
+            for i in range(self.pos - self.count, self.pos):
+                pos = i % self.size
+                if key is not None and self.keys[pos] != key:
+                    continue
+                if numpy is not None:
+                    values = self.values[pos].tolist()
+                else:
+                    values = self.values[pos * w:(pos + 1) * w].tolist()
+                rl.append((self.times[pos], self.elapsed[pos], self.keys[pos], values))
+            return rl
+    
+    def rates(self, key=None):
+        """
+        Return the samples as (time, key, values per second)
+        """
+        return [
+            (t, k, [v / e if e else 0.0 for v in values]) \
+            for t, e, k, values in self.records(key)
+        ]
+    
+class MonitorMetric:
+    """
+    A monitoring query (or fetch(session) function returning a map with
+    'names' and 'rows' as query() does) sampled by a DB2MonitorSampler.
+    The rows are identified by the keyColumns values, the counterColumns 
+    are monotonic counters and the difference with the previous sample 
+    of the same key is stored in the ring buffer.
+    """
+    def __init__(self,
+            name,
+            sql=None,
+            keyColumns=(),
+            counterColumns=(),
+            interval=10,
+            size=10000,
+            fetch=None
+        ):
+        self.name = name
+        self.sql = sql
+        self.fetch = fetch
+        self.keyColumns = [c.upper() for c in keyColumns]
+        self.counterColumns = [c.upper() for c in counterColumns]
+        self.interval = interval
+        self.ring = MetricRingBuffer(size, len(self.counterColumns))
+        # last counter values by key as (time, values)
+        self.last = {}
+        self.nextRun = time.time()
+        self.runs = 0
+        self.skipped = 0
+        self.errors = 0
+        self.lastError = None
+    
+    def sample(self, session, now=None):
+        """
+        Run the query and store the counter deltas of the rows 
+        already seen in the previous sample
+        """
+        rs = self.fetch(session) if self.fetch else session.query(self.sql, ttl=0)
+        now = now or time.time()
+        names = [n.upper() for n in rs['names']]
+        keyIdx = [names.index(c) for c in self.keyColumns]
+        counterIdx = [names.index(c) for c in self.counterColumns]
+        last = {}
+        for row in rs['rows']:
+            key = tuple(row[i] for i in keyIdx)
+            values = [_counterValue(row[i]) for i in counterIdx]
+            prev = self.last.get(key)
+            if prev:
+                # a counter lower than before was reset
+                self.ring.append(now, now - prev[0], key, [
+                    v - p if v >= p else v for v, p in zip(values, prev[1])
+                ])
+            last[key] = (now, values)
+        self.last = last
+        self.runs += 1
+    
+def _counterValue(value):
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return float('nan')
+    
+class DB2MonitorSampler(threading.Thread):
+    """
+    Run the registered monitoring metrics (see MonitorMetric) on their
+    schedule over a persistent session (DB2CliSubprocess):
+    
+        sampler = DB2MonitorSampler(DB2CliSubprocess("sample"))
+        sampler.addMetric("bp", 
+            "select bp_name, member, pool_data_l_reads "
+            "from table(mon_get_bufferpool(null, -2))",
+            keyColumns=["BP_NAME", "MEMBER"],
+            counterColumns=["POOL_DATA_L_READS"],
+            interval=5
+        )
+        sampler.start()
+        ...
+        rates = sampler.metric("bp").ring.rates()
+        sampler.stop()
+    
+    The metrics run one at the time, a metric slower than its interval 
+    is not run again until it ends and the runs it missed are skipped
+    (counted in skipped) instead of being run back to back.
+    """
+    def __init__(self, session, name=None):
+        threading.Thread.__init__(self)
+        self.name = name if name else "db2sampler"
+        self.daemon = True
+        self.session = session
+        self.metrics = {}
+        self.lock = threading.Lock()
+        self.stopEvent = threading.Event()
+    
+    def addMetric(self, name, sql=None, **kw):
+        """
+        Register a metric, see MonitorMetric for the parameters
+        """
+        metric = MonitorMetric(name, sql, **kw)
+        with self.lock:
+            self.metrics[name] = metric
+        return metric
+    
+    def removeMetric(self, name):
+        with self.lock:
+            return self.metrics.pop(name, None)
+    
+    def metric(self, name):
+        return self.metrics.get(name)
+    
+    def runDue(self, now=None):
+        """
+        Run the metrics due now, return the time of the next run
+        """
+        now = now or time.time()
+        with self.lock:
+            metrics = list(self.metrics.values())
+        for m in metrics:
+            if m.nextRun <= now and not self.stopEvent.is_set():
+                self._runMetric(m)
+        return min([m.nextRun for m in metrics] or [time.time() + 1])
+    
+    def _runMetric(self, m):
+        try:
+            m.sample(self.session)
+        except Exception as e:
+            m.errors += 1
+            m.lastError = e
+            LGR.debug("sampler-err:{0}".format(traceback.format_exc()))
+        end = time.time()
+        missed = int((end - m.nextRun) / m.interval)
+        m.skipped += missed
+        m.nextRun += (missed + 1) * m.interval
+    
+    def run(self):
+        while not self.stopEvent.is_set():
+            nextRun = self.runDue()
+            self.stopEvent.wait(min(max(nextRun - time.time(), 0), 1.0))
+    
+    def stop(self, timeout=None):
         """
+        Stop the sampling thread after the current run
         """
+        self.stopEvent.set()
+        if self.is_alive():
+            self.join(timeout)
     
 def main():
     """    
@@ -696,7 +4341,7 @@ def main():
         try:
             rs = proc.query("select * from TEST_SCH.TEST_TBL")
             pprint(rs)
-        except Exception, e:
+        except Exception as e:
             LGR.debug("!!!! Error:> {0}".format(traceback.format_exc()))
             # pprint(e)
             
@@ -0,0 +1,253 @@
+"""
+    @author: Romeo Lupascu
+    @contact: romeol@ca.ibm.com
+    @organization: IBM
+    @license: http://www.apache.org/licenses/LICENSE-2.0
+    @see: https://github.com/romeolibm/python_db2_cli_lib
+
+     Discovery of the db2 engine (db2sysc) and fenced (db2fmp) processes
+     by reading /proc (linux) instead of spawning ps, id or db2pd.
+
+        discovery = DB2ProcessDiscovery()
+        for p in discovery.processes('db2sysc'):
+            print(p.pid, p.user, p.instance, p.member)
+        print(discovery.diagPath(p.instance))
+
+     The processes found are cached, a cached process is only used while
+     its pid still exists with the same start time and /proc is scanned
+     again for new processes after maxAge seconds. The diagpath is
+     resolved once per instance.
+"""
+import os, subprocess, threading, time
+try:
+    import pwd
+except ImportError:
+    pwd = None
+
+DB2_PROCESS_NAMES = ('db2sysc', 'db2fmp')
+
+class DB2Process:
+    """
+    A db2 process found in /proc
+    """
+    def __init__(self, pid, name, ppid, startTime, uid, user, instance, member, cmdline):
+        self.pid = pid
+        self.name = name
+        self.ppid = ppid
+        self.startTime = startTime
+        self.uid = uid
+        self.user = user
+        self.instance = instance
+        self.member = member
+        self.cmdline = cmdline
+
+    def __repr__(self):
+        return "DB2Process(pid={0},name={1},user={2},instance={3},member={4})".format(
+            self.pid, self.name, self.user, self.instance, self.member
+        )
+
+def _readFile(fname):
+    """
+    Return the content of a /proc file or None if the process is gone
+    (or the file is not readable)
+    """
+    try:
+        f = open(fname, "rb")
+        try:
+            return f.read()
+        finally:
+            f.close()
+    except (IOError, OSError):
+        return None
+
+def _text(data):
+    return data.decode("utf-8", "replace") if not isinstance(data, str) else data
+
+def userName(uid):
+    """
+    Return the user name of a uid (the uid as text if unknown)
+    """
+    try:
+        return pwd.getpwuid(uid).pw_name
+    except (KeyError, AttributeError):
+        return str(uid)
+
+class DB2ProcessDiscovery:
+    """
+    Find the db2 processes (DB2_PROCESS_NAMES) by reading the
+    /proc/<pid>/stat, status, cmdline and environ files
+    """
+    def __init__(self, procDir="/proc", maxAge=60, emptyRescan=1):
+        self.procDir = procDir
+        self.maxAge = maxAge
+        # rescan interval while no process matches (e.g. engine restarting)
+        self.emptyRescan = emptyRescan
+        # pid -> DB2Process
+        self.cache = {}
+        self.scanTime = None
+        self.diagPaths = {}
+        self.lock = threading.RLock()
+
+    def available(self):
+        """
+        True if /proc has the linux format
+        """
+        return os.path.exists(os.path.join(self.procDir, "self", "stat"))
+
+    def _stat(self, pid):
+        """
+        Return (name, ppid, start time) from /proc/<pid>/stat, None if
+        the process ended (or is a zombie)
+        """
+        data = _readFile(os.path.join(self.procDir, str(pid), "stat"))
+        if not data:
+            return None
+        data = _text(data)
+        # the name is between parentheses and may contain blanks
+        spos = data.find("(")
+        epos = data.rfind(")")
+        fields = data[epos + 2:].split()
+        if fields[0] in ("Z", "X"):
+            return None
+        return data[spos + 1:epos], int(fields[1]), int(fields[19])
+
+    def _startTime(self, pid):
+        stat = self._stat(pid)
+        return stat[2] if stat else None
+
+    def _process(self, pid, name, ppid, startTime):
+        """
+        Read the owner, command line and environment of a db2 process
+        """
+        procDir = os.path.join(self.procDir, str(pid))
+        uid = None
+        status = _readFile(os.path.join(procDir, "status"))
+        if status:
+            for line in _text(status).splitlines():
+                if line.startswith("Uid:"):
+                    uid = int(line.split()[1])
+                    break
+        user = userName(uid) if uid is not None else None
+        cmdline = _text(_readFile(os.path.join(procDir, "cmdline")) or b"")
+        cmdline = " ".join(x for x in cmdline.split("\0") if x).strip()
+        environ = {}
+        data = _readFile(os.path.join(procDir, "environ"))
+        if data:
+            for item in _text(data).split("\0"):
+                k, sep, v = item.partition("=")
+                if sep:
+                    environ[k] = v
+        instance = environ.get('DB2INSTANCE')
+        member = None
+        if name == 'db2sysc':
+            # the engine command line is 'db2sysc <member>'
+            args = cmdline.split()
+            if len(args) > 1 and args[1].isdigit():
+                member = int(args[1])
+            elif environ.get('DB2NODE', '').isdigit():
+                member = int(environ['DB2NODE'])
+            else:
+                member = 0
+            if not instance:
+                # the engine runs as the instance owner
+                instance = user
+        return DB2Process(pid, name, ppid, startTime, uid, user, instance, member, cmdline)
+
+    def scan(self):
+        """
+        Scan /proc for the db2 processes, the processes already cached
+        (same pid and start time) are not read again
+        """
+        with self.lock:
+            cache = {}
+            try:
+                pids = [int(x) for x in os.listdir(self.procDir) if x.isdigit()]
+            except OSError:
+                pids = []
+            for pid in pids:
+                stat = self._stat(pid)
+                if not stat or not stat[0] in DB2_PROCESS_NAMES:
+                    continue
+                p = self.cache.get(pid)
+                if p is None or p.startTime != stat[2]:
+                    p = self._process(pid, stat[0], stat[1], stat[2])
+                cache[pid] = p
+            self.cache = cache
+            self.scanTime = time.time()
+            return list(cache.values())
+
+    def _valid(self, processes):
+        """
+        True if the processes are still running (same pid and start time)
+        """
+        for p in processes:
+            if self._startTime(p.pid) != p.startTime:
+                return False
+        return True
+
+    def processes(self, name=None, instance=None, refresh=False):
+        """
+        Return the db2 processes (of a name and instance if provided),
+        /proc is scanned again if refresh is True, after maxAge seconds,
+        if a cached process ended or (after emptyRescan seconds) if no 
+        process matches.
+        """
+        with self.lock:
+            age = time.time() - self.scanTime if self.scanTime else None
+            if refresh or age is None or age > self.maxAge:
+                self.scan()
+                age = 0
+            selected = self._select(name, instance)
+            if not self._valid(selected) or \
+              (not selected and age > self.emptyRescan):
+                self.scan()
+                selected = self._select(name, instance)
+            return sorted(selected, key=lambda p: p.pid)
+
+    def _select(self, name, instance):
+        return [p for p in self.cache.values() \
+            if (name is None or p.name == name) and \
+                (instance is None or p.instance == instance)]
+
+    def instances(self):
+        """
+        Return the instance names of the running db2 engines
+        """
+        return sorted(set(p.instance for p in self.processes('db2sysc')))
+
+    def diagPath(self, instance=None):
+        """
+        Return the diagpath of an instance (the DB2INSTANCE one by default)
+        resolved once with db2pd -diagpath, or the default sqllib/db2dump
+        of the instance owner home. A failed lookup (None) is not cached
+        and is retried on the next call.
+        """
+        instance = instance or os.environ.get('DB2INSTANCE')
+        with self.lock:
+            if instance in self.diagPaths:
+                return self.diagPaths[instance]
+        path = None
+        env = dict(os.environ)
+        if instance:
+            env['DB2INSTANCE'] = instance
+        try:
+            out = subprocess.Popen(
+                ["db2pd", "-diagpath"],
+                stdout=subprocess.PIPE,
+                stderr=subprocess.PIPE,
+                env=env
+            ).communicate()[0]
+            lines = [l.strip() for l in _text(out).splitlines() if l.strip()]
+            if lines:
+                path = lines[-1]
+        except OSError:
+            pass
+        if not path and instance and pwd is not None:
+            try:
+                path = os.path.join(pwd.getpwnam(instance).pw_dir, "sqllib", "db2dump")
+            except KeyError:
+                pass
+        if path:
+            with self.lock:
+                self.diagPaths[instance] = path
+        return path
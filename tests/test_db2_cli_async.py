@@ -0,0 +1,65 @@
+"""
+    Tests of db2_cli_async (python 3) run against the fake db2 command
+    of db2_cli_fake
+"""
+import os, sys, shutil, tempfile, unittest
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import db2_cli_fake
+try:
+    import asyncio
+    from db2_cli_async import AsyncDB2CliSubprocess
+except (ImportError, SyntaxError):
+    # python 2
+    asyncio = None
+
+_FAKE = {}
+
+def setUpModule():
+    _FAKE['dir'] = db2_cli_fake.installFakeCommands(tempfile.mkdtemp(prefix="db2fake"))
+    _FAKE['path'] = os.environ.get('PATH', '')
+    os.environ['PATH'] = _FAKE['dir'] + os.pathsep + _FAKE['path']
+
+def tearDownModule():
+    os.environ['PATH'] = _FAKE['path']
+    shutil.rmtree(_FAKE['dir'], True)
+
+@unittest.skipIf(asyncio is None, "db2_cli_async requires python 3")
+class AsyncQueryTest(unittest.TestCase):
+
+    def run_session(self, test):
+        loop = asyncio.new_event_loop()
+        try:
+            db = loop.run_until_complete(AsyncDB2CliSubprocess.create("sample"))
+            try:
+                return loop.run_until_complete(test(db))
+            finally:
+                loop.run_until_complete(db.shutdown())
+        finally:
+            loop.close()
+
+    def testQueryArgumentsMatchTheSyncOrder(self):
+        # the 4th positional argument is the ttl, not the timeout
+        rs = self.run_session(
+            lambda db: db.query("select * from t fetch first 3 rows only", None, None, 0)
+        )
+        self.assertEqual(len(rs['rows']), 3)
+
+    def testTypedQuery(self):
+        rs = self.run_session(
+            lambda db: db.query("select * from t fetch first 2 rows only", typed=True)
+        )
+        self.assertEqual([r[0] for r in rs['rows']], [0, 1])
+        self.assertEqual(rs['names'][0], "ID")
+
+    def testPromptFollowedByOutputInOneChunk(self):
+        prompts = []
+        def feed(db):
+            splitter = db._outputSplitter()
+            splitter.inflightLineHandler = lambda s: prompts.append(s) or s == db.PROMPT
+            splitter.feed(b"db2 => \n  1 record(s) selected.\n")
+            return asyncio.sleep(0)
+        self.run_session(feed)
+        self.assertEqual(prompts, ["db2 => "])
+
+if __name__ == '__main__':
+    unittest.main()
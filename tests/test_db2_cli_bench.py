@@ -0,0 +1,96 @@
+"""
+    Smoke tests of the db2_cli_fake command line processors and of the
+    db2_cli_bench benchmarks run against them
+"""
+import os, sys, json, shutil, subprocess, tempfile, unittest
+try:
+    from StringIO import StringIO
+except ImportError:
+    from io import StringIO
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import db2_cli_bench
+from db2_cli_fake import FakeCommandLineProcessor, FakeDB2pd
+
+BENCH = os.path.abspath(db2_cli_bench.__file__)
+if BENCH.endswith((".pyc", ".pyo")):
+    BENCH = BENCH[:-1]
+
+class FakeCommandsTest(unittest.TestCase):
+
+    def testCommandLineProcessor(self):
+        out = StringIO()
+        FakeCommandLineProcessor("@", out=out).run(StringIO(
+            "connect to sample@\n"
+            "select * from t\n fetch first 2 rows only@\n"
+            "select * from missing@\n"
+            "quit@\n"
+            "values 1@\n"
+        ))
+        output = out.getvalue()
+        # the banner prompt and one per request up to quit
+        self.assertEqual(output.count(FakeCommandLineProcessor.PROMPT), 4)
+        self.assertTrue("Local database alias   = SAMPLE" in output)
+        self.assertTrue("  2 record(s) selected." in output)
+        self.assertTrue("SQL0204N" in output)
+
+    def testDb2pd(self):
+        out = StringIO()
+        FakeDB2pd(out=out).run(StringIO("-db sample -locks -bufferpools\n-bogus\nq\n-latches\n"))
+        output = out.getvalue()
+        self.assertEqual(output.count(FakeDB2pd.PROMPT), 3)
+        self.assertTrue("Database SAMPLE" in output)
+        self.assertTrue("Locks:" in output and "Bufferpools" in output)
+        self.assertFalse("Latches:" in output)
+        self.assertTrue("Invalid command -bogus" in output)
+
+class BenchSmokeTest(unittest.TestCase):
+
+    ARGS = ["--rows", "20", "--count", "5", "--repeat", "1", "--startups", "1", "--applications", "5"]
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp(prefix="db2bench")
+
+    def tearDown(self):
+        shutil.rmtree(self.dir, True)
+
+    def bench(self, *args):
+        proc = subprocess.Popen([sys.executable, BENCH] + self.ARGS + list(args),
+            stdout=subprocess.PIPE, stderr=subprocess.STDOUT, universal_newlines=True)
+        output = proc.communicate()[0]
+        return proc.returncode, output
+
+    def testRunAndCompare(self):
+        fname = os.path.join(self.dir, "bench.json")
+        rc, output = self.bench("--json", fname)
+        self.assertEqual(rc, 0, output)
+        f = open(fname)
+        try:
+            results = json.load(f)
+        finally:
+            f.close()
+        names = [r['name'] for r in results]
+        self.assertEqual(names[0], "startup")
+        for name in ("query.latency", "query.throughput", "queryColumns.throughput",
+                "snapshot.applications", "db2pd.sections"):
+            self.assertTrue(name in names, name)
+            self.assertTrue(name in output)
+        self.assertTrue(all(r['count'] and r['p50'] is not None for r in results))
+        self.assertTrue(results[names.index("query.throughput")]['rowsPerSecond'] > 0)
+        rc, output = self.bench("--baseline", fname, "--tolerance", "1000")
+        self.assertEqual(rc, 0, output)
+        self.assertFalse("REGRESSION" in output)
+
+    def testRegressions(self):
+        baseline = [
+            {'name':"a", 'p50':0.010, 'rowsPerSecond':1000.0, 'mbPerSecond':None},
+            {'name':"b", 'p50':0.010, 'rowsPerSecond':1000.0, 'mbPerSecond':10.0}
+        ]
+        results = [
+            {'name':"a", 'p50':0.013, 'rowsPerSecond':1000.0, 'mbPerSecond':None},
+            {'name':"b", 'p50':0.011, 'rowsPerSecond':900.0, 'mbPerSecond':7.0},
+            {'name':"c", 'p50':1.0, 'rowsPerSecond':None, 'mbPerSecond':None}
+        ]
+        regressions = db2_cli_bench.compareResults(results, baseline, 0.2)
+        self.assertEqual(len(regressions), 2)
+        self.assertTrue(regressions[0].startswith("a: p50"))
+        self.assertTrue(regressions[1].startswith("b: mbPerSecond"))
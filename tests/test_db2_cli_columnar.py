@@ -0,0 +1,55 @@
+"""
+    Tests of db2_cli_columnar run against the fake db2 command of
+    db2_cli_fake (no db2 instance needed)
+"""
+import os, sys, shutil, tempfile, unittest
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import db2_cli_fake
+from db2_cli_lib import DB2CliSubprocess
+from db2_cli_columnar import ColumnarReader, exportColumnar, pyarrow
+
+_FAKE = {}
+
+def setUpModule():
+    _FAKE['dir'] = db2_cli_fake.installFakeCommands(tempfile.mkdtemp(prefix="db2fake"))
+    _FAKE['path'] = os.environ.get('PATH', '')
+    os.environ['PATH'] = _FAKE['dir'] + os.pathsep + _FAKE['path']
+
+def tearDownModule():
+    os.environ['PATH'] = _FAKE['path']
+    shutil.rmtree(_FAKE['dir'], True)
+
+class ExportColumnarTest(unittest.TestCase):
+
+    SQL = "select * from t fetch first 5 rows only"
+
+    def setUp(self):
+        self.db = DB2CliSubprocess("sample")
+        self.path = os.path.join(_FAKE['dir'], "t.col")
+
+    def tearDown(self):
+        self.db.shutdown()
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+    def testExportReadBack(self):
+        # the default format is read by ColumnarReader with or without pyarrow
+        self.assertEqual(exportColumnar(self.db, self.SQL, self.path, batchRows=2), 5)
+        reader = ColumnarReader(self.path)
+        try:
+            self.assertEqual(len(reader), 5)
+            self.assertEqual(reader.column("ID"), [0, 1, 2, 3, 4])
+            self.assertEqual(list(reader.values("ID", 1)), [2, 3])
+            self.assertEqual(next(reader.rows())[:2], [0, "value1_0"])
+        finally:
+            reader.close()
+
+    @unittest.skipIf(pyarrow is None, "pyarrow is not installed")
+    def testArrowFile(self):
+        exportColumnar(self.db, self.SQL, self.path, fileFormat='arrow')
+        self.assertRaises(Exception, ColumnarReader, self.path)
+        table = pyarrow.ipc.open_file(pyarrow.memory_map(self.path)).read_all()
+        self.assertEqual(table.column("ID").to_pylist(), [0, 1, 2, 3, 4])
+
+if __name__ == '__main__':
+    unittest.main()
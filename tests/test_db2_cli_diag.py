@@ -0,0 +1,83 @@
+"""
+    Tests of the db2_cli_diag tailer on generated db2diag.log files
+"""
+import os, sys, shutil, tempfile, time, unittest
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from db2_cli_diag import DB2DiagTailer
+
+RECORD = """2020-06-22-10.00.0{0}.000000-240 I{0}E400           LEVEL: Error
+PID     : 100{0}                 TID : 1                 PROC : db2sysc 0
+FUNCTION: DB2 UDB, fake, sqlfFunction{0}, probe:10
+MESSAGE : message {0}
+"""
+
+class DB2DiagTailerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp(prefix="db2diag")
+        self.log = os.path.join(self.dir, "db2diag.log")
+        self.ckpt = os.path.join(self.dir, "diag.ckpt")
+        self.write(*range(3))
+
+    def tearDown(self):
+        shutil.rmtree(self.dir, True)
+
+    def write(self, *records):
+        f = open(self.log, "a")
+        try:
+            f.write("".join(RECORD.format(i) + "\n" for i in records))
+        finally:
+            f.close()
+
+    def tailer(self, idleTimeout=None):
+        return DB2DiagTailer(self.dir, self.ckpt, idleTimeout=idleTimeout)
+
+    def testRecordCommittedByTheNextOne(self):
+        records = self.tailer().records()
+        self.assertEqual(next(records).pid, 1000)
+        self.assertEqual(next(records).pid, 1001)
+        # the handling of the second record failed
+        records.close()
+        self.assertEqual([r.pid for r in self.tailer().records()], [1001])
+
+    def testExplicitCommit(self):
+        tailer = self.tailer()
+        records = tailer.records()
+        next(records)
+        tailer.commit()
+        records.close()
+        self.assertEqual([r.pid for r in self.tailer().records()], [1001])
+
+    def testLastRecordHeldBack(self):
+        tailer = self.tailer()
+        self.assertEqual([r.pid for r in tailer.records()], [1000, 1001])
+        self.write(3)
+        self.assertEqual([r.pid for r in tailer.records()], [1002])
+        tailer.stop()
+        self.assertEqual([r.pid for r in tailer.records()], [1003])
+        self.assertEqual(list(self.tailer().records()), [])
+
+    def testIdleFileFlushesTheLastRecord(self):
+        mtime = time.time() - 60
+        os.utime(self.log, (mtime, mtime))
+        self.assertEqual([r.pid for r in self.tailer(30).records()], [1000, 1001, 1002])
+        self.assertEqual(list(self.tailer(30).records()), [])
+
+    def testLogFileMatchesOnlyItsRotations(self):
+        for name in ("db2diag.log.bak", "db2diag.log_old", "db2diag.1.log"):
+            shutil.copy(self.log, os.path.join(self.dir, name))
+        tailer = DB2DiagTailer(self.log, idleTimeout=None)
+        self.assertEqual(
+            sorted(os.path.basename(f) for f in tailer.files()),
+            ["db2diag.1.log", "db2diag.log"]
+        )
+
+    def testLevelAndFunctionFilters(self):
+        self.write(3)
+        tailer = DB2DiagTailer(self.dir, levels=["error"], functions=["sqlfFunction1"], idleTimeout=None)
+        self.assertEqual([r.pid for r in tailer.records()], [1001])
+        tailer = DB2DiagTailer(self.dir, levels=["severe"], idleTimeout=None)
+        self.assertEqual(list(tailer.records()), [])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,933 @@
+"""
+    Tests of db2_cli_lib run against the fake db2 and db2pd commands of
+    db2_cli_fake (no db2 instance needed)
+"""
+import os, sys, shutil, tempfile, threading, time, unittest
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import db2_cli_fake, db2_cli_lib
+from db2_cli_lib import DB2CliSubprocess, DB2CliSubprocessPool, ColumnBatchParser, \
+    ResultCache, MonitorMetric, DB2FanOutExecutor, DB2SessionSupervisor, SQLError, \
+    SpillingRows, DB2pdSubprocess, MetricRingBuffer, DB2MonitorSampler, \
+    LatencyHistogram, RequestInstrumentation, CompactRows, CompactMapping, MappingCompactor, \
+    TextRequestResponseSubprocess, TextLineSplitter, TextIOProcessor, TextIOReactor, useReactor
+
+_FAKE = {}
+
+def setUpModule():
+    _FAKE['dir'] = db2_cli_fake.installFakeCommands(tempfile.mkdtemp(prefix="db2fake"))
+    _FAKE['path'] = os.environ.get('PATH', '')
+    os.environ['PATH'] = _FAKE['dir'] + os.pathsep + _FAKE['path']
+
+def tearDownModule():
+    os.environ['PATH'] = _FAKE['path']
+    shutil.rmtree(_FAKE['dir'], True)
+
+class PoolTest(unittest.TestCase):
+
+    def testFailedWarmUpShutsDownStartedSessions(self):
+        started = []
+        def factory(database):
+            if len(started) == 2:
+                raise Exception("spawn failed")
+            session = DB2CliSubprocess(database)
+            started.append(session)
+            return session
+        self.assertRaises(Exception, DB2CliSubprocessPool, "sample", 3, sessionFactory=factory)
+        self.assertEqual(len(started), 2)
+        for session in started:
+            self.assertFalse(session.isAlive())
+
+class FanOutTest(unittest.TestCase):
+
+    def testTimeoutStartsAfterCheckout(self):
+        fanout = DB2FanOutExecutor(["sample", "other"], workers=1, timeout=1)
+        pool = fanout._pool(None)
+        busy = pool.checkout()
+        # the only session of the pool is busy longer than the timeout
+        release = threading.Timer(1.5, pool.checkin, [busy])
+        release.start()
+        try:
+            records = fanout.run(lambda session, target: session.database)
+        finally:
+            release.join()
+            fanout.close()
+        self.assertEqual([r['status'] for r in records], ['ok', 'ok'])
+        self.assertEqual([r['result'] for r in records], ["sample", "other"])
+
+    def testCompletedTargetIsNotExpired(self):
+        fanout = DB2FanOutExecutor(["sample"], timeout=30)
+        try:
+            record = fanout.run(lambda session, target: session.query("select * from t"))[0]
+            session = fanout._pool(None).checkout()
+            record.update(session=session, started=time.time() - 60)
+            fanout._expire(record, time.time())
+            self.assertEqual(record['status'], 'ok')
+            self.assertTrue(session.isAlive())
+            fanout._pool(None).checkin(session)
+        finally:
+            fanout.close()
+
+class SupervisorTest(unittest.TestCase):
+
+    def testQueryForwardsTyped(self):
+        supervisor = DB2SessionSupervisor("sample", standby=0)
+        try:
+            rs = supervisor.query("select * from t fetch first 2 rows only", typed=True)
+        finally:
+            supervisor.close()
+        self.assertEqual([row[0] for row in rs['rows']], [0, 1])
+
+class ColumnBatchParserTest(unittest.TestCase):
+
+    def testDescribedCharColumnKeepsLeadingZeros(self):
+        parser = ColumnBatchParser([5, 3], types=['CHAR', 'INTEGER'])
+        parser.addBatch(["01234   7", "00042  -1"])
+        zips, numbers = parser.columns()
+        self.assertEqual(list(zips), ["01234", "00042"])
+        self.assertEqual([int(x) for x in numbers], [7, -1])
+
+    def testLeftAlignedColumnIsText(self):
+        parser = ColumnBatchParser([8])
+        parser.addBatch(["01234   ", "00042   "])
+        self.assertEqual(list(parser.columns()[0]), ["01234", "00042"])
+
+    def testNullsOfANumericBatchAreNotNan(self):
+        parser = ColumnBatchParser([3], types=None)
+        parser.addBatch(["  1", "  -"])
+        parser.addBatch(["abc"])
+        self.assertEqual(list(parser.columns()[0]), ["1", "-", "abc"])
+
+class QueryColumnsTest(unittest.TestCase):
+
+    def testColumnsTypedFromDescribe(self):
+        db = DB2CliSubprocess("sample")
+        try:
+            rs = db.queryColumns("select * from t fetch first 3 rows only")
+        finally:
+            db.shutdown()
+        ids, values = rs['columns'][0], rs['columns'][1]
+        self.assertEqual([int(x) for x in ids], [0, 1, 2])
+        self.assertEqual(list(values), ["value1_0", "value1_1", "value1_2"])
+
+    def testMultibyteRows(self):
+        sql = "select * from utf8 fetch first 3 rows only"
+        db = DB2CliSubprocess("sample")
+        try:
+            rows = db.query(sql)['rows']
+            rs = db.queryColumns(sql)
+        finally:
+            db.shutdown()
+        expected = [u"v\u00e4lue1_0", u"v\u00e4lue1_1", u"v\u00e4lue1_2"]
+        if sys.version_info[0] < 3:
+            expected = [v.encode("utf-8") for v in expected]
+        self.assertEqual([r[1] for r in rows], expected)
+        self.assertEqual(rs['count'], 3)
+        self.assertEqual([int(x) for x in rs['columns'][0]], [0, 1, 2])
+        self.assertEqual(list(rs['columns'][1]), expected)
+
+class InsertManyTest(unittest.TestCase):
+
+    def setUp(self):
+        self.db = DB2CliSubprocess("sample")
+
+    def tearDown(self):
+        self.db.shutdown()
+
+    def testValues(self):
+        rs = self.db.insertMany("t", ["id", "name"], [[i, "n%d" % i] for i in range(5)], chunkSize=2)
+        self.assertEqual(rs['method'], 'values')
+        self.assertEqual((rs['inserted'], rs['statements']), (5, 3))
+
+    def testFailedChunkStopsTheNextOnes(self):
+        rows = [[1], [2], ["missing"], [4], [5]]
+        try:
+            self.db.insertMany("t", ["name"], rows, chunkSize=1)
+            self.fail("no error raised")
+        except SQLError as e:
+            self.assertEqual(e.inserted, 2)
+        # the chunks after the failed one were never written
+        self.assertEqual(self.db.pipeSent, 3)
+        self.assertTrue(self.db.isAlive())
+
+    def testImport(self):
+        for useFifo in (True, False):
+            rs = self.db.insertMany("t", ["id"], ([i] for i in range(50)), bulkThreshold=10, useFifo=useFifo)
+            self.assertEqual(rs['method'], 'import')
+            self.assertEqual((rs['read'], rs['inserted'], rs['rejected']), (50, 50, 0))
+
+    def testLoad(self):
+        rs = self.db.insertMany("t", ["id"], [[i] for i in range(7)], method='load')
+        self.assertEqual(rs['method'], 'load')
+        self.assertEqual(rs['inserted'], 7)
+
+class RowDecoderTest(unittest.TestCase):
+
+    def testDescribeKeptUntilDDL(self):
+        described = []
+        class Session(DB2CliSubprocess):
+            def describe(self, sql):
+                described.append(sql)
+                return DB2CliSubprocess.describe(self, sql)
+        db = Session("sample")
+        try:
+            for stmt in ("commit", "set schema fake", "insert into t values (1)", "alter table t add c int"):
+                db.query("select * from t", typed=True)
+                db.execStmt(stmt)
+            db.query("select * from t", typed=True)
+        finally:
+            db.shutdown()
+        self.assertEqual(len(described), 2)
+
+class SpillingRowsTest(unittest.TestCase):
+
+    def rows(self, n, start=0):
+        return [[i, "value%d" % i] for i in range(start, start + n)]
+
+    def testSpillAndRead(self):
+        with SpillingRows(maxBytes=4096, flushBytes=256) as rows:
+            rows.extend(self.rows(10))
+            self.assertFalse(rows.spilled)
+            rows.extend(self.rows(490, 10))
+            self.assertTrue(rows.spilled)
+            self.assertEqual(len(rows), 500)
+            self.assertEqual(rows[0], [0, "value0"])
+            self.assertEqual(rows[-1], [499, "value499"])
+            self.assertEqual(rows[10:13], self.rows(3, 10))
+            self.assertEqual(list(rows), self.rows(500))
+            # the file is mapped again when it grows
+            rows.append([500, "value500"])
+            self.assertEqual(rows[500], [500, "value500"])
+            self.assertRaises(IndexError, rows.row, 501)
+
+    def testAppendWhileIterating(self):
+        with SpillingRows(maxBytes=256, flushBytes=64) as rows:
+            rows.extend(self.rows(50))
+            seen = []
+            for row in rows:
+                seen.append(row)
+                rows.append([row[0] + 50, "value%d" % (row[0] + 50)])
+                # reads remap the grown file under the iteration
+                rows[-1]
+            self.assertEqual(seen, self.rows(50))
+            self.assertEqual(list(rows), self.rows(100))
+
+    def testClose(self):
+        rows = SpillingRows(maxBytes=64)
+        rows.extend(self.rows(20))
+        rows.close()
+        self.assertEqual(len(rows), 0)
+        self.assertFalse(rows.spilled)
+
+class QueryIterTest(unittest.TestCase):
+
+    def setUp(self):
+        self.db = DB2CliSubprocess("sample")
+
+    def tearDown(self):
+        self.db.shutdown()
+
+    def testRows(self):
+        rows = self.db.queryIter("select * from t fetch first 25 rows only")
+        self.assertEqual([int(r[0]) for r in rows], list(range(25)))
+        self.assertEqual(rows.names[0], "ID")
+
+    def testBackpressure(self):
+        rows = self.db.queryIter("select * from t fetch first 200 rows only", queueSize=5)
+        first = next(rows)
+        time.sleep(0.3)
+        # the stdout thread waits for the consumer
+        self.assertTrue(rows.queue.full())
+        self.assertFalse(self.db.endRequest)
+        self.assertEqual(len([first] + list(rows)), 200)
+
+    def testEarlyClose(self):
+        with self.db.queryIter("select * from t fetch first 500 rows only", queueSize=10) as rows:
+            self.assertEqual([int(next(rows)[0]) for i in range(3)], [0, 1, 2])
+        self.assertEqual(len(self.db.query("select * from t fetch first 4 rows only")['rows']), 4)
+
+    def testErrorAtTheEnd(self):
+        rows = self.db.queryIter("select * from missing")
+        self.assertRaises(SQLError, list, rows)
+        self.assertEqual(len(self.db.query("select * from t fetch first 2 rows only")['rows']), 2)
+
+class ExecManyTest(unittest.TestCase):
+
+    def setUp(self):
+        self.db = DB2CliSubprocess("sample")
+
+    def tearDown(self):
+        self.db.shutdown()
+
+    def testOneResultPerStatement(self):
+        stmts = ["select * from t fetch first {0} rows only".format(n) for n in range(1, 30)]
+        results = self.db.execMany(stmts + ["commit", "select * from missing"])
+        self.assertEqual([len(r['rows']) for r in results[:-2]], list(range(1, 30)))
+        self.assertEqual(results[-2]['rows'], [])
+        self.assertTrue(isinstance(results[-1], SQLError))
+        self.assertEqual(len(self.db.query("select * from t fetch first 3 rows only")['rows']), 3)
+
+    def testWindow(self):
+        stmts = ["values {0}".format(i) for i in range(20)]
+        results = self.db.execMany(stmts, window=3)
+        self.assertEqual(len(results), 20)
+        self.assertFalse(any(isinstance(r, SQLError) for r in results))
+
+    def testStopOnError(self):
+        stmts = ["commit", "select * from missing", "commit", "commit", "commit", "commit"]
+        results = self.db.execMany(stmts, stopOnError=True, window=2)
+        self.assertTrue(isinstance(results[1], SQLError))
+        # at most the window after the error was sent
+        self.assertTrue(self.db.pipeSent <= 3)
+        self.assertEqual(results[self.db.pipeSent:], [None] * (6 - self.db.pipeSent))
+
+class DB2pdSectionsTest(unittest.TestCase):
+
+    def setUp(self):
+        self.pd = DB2pdSubprocess("sample")
+
+    def tearDown(self):
+        self.pd.shutdown()
+
+    def testSectionsOfOneInvocation(self):
+        sections = self.pd.getSections('latches', 'locks', 'bufferpools', 'transactions', 'mempools')
+        self.assertEqual(sorted(sections), ['bufferpools', 'latches', 'locks', 'mempools', 'transactions'])
+        self.assertEqual(sections['mempools']['title'], 'Memory Pools')
+        for name in ('latches', 'locks', 'transactions', 'mempools'):
+            section = sections[name]
+            self.assertEqual(len(section['rows']), 10)
+            self.assertTrue(all(len(r) == len(section['names']) for r in section['rows']))
+
+    def testValueConversions(self):
+        locks = self.pd.getLocks()
+        row = dict(zip(locks['names'], locks['rows'][0]))
+        # hex addresses as int, numeric looking lock names kept as text
+        self.assertEqual(row['Address'], 0x00007F0B1A2C0000)
+        self.assertEqual(row['Lockname'], '02000400000000000000000052')
+        self.assertEqual(row['TranHdl'], 3)
+        self.assertEqual(row['Type'], 'TableLock')
+        mempools = self.pd.getMempools()
+        logSz = mempools['names'].index('LogSz')
+        self.assertEqual([r[logSz] for r in mempools['rows']], [i * 100 for i in range(10)])
+
+    def testKeyValueLines(self):
+        bufferpools = self.pd.getBufferpools()
+        self.assertEqual(bufferpools['values']['Num Bufferpools'], 5)
+        self.assertEqual(bufferpools['rows'][0][bufferpools['names'].index('Name')], 'IBMDEFAULTBP')
+        transactions = self.pd.getTransactions()
+        self.assertEqual(transactions['values']['Total application commits'], 30)
+        self.assertEqual(transactions['values']['Total application rollbacks'], 2)
+
+    def testBannerAndErrors(self):
+        output = self.pd.execSections("-db other -locks")
+        self.assertTrue(any("Database OTHER" in b for b in output['banner']))
+        self.assertEqual(len(output['sections']['Locks']['rows']), 10)
+        self.assertRaises(Exception, self.pd.execCmd, "-bogus")
+        self.assertEqual(len(self.pd.getLatches()['rows']), 10)
+
+class MonitorSamplerTest(unittest.TestCase):
+
+    def counters(self, samples):
+        """
+        Return a fetch function returning the rows of the next sample
+        """
+        samples = iter(samples)
+        return lambda session: {'names':['key', 'reads'], 'rows':next(samples)}
+
+    def testRingBufferWraparound(self):
+        ring = MetricRingBuffer(3, 2)
+        for i in range(5):
+            ring.append(float(i), 2.0, i, [i, 2 * i])
+        self.assertEqual(len(ring), 3)
+        self.assertEqual([r[2] for r in ring.records()], [2, 3, 4])
+        self.assertEqual(ring.records(3), [(3.0, 2.0, 3, [3.0, 6.0])])
+        self.assertEqual(ring.rates(4), [(4.0, 4, [2.0, 4.0])])
+        ring.append(5.0, 0.0, 5, [1, 1])
+        self.assertEqual(ring.rates(5), [(5.0, 5, [0.0, 0.0])])
+
+    def testCounterDeltas(self):
+        metric = MonitorMetric("reads", keyColumns=['KEY'], counterColumns=['READS'],
+            fetch=self.counters([
+                [['a', 10], ['b', 5]],
+                [['a', 15], ['b', 7], ['c', 1]],
+                # b reset, c gone
+                [['a', 25], ['b', 3]],
+            ])
+        )
+        for now in (100.0, 110.0, 130.0):
+            metric.sample(None, now)
+        self.assertEqual([(r[1], r[2], r[3]) for r in metric.ring.records()], [
+            (10.0, ('a',), [5.0]), (10.0, ('b',), [2.0]),
+            (20.0, ('a',), [10.0]), (20.0, ('b',), [3.0]),
+        ])
+        self.assertEqual(sorted(metric.last), [('a',), ('b',)])
+        self.assertEqual([r[2] for r in metric.ring.rates(('a',))], [[0.5], [0.5]])
+
+    def testDeltasWrapAround(self):
+        metric = MonitorMetric("reads", keyColumns=['KEY'], counterColumns=['READS'], size=2,
+            fetch=self.counters([[['a', i * i]] for i in range(6)])
+        )
+        for now in range(6):
+            metric.sample(None, float(now + 1))
+        self.assertEqual(len(metric.ring), 2)
+        self.assertEqual([r[3] for r in metric.ring.records()], [[7.0], [9.0]])
+
+    def testSamplerSchedule(self):
+        sampler = DB2MonitorSampler(None)
+        calls = []
+        def fetch(session):
+            calls.append(session)
+            if len(calls) == 2:
+                raise Exception("monitor query failed")
+            return {'names':['KEY', 'READS'], 'rows':[['a', len(calls)]]}
+        metric = sampler.addMetric("reads", keyColumns=['KEY'], counterColumns=['READS'],
+            interval=3600, fetch=fetch)
+        sampler.runDue()
+        sampler.runDue()
+        self.assertEqual(len(calls), 1)
+        metric.nextRun = time.time()
+        sampler.runDue()
+        self.assertEqual((metric.runs, metric.errors), (1, 1))
+        self.assertEqual(str(metric.lastError), "monitor query failed")
+        self.assertTrue(metric.nextRun > time.time())
+        self.assertTrue(sampler.removeMetric("reads") is metric)
+        self.assertEqual(sampler.metric("reads"), None)
+
+    def testSamplerThread(self):
+        db = DB2CliSubprocess("sample")
+        sampler = DB2MonitorSampler(db)
+        metric = sampler.addMetric("rows", "select * from t fetch first 2 rows only",
+            keyColumns=['ID'], counterColumns=['ID'], interval=0.05)
+        try:
+            sampler.start()
+            deadline = time.time() + 10
+            while len(metric.ring) < 4 and time.time() < deadline:
+                time.sleep(0.05)
+        finally:
+            sampler.stop(5)
+            db.shutdown()
+        self.assertFalse(sampler.is_alive())
+        self.assertEqual(metric.errors, 0)
+        self.assertTrue(len(metric.ring) >= 4)
+        self.assertEqual(set(r[2] for r in metric.ring.records()), set([('0',), ('1',)]))
+
+class InstrumentationTest(unittest.TestCase):
+
+    def testBucketBounds(self):
+        h = LatencyHistogram(subBuckets=128)
+        # exact below 2 x 64 microseconds
+        self.assertEqual([h._value(h._index(us)) for us in range(128)], list(range(128)))
+        previous = 0
+        for us in list(range(128, 5000)) + [10 ** n + d for n in range(4, 10) for d in (-1, 0, 1)]:
+            index = h._index(us)
+            self.assertTrue(index >= previous)
+            previous = index
+            high = h._value(index)
+            # us is in the bucket ending at high and the bucket is < 2/128 wide
+            self.assertTrue(us <= high < us * (1 + 2.0 / 128), us)
+            self.assertEqual(h._index(high), index)
+            self.assertEqual(h._index(high + 1), index + 1)
+
+    def testPercentiles(self):
+        h = LatencyHistogram()
+        self.assertEqual(h.percentile(50), None)
+        for ms in range(1, 1001):
+            h.record(ms / 1000.0)
+        stats = h.stats()
+        self.assertEqual((stats['count'], stats['min'], stats['max']), (1000, 0.001, 1.0))
+        self.assertAlmostEqual(stats['mean'], 0.5005)
+        for p, expected in (('p50', 0.5), ('p90', 0.9), ('p99', 0.99)):
+            self.assertTrue(expected <= stats[p] < expected * (1 + 2.0 / 128), (p, stats[p]))
+        self.assertEqual(h.percentile(100), 1.0)
+
+    def testOverflowAndNegative(self):
+        h = LatencyHistogram(maxSeconds=1)
+        h.record(-1)
+        h.record(5)
+        self.assertEqual((h.counts[0], h.counts[-1]), (1, 1))
+        self.assertEqual((h.min, h.max), (0.0, 5))
+        self.assertTrue(1.0 <= h.percentile(100) < 1.0 * (1 + 2.0 / 128))
+
+    def testHooks(self):
+        seen = []
+        def failing(metrics):
+            raise Exception("hook failed")
+        instrumentation = RequestInstrumentation([failing, seen.append])
+        db = DB2CliSubprocess("sample")
+        other = DB2CliSubprocess("sample")
+        try:
+            self.assertTrue(db.enableMetrics(instrumentation) is instrumentation)
+            other.enableMetrics(instrumentation)
+            db.query("select * from t fetch first 5 rows only")
+            other.query("  SELECT * from t fetch first 2 rows only")
+            self.assertRaises(SQLError, db.query, "select * from missing")
+            instrumentation.removeHook(failing)
+            db.execStmt("commit")
+            db.disableMetrics()
+            db.query("select * from t")
+        finally:
+            db.shutdown()
+            other.shutdown()
+        self.assertEqual([(m.kind, m.rows) for m in seen[:2]], [('select', 5), ('select', 2)])
+        self.assertTrue(isinstance(seen[2].error, SQLError))
+        self.assertEqual((instrumentation.requests, instrumentation.errors), (4, 1))
+        stats = instrumentation.stats()
+        self.assertEqual(sorted(stats), ['commit', 'select'])
+        self.assertEqual(stats['select']['total']['count'], 3)
+        metrics = seen[0].asDict()
+        self.assertTrue(metrics['bytesRead'] > 0 and metrics['lines'] >= 5)
+        # the first bytes can be read before sent is set, only the order with the end is sure
+        self.assertTrue(metrics['firstByteSeconds'] is not None)
+        self.assertTrue(metrics['firstByteSeconds'] <= metrics['totalSeconds'])
+
+class CompactTest(unittest.TestCase):
+
+    def testRowsRoundTrip(self):
+        rows = [[i, "status%d" % (i % 3), None if i % 5 else "x", i * 0.5] for i in range(3000)]
+        compact = CompactRows(rows)
+        self.assertEqual(len(compact), 3000)
+        self.assertEqual(compact.tolist(), rows)
+        self.assertEqual(list(compact), rows)
+        self.assertEqual((compact[0], compact[-1]), (rows[0], rows[-1]))
+        self.assertEqual(compact[10:20:3], rows[10:20:3])
+        self.assertEqual(compact.column(1), [r[1] for r in rows])
+        self.assertRaises(IndexError, compact.row, 3000)
+        # the repeated values are dictionary encoded, the distinct ones plain
+        self.assertEqual(len(compact.columns[1].values), 3)
+        self.assertTrue(compact.columns[0].plain is not None)
+        self.assertEqual(list(CompactRows()), [])
+
+    def testWideCodes(self):
+        compact = CompactRows()
+        compact.extend([i // 2] for i in range(131074))
+        self.assertEqual(compact.columns[0].codes.typecode, 'I')
+        self.assertEqual(compact.column(0), [i // 2 for i in range(131074)])
+
+    def testAsRowReader(self):
+        db = DB2CliSubprocess("sample")
+        try:
+            expected = db.query("select * from t fetch first 7 rows only")['rows']
+            rows = db.query("select * from t fetch first 7 rows only", rowReader=CompactRows())['rows']
+        finally:
+            db.shutdown()
+        self.assertTrue(isinstance(rows, CompactRows))
+        self.assertEqual(rows.tolist(), expected)
+
+    def testMappings(self):
+        compactor = MappingCompactor()
+        first = compactor.compact({'a':1, 'b':"x" * 20, 'c':None})
+        second = compactor.compact(dict([('a', 2), ('b', "x" * 20), ('c', None)]))
+        other = compactor.compact({'a':1})
+        self.assertEqual(first, {'a':1, 'b':"x" * 20, 'c':None})
+        self.assertNotEqual(first, second)
+        self.assertTrue(first.schema is second.schema)
+        self.assertFalse(first.schema is other.schema)
+        self.assertTrue(first['b'] is second['b'])
+        self.assertEqual((len(first), sorted(first), first.get('z', 0)), (3, ['a', 'b', 'c'], 0))
+        self.assertTrue('c' in first and not 'z' in first)
+        self.assertRaises(KeyError, lambda: first['z'])
+        self.assertEqual(dict(second.items()), {'a':2, 'b':"x" * 20, 'c':None})
+        self.assertEqual(repr(other), "{'a': 1}")
+
+    def testCompactorTablesAreBounded(self):
+        compactor = MappingCompactor(maxSchemas=2, maxValues=10)
+        mappings = [dict([("k%d" % (i % 5), i)]) for i in range(50)]
+        compacted = [compactor.compact(m) for m in mappings]
+        self.assertTrue(len(compactor.schemas) <= 2 and len(compactor.values) <= 10)
+        self.assertEqual(compacted, mappings)
+
+    def testCompactSnapshots(self):
+        db = DB2CliSubprocess("sample")
+        try:
+            full = db.getSnapshotForApplications()
+            compact = db.getSnapshotForApplications(compact=True)
+        finally:
+            db.shutdown()
+        self.assertEqual(sorted(compact), sorted(full))
+        for ah, snapshot in full.items():
+            self.assertTrue(isinstance(compact[ah], CompactMapping))
+            # the agent sections are keyed by position in the compact ones
+            plain = dict((k, v) for k, v in snapshot.items() if not k.startswith("agent["))
+            self.assertEqual(dict((k, v) for k, v in compact[ah].items() if not k.startswith("agent[")), plain)
+            self.assertTrue(any(k.startswith("agent[0].") for k in compact[ah]))
+        schemas = set(id(s.schema) for s in compact.values())
+        self.assertTrue(len(schemas) < len(compact))
+
+class TextLineSplitterTest(unittest.TestCase):
+
+    def splitter(self, prompt=None):
+        self.lines = []
+        self.prompts = []
+        def inflight(line):
+            if line == "db2 => ":
+                self.prompts.append(len(self.lines))
+                return True
+            return False
+        return TextLineSplitter(self.lines.append, inflight, encoding="utf-8", prompt=prompt)
+
+    def testLinesAndPromptAcrossChunks(self):
+        splitter = self.splitter()
+        for chunk in ("ro", "w1\r\nrow", "2\r", "\nrow3\ndb2 ", "=", "> "):
+            splitter.feed(chunk)
+        self.assertEqual(self.lines, ["row1", "row2", "row3"])
+        self.assertEqual(self.prompts, [3])
+        self.assertEqual(splitter.tail, "")
+        splitter.feed("row4\n")
+        self.assertEqual(self.lines[-1], "row4")
+
+    def testMultibyteCharAcrossChunks(self):
+        splitter = self.splitter()
+        data = u"v\u00e4lue\n".encode("utf-8")
+        splitter.feed(data[:2])
+        splitter.feed(data[2:])
+        # python 2 pipes are read as str, kept encoded
+        expected = u"v\u00e4lue" if sys.version_info[0] >= 3 else data[:-1]
+        self.assertEqual(self.lines, [expected])
+
+    def testPromptFollowedByOutput(self):
+        # only the unterminated tail is checked for the prompt
+        splitter = self.splitter()
+        splitter.feed("row1\ndb2 => row2\n")
+        self.assertEqual((self.lines, self.prompts), (["row1", "db2 => row2"], []))
+        # unless the prompt text is known
+        splitter = self.splitter(prompt="db2 => ")
+        splitter.feed("row1\ndb2 => row2\ndb2 => ")
+        self.assertEqual((self.lines, self.prompts), (["row1", "row2"], [1, 2]))
+
+    def testChunkedReader(self):
+        lines = []
+        prompts = []
+        def inflight(line):
+            if line == "db2 => ":
+                prompts.append(len(lines))
+                return True
+            return False
+        rfd, wfd = os.pipe()
+        reader = TextIOProcessor(os.fdopen(rfd, "rb"), linehandler=lines.append,
+            inflightLineHandler=inflight, chunkSize=4)
+        reader.start()
+        for chunk in (b"row1\nro", b"w2\ndb2 ", b"=> "):
+            os.write(wfd, chunk)
+            time.sleep(0.05)
+        os.close(wfd)
+        reader.join(5)
+        self.assertFalse(reader.is_alive())
+        self.assertTrue(reader.eof)
+        self.assertEqual(lines, ["row1", "row2"])
+        self.assertEqual(prompts, [2])
+
+@unittest.skipIf(db2_cli_lib.selectors is None, "the reactor requires the selectors module")
+class ReactorTest(unittest.TestCase):
+
+    def setUp(self):
+        self.reactor = TextIOReactor(chunkSize=16)
+        self.reactor.start()
+
+    def tearDown(self):
+        self.reactor.close()
+        self.reactor.join(5)
+
+    def waitFor(self, condition, timeout=5):
+        deadline = time.time() + timeout
+        while not condition() and time.time() < deadline:
+            time.sleep(0.01)
+        return condition()
+
+    def registered(self):
+        # the wakeup pipe is always registered
+        return len(self.reactor.selector.get_map()) - 1
+
+    def pipeProcessor(self, lines):
+        rfd, wfd = os.pipe()
+        processor = TextIOProcessor(os.fdopen(rfd, "rb"), linehandler=lines.append,
+            chunkSize=16, reactor=self.reactor)
+        processor.start()
+        return processor, wfd
+
+    def testRegisterUnregisterAndEof(self):
+        first, second = [], []
+        p1, w1 = self.pipeProcessor(first)
+        p2, w2 = self.pipeProcessor(second)
+        try:
+            self.assertTrue(self.waitFor(lambda: self.registered() == 2))
+            os.write(w1, b"a line longer than a chunk of the reactor\n")
+            os.write(w2, b"b1\nb2\n")
+            self.assertTrue(self.waitFor(lambda: len(first) == 1 and len(second) == 2))
+            self.assertEqual(first, ["a line longer than a chunk of the reactor"])
+            # a closed processor is no longer read
+            p1.close()
+            self.assertTrue(self.waitFor(lambda: self.registered() == 1))
+            os.write(w1, b"ignored\n")
+            # the end of input unregisters the other one
+            os.write(w2, b"b3\n")
+            os.close(w2)
+            w2 = None
+            self.assertTrue(self.waitFor(lambda: p2.eof and self.registered() == 0))
+            self.assertEqual(second, ["b1", "b2", "b3"])
+            self.assertEqual(first, ["a line longer than a chunk of the reactor"])
+            self.assertFalse(p1.is_alive() or p2.is_alive())
+        finally:
+            os.close(w1)
+            if w2 is not None:
+                os.close(w2)
+            p2.close()
+
+    def testSessionsShareTheReactor(self):
+        threads = threading.active_count()
+        sessions = [DB2CliSubprocess("sample", reactor=self.reactor) for i in range(3)]
+        try:
+            self.assertEqual(threading.active_count(), threads)
+            self.assertTrue(self.waitFor(lambda: self.registered() == 6))
+            for i, db in enumerate(sessions):
+                rs = db.query("select * from t fetch first {0} rows only".format(i + 1))
+                self.assertEqual(len(rs['rows']), i + 1)
+            sessions[0].shutdown()
+            self.assertTrue(self.waitFor(lambda: self.registered() == 4))
+            self.assertRaises(Exception, sessions[0].query, "select * from t")
+            self.assertEqual(len(sessions[1].query("select * from t")['rows']), 10)
+        finally:
+            for db in sessions:
+                db.shutdown()
+        self.assertTrue(self.waitFor(lambda: self.registered() == 0))
+
+    def testUseReactor(self):
+        default = TextRequestResponseSubprocess.defaultReactor
+        try:
+            reactor = useReactor()
+            self.assertTrue(useReactor() is reactor)
+            db = DB2CliSubprocess("sample")
+            try:
+                self.assertTrue(db.reactor is reactor)
+                self.assertEqual(len(db.query("select * from t")['rows']), 10)
+            finally:
+                db.shutdown()
+            reactor.close()
+            self.assertFalse(useReactor() is reactor)
+            self.assertEqual(useReactor(False), None)
+            db = DB2CliSubprocess("sample")
+            try:
+                self.assertEqual(db.reactor, None)
+            finally:
+                db.shutdown()
+        finally:
+            useReactor().close()
+            TextRequestResponseSubprocess.defaultReactor = default
+
+ECHO_SCRIPT = """
+for line in iter(sys.stdin.readline, ''):
+    cmd = line.strip()
+    if cmd == 'exit':
+        break
+    if cmd.startswith('sleep'):
+        time.sleep(float(cmd.split()[1]))
+    sys.stdout.write(cmd + '\\n> ')
+    sys.stdout.flush()
+"""
+
+class RequestCompletionTest(unittest.TestCase):
+
+    def echoSession(self, startup="sys.stdout.write('> ')", script=ECHO_SCRIPT):
+        """
+        Return a session of a child process running startup then 
+        echoing the commands followed by a '> ' prompt
+        """
+        startup = "import sys, time\n{0}\nsys.stdout.flush()\n".format(startup)
+        return TextRequestResponseSubprocess([sys.executable, "-c", startup + script],
+            lambda line: line == "> ")
+
+    def testCompletionIsSignaled(self):
+        proc = self.echoSession()
+        try:
+            self.assertTrue(proc.endRequest)
+            stime = time.time()
+            for i in range(50):
+                self.assertEqual(proc.getResponse("x%d" % i)[-1], "x%d" % i)
+            # a poll every 0.2 seconds would take 10 seconds
+            self.assertTrue(time.time() - stime < 5)
+        finally:
+            proc.shutdown()
+
+    def testTimeout(self):
+        proc = self.echoSession()
+        try:
+            stime = time.time()
+            try:
+                proc.getResponse("sleep 3", timeout=0.3)
+                self.fail("no timeout")
+            except Exception as e:
+                self.assertEqual(str(e), "Timeout")
+            self.assertTrue(time.time() - stime < 2)
+        finally:
+            proc.shutdown(0)
+
+    def testProcessEndedDuringRequest(self):
+        proc = self.echoSession()
+        try:
+            stime = time.time()
+            try:
+                proc.getResponse("exit", timeout=30)
+                self.fail("no error raised")
+            except Exception as e:
+                self.assertTrue(str(e).endswith("process ended"))
+            self.assertTrue(time.time() - stime < 5)
+        finally:
+            proc.shutdown()
+
+    def testStartup(self):
+        # the first prompt comes late
+        stime = time.time()
+        proc = self.echoSession("time.sleep(0.5); sys.stdout.write('banner\\n> ')")
+        try:
+            self.assertTrue(proc.endRequest)
+            self.assertTrue(time.time() - stime < 5)
+        finally:
+            proc.shutdown()
+        # no prompt ever: the startup does not wait 10 seconds for it
+        stime = time.time()
+        proc = self.echoSession("time.sleep(0.5)", script="")
+        try:
+            self.assertFalse(proc.endRequest)
+            self.assertTrue(time.time() - stime < 5)
+            # the reader threads end at the end of input
+            proc.stdoutproc.join(5)
+            proc.stderrproc.join(5)
+            self.assertFalse(proc.stdoutproc.is_alive() or proc.stderrproc.is_alive())
+        finally:
+            proc.shutdown()
+
+class ResultCacheTest(unittest.TestCase):
+
+    def countingSession(self, cache):
+        queries = []
+        class Session(DB2CliSubprocess):
+            def _prepareQuery(self, sql, *args, **kw):
+                queries.append(sql)
+                return DB2CliSubprocess._prepareQuery(self, sql, *args, **kw)
+        return Session("sample", cache=cache), queries
+
+    def testQueryIsNotCachedByDefault(self):
+        db, queries = self.countingSession(ResultCache())
+        try:
+            db.query("select * from t")
+            db.query("select * from t")
+            db.query("select * from t", ttl=60)
+            db.query("select * from t", ttl=60)
+        finally:
+            db.shutdown()
+        self.assertEqual(len(queries), 3)
+        self.assertEqual(db.cache.stats()['hits'], 1)
+
+    def testSamplerDeltasAreNotCached(self):
+        db, queries = self.countingSession(ResultCache())
+        metric = MonitorMetric("rows", "select * from t fetch first 2 rows only",
+            keyColumns=['ID'], counterColumns=['ID'])
+        try:
+            db.query(metric.sql, ttl=60)
+            metric.sample(db)
+            metric.sample(db)
+        finally:
+            db.shutdown()
+        self.assertEqual(len(queries), 3)
+        self.assertEqual(len(metric.ring), 2)
+
+    def testQueryAfterConnectSwitch(self):
+        db, queries = self.countingSession(ResultCache())
+        try:
+            db.query("select * from t", ttl=60)
+            db.execStmt("connect to other")
+            self.assertEqual(db.database, "other")
+            db.query("select * from t", ttl=60)
+            self.assertEqual(sorted(key[1] for key in db.cache.entries), ["other", "sample"])
+            db.execMany(["connect to sample", "select * from missing"])
+            self.assertEqual(db.database, "sample")
+        finally:
+            db.shutdown()
+        self.assertEqual(queries.count("select * from t"), 2)
+
+    def testOnlyWritesInvalidateOtherSessions(self):
+        cache = ResultCache()
+        db, queries = self.countingSession(cache)
+        other = DB2CliSubprocess("sample", cache=cache)
+        try:
+            db.query("select * from t", ttl=60)
+            other.execStmt("commit")
+            other.execStmt("set schema fake")
+            other.execMany(["connect to sample", "commit"])
+            db.query("select * from t", ttl=60)
+            self.assertEqual(len(queries), 1)
+            other.execStmt("insert into t values (1)")
+            db.query("select * from t", ttl=60)
+            self.assertEqual(len(queries), 2)
+        finally:
+            other.shutdown()
+            db.shutdown()
+
+    def testCachedResultsAreCopies(self):
+        db, queries = self.countingSession(ResultCache())
+        try:
+            rs = db.query("select * from t fetch first 2 rows only", ttl=60)
+            rs['rows'].append(["x"])
+            rs['extra'] = True
+            cached = db.query("select * from t fetch first 2 rows only", ttl=60)
+        finally:
+            db.shutdown()
+        self.assertEqual(len(queries), 1)
+        self.assertEqual(len(cached['rows']), 2)
+        self.assertFalse('extra' in cached)
+
+    def testCacheKeyHasTheInstance(self):
+        db = DB2CliSubprocess("sample", instance="db2inst2")
+        try:
+            self.assertEqual(db._cacheKey("select 1 from t")[:2], ("db2inst2", "sample"))
+        finally:
+            db.shutdown()
+
+class SnapshotTest(unittest.TestCase):
+
+    def testApplicationsSnapshotNeedsADatabase(self):
+        db = DB2CliSubprocess()
+        try:
+            try:
+                db.getSnapshotForApplications()
+                self.fail("no error raised")
+            except Exception as e:
+                self.assertTrue(str(e).startswith("no database"))
+            self.assertTrue(db.isAlive())
+        finally:
+            db.shutdown()
+
+class QueryExportTest(unittest.TestCase):
+
+    def exportSession(self, failExport=False):
+        readers = []
+        class Session(DB2CliSubprocess):
+            def execStmt(self, sql, *args, **kw):
+                if failExport and sql.startswith("EXPORT"):
+                    # db2 never opens the pipe
+                    raise Exception("Timeout")
+                return DB2CliSubprocess.execStmt(self, sql, *args, **kw)
+            def _releaseExport(self, reader, timeout=None):
+                readers.append(reader)
+                DB2CliSubprocess._releaseExport(self, reader, timeout)
+        return Session("sample"), readers
+
+    def testExportRows(self):
+        db, readers = self.exportSession()
+        try:
+            rs = db.queryExport("select * from t fetch first 4 rows only", timeout=30)
+        finally:
+            db.shutdown()
+        self.assertEqual(rs['count'], 4)
+        self.assertEqual([r[0] for r in rs['rows']], [0, 1, 2, 3])
+        self.assertFalse(os.path.exists(os.path.dirname(readers[0].fname)))
+
+    def testFailedExportCleansUp(self):
+        db, readers = self.exportSession(failExport=True)
+        try:
+            self.assertRaises(Exception, db.queryExport, "select * from t", timeout=30)
+        finally:
+            db.shutdown()
+        self.assertFalse(readers[0].is_alive())
+        self.assertFalse(os.path.exists(os.path.dirname(readers[0].fname)))
+
+if __name__ == '__main__':
+    unittest.main()
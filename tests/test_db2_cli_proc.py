@@ -0,0 +1,33 @@
+"""
+    Tests of db2_cli_proc (no db2 instance needed)
+"""
+import os, sys, shutil, tempfile, unittest
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from db2_cli_proc import DB2ProcessDiscovery
+
+class DiagPathTest(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp(prefix="db2proc")
+        self.path = os.environ.get('PATH', '')
+        os.environ['PATH'] = self.dir
+
+    def tearDown(self):
+        os.environ['PATH'] = self.path
+        shutil.rmtree(self.dir, True)
+
+    def testFailedLookupIsRetried(self):
+        discovery = DB2ProcessDiscovery()
+        self.assertEqual(discovery.diagPath("nosuchinstance"), None)
+        fname = os.path.join(self.dir, "db2pd")
+        f = open(fname, "w")
+        try:
+            f.write("#!/bin/sh\necho /db2/diag/\n")
+        finally:
+            f.close()
+        os.chmod(fname, 0o755)
+        self.assertEqual(discovery.diagPath("nosuchinstance"), "/db2/diag/")
+        self.assertEqual(discovery.diagPaths, {"nosuchinstance":"/db2/diag/"})
+
+if __name__ == '__main__':
+    unittest.main()